@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'electoral_roll.apps.ElectoralRollConfig',
     'crispy_forms',
 ]
@@ -80,10 +81,29 @@ WSGI_APPLICATION = 'challenge_2.wsgi.application'
 # If you choose postgre the app will use the configuration of database given in below in DATABASES
 
 MONGO_URI =  'mongodb://localhost'
-# ENGINE -> 1: postgre, 2: mongo
+# ENGINE -> 1: postgre, 2: mongo, 3: mmap (read only, it reads the file of export_electoral_roll_index)
 DB_ENGINE = 'mongo'
+# Index file used by the mmap engine
+MMAP_INDEX_FILE = os.path.join(BASE_DIR, 'electoral_roll.index')
 # DB_NAME indicates the name of database to use in mongo
 DB_NAME = 'padron_electoral'
+# Max and min number of connections of the mongo client pool of each process
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+# Max number of results and seconds that each result is kept in the cache of searches by id card
+SEARCH_CACHE_SIZE = 10000
+SEARCH_CACHE_TTL = 300
+
+# Keys of the scripts that call batch_voting_info without a session, they send one of them in the X-Api-Key header.
+# They are read from the BATCH_API_KEYS environment variable separated by blanks, so they are not stored in the repository
+BATCH_API_KEYS = os.environ.get('BATCH_API_KEYS', '').split()
+# Maximum number of electors that the mongo similar names search scores
+FUZZY_SEARCH_CANDIDATES = 50000
+# Memory of each index build and number of indexes built at the same time when postgres recreates the deferred indexes
+POSTGRES_MAINTENANCE_WORK_MEM = '512MB'
+POSTGRES_INDEX_WORKERS = 4
+# File where postgres keeps the statements of the dropped indexes until they are created again, so a load that crashes does not lose them
+POSTGRES_DROPPED_INDEXES_FILE = os.path.join(BASE_DIR, 'electoral_roll.dropped_indexes')
 ##########################################################
 
 DATABASES = {
@@ -94,6 +114,8 @@ DATABASES = {
         'PASSWORD': 'admin',
         'HOST': 'localhost',
         'PORT': '5432',
+        # Seconds that each thread keeps its postgres connection open to reuse it in the next requests
+        'CONN_MAX_AGE': 60,
     }
 }
 
@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from electoral_roll.delta import ElectoralRollDelta
+from electoral_roll.cache import id_card_cache
+
+
+class BulkElectors:
+    """ Adds or removes many electors at once.
+        Instead of the signals of each elector, the stats changes are grouped by district in memory and applied
+        with one update for each affected district, canton, province and expiration date
+    """
+
+    def __init__(self, connection, batch_size=10000):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.rejected_rows = []
+
+    def get_existing_id_cards(self, id_cards):
+        """Returns the id cards given as a parameter that are stored in the database"""
+        existing_id_cards = set()
+
+        for i in range(0, len(id_cards), self.batch_size):
+            existing_id_cards.update(self.connection.get_electors_locations(id_cards[i:i + self.batch_size]))
+
+        return existing_id_cards
+
+    def is_valid_row(self, row, codes):
+        """Verifies that a row has all the fields, a 9 digits id card, an existing electoral code, a gender and a YYYYMMDD expiration date"""
+        if len(row) != 8 or len(row[0]) != 9 or not row[0].isdigit() or row[1] not in codes or row[2] not in ('1', '2'):
+            return False
+
+        try:
+            datetime.strptime(row[3], '%Y%m%d')
+        except ValueError:
+            return False
+
+        return True
+
+    def create(self, rows):
+        """ Inserts the electors of the rows given as a parameter, each row has the fields of the padron file.
+            The invalid rows, the rows of an id card that is already stored and the rows that the database did not store
+            are kept in rejected_rows. Returns the number of inserted electors
+        """
+        codes = {district[0] for district in self.connection.get_districts()}
+        rows = [tuple(field.strip() for field in row[:8]) for row in rows]
+        existing_id_cards = self.get_existing_id_cards([row[0] for row in rows])
+        delta = ElectoralRollDelta(self.connection, self.batch_size)
+        id_cards = set()
+
+        for row in rows:
+            if not self.is_valid_row(row, codes) or row[0] in existing_id_cards or row[0] in id_cards:
+                self.rejected_rows.append(row)
+
+            else:
+                id_cards.add(row[0])
+                delta.electors_to_insert.append(row)
+
+        delta.apply()
+
+        # The rows of a batch that the database did not store are rejected too
+        inserted_id_cards = set(delta.inserted_id_cards)
+        self.rejected_rows.extend(row for row in delta.electors_to_insert if row[0] not in inserted_id_cards)
+
+        return len(delta.inserted_id_cards)
+
+    def delete(self, id_cards):
+        """Deletes the electors of the id cards given as a parameter. Returns the number of deleted electors"""
+        id_cards = list(dict.fromkeys(id_card.strip() for id_card in id_cards))
+        delta = ElectoralRollDelta(self.connection, self.batch_size)
+        delta.id_cards_to_delete = list(self.get_existing_id_cards(id_cards))
+
+        delta.apply()
+
+        for id_card in delta.deleted_id_cards:
+            id_card_cache.invalidate(id_card)
+
+        return len(delta.deleted_id_cards)
@@ -0,0 +1,65 @@
+import time
+import threading
+from collections import OrderedDict
+
+from challenge_2.settings import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+
+
+class SearchCache:
+    """ In-process LRU cache with a time to live for the searching results.
+        When the cache is full the least recently used result is discarded
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached result of the key or None if it is not cached or it expired"""
+        with self.lock:
+            cached = self.results.get(key)
+
+            if cached is not None and cached[0] > time.monotonic():
+                self.results.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+
+            if cached is not None:
+                del self.results[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, result):
+        with self.lock:
+            self.results[key] = (time.monotonic() + self.ttl, result)
+            self.results.move_to_end(key)
+
+            if len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.results.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def get_stats(self):
+        """Returns the hit and miss counters of the cache"""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'size': len(self.results),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / requests if requests else 0}
+
+
+# Cache of search_by_id_card results, the key is the id card
+id_card_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
@@ -0,0 +1,79 @@
+import os
+import json
+import zlib
+import threading
+
+
+class ImportCheckpoint:
+    """ Keeps a record of the chunks that load_electoral_roll has already committed to the database.
+        Each committed chunk is appended as a json line and synced to disk, so it survives a crash of the process
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.committed_chunks = {}
+
+    def reset(self):
+        """Removes the records of a previous import"""
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+        self.committed_chunks = {}
+
+    def load(self):
+        """Reads the chunks that were committed by a previous import"""
+        self.committed_chunks = {}
+
+        if os.path.exists(self.file_name):
+            with open(self.file_name, mode='r') as file:
+                for line in file:
+                    # A crash while writing can leave the last line incomplete
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    self.committed_chunks[(record['option_file'], record['chunk'])] = record
+
+    @staticmethod
+    def get_checksum(data):
+        """Returns a checksum of the rows of a chunk"""
+        return zlib.crc32(repr(data).encode('utf-8'))
+
+    def is_committed(self, option_file, chunk_index):
+        return (option_file, chunk_index) in self.committed_chunks
+
+    def verify(self, option_file, chunk_index, data):
+        """Verifies that a chunk read again from the file is the same that was committed before"""
+        record = self.committed_chunks[(option_file, chunk_index)]
+        return record['rows'] == len(data) and record['checksum'] == self.get_checksum(data)
+
+    def get_resume_point(self, option_file):
+        """ Returns the number of chunks at the beginning of the file that were all committed and
+            the byte offset where the next chunk starts
+        """
+        chunk_index = 0
+        offset = 0
+
+        while self.is_committed(option_file, chunk_index):
+            offset = self.committed_chunks[(option_file, chunk_index)]['offset']
+            chunk_index += 1
+
+        return chunk_index, offset
+
+    def commit(self, option_file, chunk_index, offset, rows, checksum):
+        """Records a chunk that was inserted in the database"""
+        record = {'option_file': option_file,
+                  'chunk': chunk_index,
+                  'offset': offset,
+                  'rows': rows,
+                  'checksum': checksum}
+
+        with self.lock:
+            with open(self.file_name, mode='a') as file:
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.committed_chunks[(option_file, chunk_index)] = record
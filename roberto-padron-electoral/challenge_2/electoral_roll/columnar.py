@@ -0,0 +1,67 @@
+""" Columnar copy of the TSE files.
+    The padron and distelec files are parsed once into parquet files with typed columns, so the loads and the stats
+    of other environments read record batches instead of parsing the text again. pyarrow is optional and imported when it is needed
+"""
+
+# Columns of each file in the same order as the text files
+FILES_COLUMNS = {
+    'distelec': ['codigo_electoral', 'provincia', 'canton', 'distrito'],
+    'padron': ['cedula', 'codigo_electoral', 'relleno', 'fecha_caducidad', 'junta', 'nombre', 'primer_apellido', 'segundo_apellido']
+}
+
+
+def import_pyarrow():
+    """Returns the pyarrow modules used by this module. Raises ImportError when pyarrow is not installed"""
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.compute
+    import pyarrow.parquet
+
+    return pyarrow
+
+
+def is_columnar_file(file_name):
+    return file_name.endswith('.parquet')
+
+
+def convert_file(file_name, encoding, option_file, output_file_name, row_group_size=600000):
+    """ Parses a TSE text file and writes it as parquet.
+        The blanks of the fields are removed, the cedula is an integer and the expiration date a date32
+    """
+    pa = import_pyarrow()
+    columns = FILES_COLUMNS[option_file]
+
+    read_options = pa.csv.ReadOptions(column_names=columns, encoding=encoding)
+    # All the columns are read as text, the blanks are removed before to convert them
+    convert_options = pa.csv.ConvertOptions(column_types={column: pa.string() for column in columns})
+    table = pa.csv.read_csv(file_name, read_options=read_options, convert_options=convert_options)
+
+    arrays = [pa.compute.utf8_trim_whitespace(table[column]) for column in columns]
+
+    if option_file == 'padron':
+        arrays[0] = arrays[0].cast(pa.int64())
+        arrays[3] = pa.compute.strptime(arrays[3], format='%Y%m%d', unit='s').cast(pa.date32())
+
+    pa.parquet.write_table(pa.table(arrays, names=columns), output_file_name, row_group_size=row_group_size)
+
+
+def iterate_batches(file_name, batch_size):
+    """Yields the parquet file as record batches of batch_size rows"""
+    pa = import_pyarrow()
+    yield from pa.parquet.ParquetFile(file_name).iter_batches(batch_size=batch_size)
+
+
+def read_columns(file_name, columns):
+    """Returns a table with the columns of the parquet file given as a parameter"""
+    pa = import_pyarrow()
+    return pa.parquet.read_table(file_name, columns=columns)
+
+
+def count_rows(table_or_batch, columns):
+    """Returns a dictionary of the values of the columns => number of rows, counted in arrow"""
+    pa = import_pyarrow()
+    counts = pa.table(table_or_batch).group_by(columns).aggregate([([], 'count_all')])
+    values = [counts[column].to_pylist() for column in columns]
+    keys = list(zip(*values)) if len(columns) > 1 else values[0]
+
+    return dict(zip(keys, counts['count_all'].to_pylist()))
@@ -1,5 +1,25 @@
 from abc import ABC, abstractmethod
 
+
+class ReadOnlyEngineError(Exception):
+    """ Raised when the electors are changed with an engine that can only read them"""
+    pass
+
+
+class DistrictInformation:
+    """ A district with its count of male and female voters.
+        It has the same attributes as the district objects that get_districts_information returns
+    """
+
+    def __init__(self, electoral_code, province, canton, district, male_count, female_count):
+        self.codigo_electoral = electoral_code
+        self.provincia = province
+        self.canton = canton
+        self.distrito = district
+        self.total_hombres = male_count
+        self.total_mujeres = female_count
+
+
 class Connection(ABC):
     """ Is the common class to all connections.
         Each concrete connection must implement the abstract methods that are specific for it.
@@ -13,6 +33,7 @@ class Connection(ABC):
         self.province_stats_table_or_collection = 'electoral_roll_votantesporprovincia'
         self.canton_stats_table_or_collection = 'electoral_roll_votantesporcanton'
         self.district_stats_table_or_collection = 'electoral_roll_votantespordistrito'
+        self.expiration_date_stats_table_or_collection = 'electoral_roll_votantesporfechacaducidad'
 
 
     @abstractmethod
@@ -22,6 +43,20 @@ class Connection(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_row_location(self, data_row):
+        """
+        Returns the electoral code and the gender of a row returned by handle_row_to_insert for the padron file
+        """
+        pass
+
+    @abstractmethod
+    def get_row_expiration_date(self, data_row):
+        """
+        Returns the id card expiration date of a row returned by handle_row_to_insert for the padron file
+        """
+        pass
+
     @abstractmethod
     def bulk_insert(self, table_or_collection):
         """
@@ -30,31 +65,160 @@ class Connection(ABC):
         pass
 
     @abstractmethod
-    def clean_database(self, option):
+    def bulk_insert_batch(self, batch, option_file):
+        """
+        Inserts a record batch of a columnar file created by convert_electoral_roll. Returns True when the batch was inserted
+        """
+        pass
+
+    @abstractmethod
+    def clean_chunk(self, data, option_file):
         """
-        Cleans the database according with the option given as a parameter before to start the insertion process
+        Deletes the rows of a chunk that could be partially inserted, before to insert it again
         """
         pass
 
+    @abstractmethod
+    def clean_database(self, option, truncate=False):
+        """
+        Cleans the database according with the option given as a parameter before to start the insertion process.
+        With truncate the tables or collections are emptied at once, without the signals of each element
+        """
+        pass
+
+    @abstractmethod
+    def drop_indexes(self):
+        """Drops the indexes of the electors and districts before a bulk load"""
+        pass
+
+    @abstractmethod
+    def create_indexes(self):
+        """Creates the indexes used by the searches and the stats after a bulk load"""
+        pass
+
+    @abstractmethod
+    def get_index_usage(self):
+        """Returns a list of (table or collection, index name, number of times that the index was used)"""
+        pass
+
     @abstractmethod
     def search_by_name(self,name,surname,second_surname):
         """Allows to search in the database an element that matches with the name,surname and second surname given as a parameters"""
         pass
 
+    @abstractmethod
+    def search_by_name_fuzzy(self, name, surname, second_surname, page=1, page_size=20):
+        """Allows to search electors whose names start with or are similar to the names given as parameters. Returns a page of results ranked by similarity"""
+        pass
+
+    @abstractmethod
+    def build_name_index(self):
+        """Builds the index used by search_by_name_fuzzy"""
+        pass
+
     @abstractmethod
     def search_by_id_card(self,id_card):
         """Allows to search in the database an element that matches with the id card given as a parameter"""
         pass
 
+    @abstractmethod
+    def search_by_id_cards(self, id_cards):
+        """Allows to search with one query the electors of the id cards given as a parameter. Returns a dictionary of id card => searching result"""
+        pass
+
     @abstractmethod
     def get_districts_information(self):
         """Returns a list of districts and its information according with the database engine indicated in settings.py"""
         pass
 
+    @abstractmethod
+    def get_districts(self):
+        """Returns a list of (electoral code, province, canton, district) in the same order as get_districts_information"""
+        pass
+
+    @abstractmethod
+    def iterate_electors_locations(self):
+        """Yields the electoral code and the gender of each elector"""
+        pass
+
     @abstractmethod
     def get_statistics_from_database(self,expiration_date, province, canton, district):
         """Gets all stats of provinces, cantons, districts and id card expiration dates from the database"""
         pass
 
+    @abstractmethod
+    def iterate_electors(self, sort=False):
+        """ Yields each elector as a tuple of strings in the same order and format of the padron file.
+            With sort the electors are sorted by cedula, the other callers do not pay for the sort
+        """
+        pass
+
+    @abstractmethod
+    def get_electors_locations(self, id_cards):
+        """Returns a dictionary with the electoral code, the gender and the expiration date of each id card given as a parameter"""
+        pass
+
+    @abstractmethod
+    def delete_electors(self, id_cards):
+        """Deletes the electors of the id cards given as a parameter without updating the statistics"""
+        pass
+
+    @abstractmethod
+    def replace_electors(self, data):
+        """ Replaces the stored electors with the rows returned by handle_row_to_insert given as a parameter, without updating the statistics.
+            An elector is never missing between the delete and the insert. Returns the id cards of the electors that were written
+        """
+        pass
+
+    def group_statistics_deltas(self, districts, deltas):
+        """ Groups the changes of each district by province, canton and district.
+            Returns three dictionaries with the [male voters change, female voters change] of each level
+        """
+        province_deltas, canton_deltas, district_deltas = {}, {}, {}
+
+        for district in districts:
+            male_delta, female_delta = deltas[district['codigo_electoral']]
+            keys = [(province_deltas, (district['provincia'],)),
+                    (canton_deltas, (district['provincia'], district['canton'])),
+                    (district_deltas, (district['provincia'], district['canton'], district['distrito']))]
+
+            for level_deltas, key in keys:
+                level_delta = level_deltas.setdefault(key, [0, 0])
+                level_delta[0] += male_delta
+                level_delta[1] += female_delta
+
+        return province_deltas, canton_deltas, district_deltas
+
+    @abstractmethod
+    def prepare_shadow_load(self):
+        """ Creates empty shadow tables or collections and makes the connection write and read them instead of the live ones,
+            so a load does not leave the live data empty or partial
+        """
+        pass
+
+    @abstractmethod
+    def swap_shadow_load(self):
+        """Replaces the live tables or collections with the shadow ones and makes the connection use the live names again"""
+        pass
+
+    @abstractmethod
+    def insert_expiration_dates_statistics(self, expiration_dates=None):
+        """ Inserts the number of electors of each id card expiration date.
+            expiration_dates is a dictionary of expiration date => number of electors, without it they are counted in the database
+        """
+        pass
+
+    @abstractmethod
+    def apply_expiration_dates_deltas(self, deltas):
+        """Adds to the number of electors of each id card expiration date the changes of the dictionary given as a parameter"""
+        pass
+
+    @abstractmethod
+    def apply_statistics_deltas(self, deltas):
+        """ Adds to the stats of each district, canton and province the changes given as a parameter.
+            deltas is a dictionary of electoral code => [male voters change, female voters change]
+        """
+        pass
+
 
          
@@ -1,25 +1,53 @@
+import os
+import threading
+
 from .mongo_connection import MongoConnection
 from .postgresql_connection import PostgreConnection
+from .mmap_connection import MmapConnection
 
 class DBConnectionProducer:
-    """ Returns a new db connection according to the setting.py information
-        Uses the factory method to create instances of connection"""
+    """ Returns a db connection according to the setting.py information
+        Uses the factory method to create instances of connection.
+        Each process keeps one connection per engine, so the connection pool of the client is reused by every request.
+        A forked process (for example a gunicorn worker) creates its own connections instead of using the ones of its parent
+    """
+
+    connections = {}
+    process_id = os.getpid()
+    lock = threading.Lock()
 
     @staticmethod
     def get_connection(engine):
-        """ Returns an instance of a concrete db connection that was specified in the settings.py"""
-        if (engine.lower() == 'mongo'):
-            return MongoConnection(engine)
-
-        elif (engine.lower() == 'postgre'):
-            return PostgreConnection(engine)
+        """ Returns the instance of the concrete db connection that was specified in the settings.py"""
+        engine = engine.lower()
 
+        with DBConnectionProducer.lock:
+            if DBConnectionProducer.process_id != os.getpid():
+                DBConnectionProducer.reset_connections()
 
+            if engine not in DBConnectionProducer.connections:
+                DBConnectionProducer.connections[engine] = DBConnectionProducer.create_connection(engine)
 
+            return DBConnectionProducer.connections[engine]
 
+    @staticmethod
+    def create_connection(engine):
+        """ Returns a new instance of a concrete db connection"""
+        if (engine == 'mongo'):
+            return MongoConnection(engine)
 
+        elif (engine == 'postgre'):
+            return PostgreConnection(engine)
 
+        elif (engine == 'mmap'):
+            return MmapConnection(engine)
 
+    @staticmethod
+    def reset_connections():
+        """ Forgets the connections created by the parent process. The clients are not closed because the parent still uses them"""
+        DBConnectionProducer.connections = {}
+        DBConnectionProducer.process_id = os.getpid()
 
-        
 
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=DBConnectionProducer.reset_connections)
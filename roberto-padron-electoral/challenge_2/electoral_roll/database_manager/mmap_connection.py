@@ -0,0 +1,269 @@
+import os
+import mmap
+import threading
+from datetime import datetime
+
+from django.utils import timezone
+
+from challenge_2.settings import MMAP_INDEX_FILE
+from .connection import Connection, DistrictInformation, ReadOnlyEngineError
+from .mmap_index import (MAGIC, VERSION, HEADER, DISTRICT_RECORD, CANTON_RECORD, PROVINCE_RECORD, EXPIRATION_DATE_RECORD,
+                         ELECTOR_RECORD, NAMES_OFFSET, NAMES_WIDTHS, encode, decode)
+
+
+def get_file_id(stat):
+    """The inode, the size and the modification time change when export_electoral_roll_index replaces the file"""
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class MappedIndex:
+    """ The mapped index file with its districts, stats and expiration dates.
+        These sections are small, the electors are left in the mapped file.
+        A new file is mapped in a new object, so a search that started with the old file finishes with it
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, mode='rb') as file:
+            self.file_id = get_file_id(os.fstat(file.fileno()))
+            index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, electors_count, districts_count, cantons_count, provinces_count, dates_count = HEADER.unpack_from(index)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{file_name} is not an index of export_electoral_roll_index version {VERSION}")
+
+        offset = HEADER.size + electors_count * ELECTOR_RECORD.size
+        self.districts = []
+        self.canton_statistics = {}
+        self.province_statistics = {}
+        self.expiration_dates = {}
+
+        for _ in range(districts_count):
+            code, province, canton, district, male_count, female_count = DISTRICT_RECORD.unpack_from(index, offset)
+            self.districts.append((f"{code:06d}", decode(province), decode(canton), decode(district), male_count, female_count))
+            offset += DISTRICT_RECORD.size
+
+        for _ in range(cantons_count):
+            province, canton, male_count, female_count = CANTON_RECORD.unpack_from(index, offset)
+            self.canton_statistics[(decode(province), decode(canton))] = (male_count, female_count)
+            offset += CANTON_RECORD.size
+
+        for _ in range(provinces_count):
+            province, male_count, female_count = PROVINCE_RECORD.unpack_from(index, offset)
+            self.province_statistics[decode(province)] = (male_count, female_count)
+            offset += PROVINCE_RECORD.size
+
+        for _ in range(dates_count):
+            expiration_date, electors = EXPIRATION_DATE_RECORD.unpack_from(index, offset)
+            self.expiration_dates[expiration_date] = electors
+            offset += EXPIRATION_DATE_RECORD.size
+
+        self.district_statistics = {district[1:4]: district[4:] for district in self.districts}
+        self.electors_offset = HEADER.size
+        self.electors_count = electors_count
+        self.index = index
+
+    def get_elector(self, position):
+        """Returns the record of the elector in the position given as a parameter"""
+        return ELECTOR_RECORD.unpack_from(self.index, self.electors_offset + position * ELECTOR_RECORD.size)
+
+    def find_position(self, id_card):
+        """Binary search of the id card in the electors sorted by cedula. Returns the position or None"""
+        low, high = 0, self.electors_count - 1
+
+        while low <= high:
+            middle = (low + high) // 2
+            middle_id_card = ELECTOR_RECORD.unpack_from(self.index, self.electors_offset + middle * ELECTOR_RECORD.size)[0]
+
+            if middle_id_card == id_card:
+                return middle
+
+            elif middle_id_card < id_card:
+                low = middle + 1
+
+            else:
+                high = middle - 1
+
+        return None
+
+
+class MmapConnection(Connection):
+    """
+        It is a read-only connection to the index file written by export_electoral_roll_index.
+        The electors are searched in the mapped file, so only the pages that a search reads are loaded in memory
+    """
+
+    def __init__(self, engine, file_name=MMAP_INDEX_FILE):
+        super().__init__(engine)
+        self.file_name = file_name
+        self.mapped_index = None
+        self.lock = threading.Lock()
+
+    def open_index(self):
+        """ Returns the mapped index file. It is mapped the first time that it is needed and again when
+            export_electoral_roll_index replaced the file, so the servers read the new electors without a restart
+        """
+        mapped_index = self.mapped_index
+
+        if mapped_index is None or mapped_index.file_id != get_file_id(os.stat(self.file_name)):
+            with self.lock:
+                if self.mapped_index is None or self.mapped_index.file_id != get_file_id(os.stat(self.file_name)):
+                    self.mapped_index = MappedIndex(self.file_name)
+
+                mapped_index = self.mapped_index
+
+        return mapped_index
+
+    def read_only(self, *args, **kwargs):
+        raise ReadOnlyEngineError('The mmap engine is read only, change the data in mongo or postgres and export the index again')
+
+    handle_row_to_insert = read_only
+    get_row_location = read_only
+    get_row_expiration_date = read_only
+    bulk_insert = read_only
+    bulk_insert_batch = read_only
+    clean_chunk = read_only
+    clean_database = read_only
+    build_name_index = read_only
+    delete_electors = read_only
+    replace_electors = read_only
+    prepare_shadow_load = read_only
+    swap_shadow_load = read_only
+    insert_expiration_dates_statistics = read_only
+    apply_expiration_dates_deltas = read_only
+    apply_statistics_deltas = read_only
+
+    def drop_indexes(self):
+        """The index file has no secondary indexes"""
+        pass
+
+    def create_indexes(self):
+        """The index file has no secondary indexes"""
+        pass
+
+    def get_index_usage(self):
+        return []
+
+    def build_elector_result(self, mapped_index, record):
+        """ Returns the information of an elector record and its electoral district"""
+        id_card, district_position, gender, expiration_date, junta, name, surname, second_surname = record
+        code, province, canton, district = mapped_index.districts[district_position][:4]
+
+        return {'nombre': decode(name, 'latin-1'),
+                'primer_apellido': decode(surname, 'latin-1'),
+                'segundo_apellido': decode(second_surname, 'latin-1'),
+                'cedula': f"{id_card:09d}",
+                'fecha_caducidad': timezone.make_aware(datetime(expiration_date // 10000, expiration_date // 100 % 100, expiration_date % 100, 18)),
+                'codigo_electoral__provincia': province,
+                'codigo_electoral__canton': canton,
+                'codigo_electoral__distrito': district,
+                'codigo_electoral': code,
+                }
+
+    def search_by_id_card(self, id_card):
+        """Allows to search in the index file an element that matches with the id card given as a parameter"""
+        mapped_index = self.open_index()
+
+        try:
+            position = mapped_index.find_position(int(id_card))
+        except ValueError:
+            position = None
+
+        return self.build_elector_result(mapped_index, mapped_index.get_elector(position)) if position is not None else []
+
+    def search_by_id_cards(self, id_cards):
+        """Allows to search the electors of the id cards given as a parameter. Returns a dictionary of id card => searching result"""
+        results = {}
+
+        for id_card in id_cards:
+            result = self.search_by_id_card(id_card)
+
+            if result:
+                results[id_card] = result
+
+        return results
+
+    def search_by_name(self, name, surname, second_surname):
+        """ Allows to search an elector with the name, surname and second surname given as a parameters.
+            The three names are contiguous in each record, so the file is scanned with a single find of the padded names
+        """
+        mapped_index = self.open_index()
+        pattern = b''.join(encode(text, width, 'latin-1') for text, width in zip([name, surname, second_surname], NAMES_WIDTHS))
+        start = mapped_index.electors_offset
+
+        while True:
+            found = mapped_index.index.find(pattern, start)
+
+            if found == -1:
+                return []
+
+            # The pattern could start in the middle of a record
+            record_offset = found - NAMES_OFFSET - mapped_index.electors_offset
+
+            if record_offset % ELECTOR_RECORD.size == 0:
+                return self.build_elector_result(mapped_index, mapped_index.get_elector(record_offset // ELECTOR_RECORD.size))
+
+            start = found + 1
+
+    def search_by_name_fuzzy(self, name, surname, second_surname, page=1, page_size=20):
+        """The index file has no trigrams, only the electors with exactly the same names are returned"""
+        result = self.search_by_name(name, surname, second_surname)
+
+        if result and page == 1:
+            result['similarity'] = 1.0
+            return [result]
+
+        return []
+
+    def get_districts_information(self):
+        """ Returns a list of DistrictInformation objects with the voters counted when the index was exported"""
+        return [DistrictInformation(electoral_code=code, province=province, canton=canton, district=district, male_count=male_count,
+                                    female_count=female_count) for code, province, canton, district, male_count, female_count in self.open_index().districts]
+
+    def get_districts(self):
+        """Returns a list of (electoral code, province, canton, district) in the same order as get_districts_information"""
+        return [district[:4] for district in self.open_index().districts]
+
+    def iterate_electors(self, sort=False):
+        """Yields each elector as a tuple of strings in the same order and format of the padron file, the file is always sorted by cedula"""
+        mapped_index = self.open_index()
+
+        for position in range(mapped_index.electors_count):
+            id_card, district_position, gender, expiration_date, junta, name, surname, second_surname = mapped_index.get_elector(position)
+            yield (f"{id_card:09d}", mapped_index.districts[district_position][0], str(gender), str(expiration_date), decode(junta, 'latin-1'),
+                   decode(name, 'latin-1'), decode(surname, 'latin-1'), decode(second_surname, 'latin-1'))
+
+    def iterate_electors_locations(self):
+        """Yields the electoral code and the gender of each elector"""
+        for elector in self.iterate_electors():
+            yield elector[1], elector[2]
+
+    def get_electors_locations(self, id_cards):
+        """Returns a dictionary with the electoral code, the gender and the expiration date of each id card given as a parameter"""
+        mapped_index = self.open_index()
+        locations = {}
+
+        for id_card in id_cards:
+            position = mapped_index.find_position(int(id_card))
+
+            if position is not None:
+                record = mapped_index.get_elector(position)
+                locations[id_card] = (mapped_index.districts[record[1]][0], str(record[2]), str(record[3]))
+
+        return locations
+
+    def get_statistics(self, counts):
+        male_count, female_count = counts
+        return {'total_votantes': male_count + female_count,
+                'total_votantes_hombres': male_count,
+                'total_votantes_mujeres': female_count}
+
+    def get_statistics_from_database(self, expiration_date, province, canton, district):
+        """Gets all stats of provinces, cantons, districts and id card expiration dates from the stats block of the index file"""
+        mapped_index = self.open_index()
+        expiration_date = expiration_date.year * 10000 + expiration_date.month * 100 + expiration_date.day
+
+        return {'province_statistics': self.get_statistics(mapped_index.province_statistics.get(province, (0, 0))),
+                'canton_statistics': self.get_statistics(mapped_index.canton_statistics.get((province, canton), (0, 0))),
+                'district_statistics': self.get_statistics(mapped_index.district_statistics.get((province, canton, district), (0, 0))),
+                'id_statistics': {'same_id_count': mapped_index.expiration_dates.get(expiration_date, 0)}}
@@ -0,0 +1,116 @@
+""" Layout of the read-only index file used by the mmap engine.
+    The file has a header with the number of records of each section, followed by the electors sorted by cedula, the districts,
+    the cantons and provinces stats and the number of electors of each expiration date. All the records have a fixed width,
+    so the elector of a position is at header + position * record size and the cedulas can be searched with a binary search.
+    The electors are written first, so they are streamed to the file and the stats counted on the way are written after them
+"""
+import os
+import struct
+
+MAGIC = b'PADRONIX'
+VERSION = 2
+
+# magic, version, electors, districts, cantons, provinces, expiration dates
+HEADER = struct.Struct('<8sIIIIII')
+# electoral code, province, canton, district (utf-8), male voters, female voters
+DISTRICT_RECORD = struct.Struct('<I20s52s72sII')
+# province, canton (utf-8), male voters, female voters
+CANTON_RECORD = struct.Struct('<20s52sII')
+# province (utf-8), male voters, female voters
+PROVINCE_RECORD = struct.Struct('<20sII')
+# expiration date as YYYYMMDD, electors
+EXPIRATION_DATE_RECORD = struct.Struct('<II')
+# cedula, position of the district, gender, expiration date as YYYYMMDD, junta, name, first surname, second surname.
+# The names are latin-1 and padded with blanks as in the padron file, so the three names are contiguous and can be searched as one pattern
+ELECTOR_RECORD = struct.Struct('<IHBI5s30s26s26s')
+NAMES_OFFSET = ELECTOR_RECORD.size - 82
+NAMES_WIDTHS = (30, 26, 26)
+
+
+def encode(text, width, encoding='utf-8'):
+    """Returns the text padded with blanks to the width of its field"""
+    return text.encode(encoding, errors='replace')[:width].ljust(width)
+
+
+def decode(field, encoding='utf-8'):
+    # A utf-8 field cut in the middle of a character loses that character
+    return field.decode(encoding, errors='ignore').strip()
+
+
+def write_index(file_name, districts, electors):
+    """ Writes the index file.
+        districts is a list of (electoral code, province, canton, district) and electors yields rows with the fields of the padron file
+        sorted by cedula. The rows are written as they are read and the stats of each level and the expiration dates are counted
+        on the way. The rows with an electoral code that is not in districts are skipped.
+        Returns the number of written electors and the number of skipped rows
+    """
+    district_positions = {district[0]: position for position, district in enumerate(districts)}
+    district_counts = [[0, 0] for _ in districts]
+    expiration_dates = {}
+    electors_count, skipped_count = 0, 0
+    last_id_card = -1
+    temporary_file_name = file_name + '.tmp'
+
+    try:
+        with open(temporary_file_name, mode='wb') as file:
+            # The counts of the header are written again when the electors were read
+            file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0, 0))
+
+            for row in electors:
+                position = district_positions.get(row[1])
+
+                if position is None:
+                    skipped_count += 1
+                    continue
+
+                id_card = int(row[0])
+
+                # The binary search of the cedulas needs them sorted and without repetitions
+                if id_card <= last_id_card:
+                    raise ValueError(f"The cedula {row[0]} is not sorted after {last_id_card:09d}")
+
+                gender = int(row[2])
+                expiration_date = int(row[3])
+
+                if gender in (1, 2):
+                    district_counts[position][gender - 1] += 1
+
+                expiration_dates[expiration_date] = expiration_dates.get(expiration_date, 0) + 1
+                file.write(ELECTOR_RECORD.pack(id_card, position, gender, expiration_date, encode(row[4], 5, 'latin-1'),
+                                               encode(row[5].strip(), 30, 'latin-1'), encode(row[6].strip(), 26, 'latin-1'),
+                                               encode(row[7].strip(), 26, 'latin-1')))
+                electors_count += 1
+                last_id_card = id_card
+
+            canton_counts, province_counts = {}, {}
+
+            for (code, province, canton, district), (male_count, female_count) in zip(districts, district_counts):
+                for level_counts, key in [(canton_counts, (province, canton)), (province_counts, province)]:
+                    counts = level_counts.setdefault(key, [0, 0])
+                    counts[0] += male_count
+                    counts[1] += female_count
+
+            for (code, province, canton, district), (male_count, female_count) in zip(districts, district_counts):
+                file.write(DISTRICT_RECORD.pack(int(code), encode(province, 20), encode(canton, 52), encode(district, 72), male_count, female_count))
+
+            for (province, canton), (male_count, female_count) in canton_counts.items():
+                file.write(CANTON_RECORD.pack(encode(province, 20), encode(canton, 52), male_count, female_count))
+
+            for province, (male_count, female_count) in province_counts.items():
+                file.write(PROVINCE_RECORD.pack(encode(province, 20), male_count, female_count))
+
+            for expiration_date in sorted(expiration_dates):
+                file.write(EXPIRATION_DATE_RECORD.pack(expiration_date, expiration_dates[expiration_date]))
+
+            file.seek(0)
+            file.write(HEADER.pack(MAGIC, VERSION, electors_count, len(districts), len(canton_counts), len(province_counts), len(expiration_dates)))
+
+    except Exception:
+        # An export that fails leaves the index file that is in use as it was
+        os.remove(temporary_file_name)
+        raise
+
+    # MmapConnection sees the new inode in its next search and maps the new file, the searches that already started finish with the old one
+    os.replace(temporary_file_name, file_name)
+
+    return electors_count, skipped_count
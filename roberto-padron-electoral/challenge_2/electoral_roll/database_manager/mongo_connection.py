@@ -1,18 +1,17 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
 from datetime import datetime
 from challenge_2.settings import MONGO_URI
 from challenge_2.settings import DB_NAME
-from .connection import Connection
+from challenge_2.settings import MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE
+from challenge_2.settings import FUZZY_SEARCH_CANDIDATES
+from .connection import Connection, DistrictInformation
+from .ngrams import get_name_ngrams
+from electoral_roll.cache import id_card_cache
 
 
-class MongoDistrictInformation:
-    def __init__(self, electoral_code, province, canton, district, male_count, female_count):
-        self.codigo_electoral = electoral_code
-        self.provincia = province
-        self.canton = canton
-        self.distrito = district
-        self.total_hombres = male_count
-        self.total_mujeres = female_count
+class MongoDistrictInformation(DistrictInformation):
+    pass
 
 
 class MongoConnection(Connection):
@@ -22,26 +21,154 @@ class MongoConnection(Connection):
 
     def __init__(self, engine):
         super().__init__(engine)
-        self.mongo_client = MongoClient(MONGO_URI)
+        self.mongo_client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE)
         self.db = self.mongo_client[DB_NAME]
-
-    def clean_database(self, option):
+        # Dictionary of electoral code => district document. There are only around 2000 districts, so they are kept in memory
+        self.districts = None
+        # Dictionary of electoral code => (province, canton, district) ids of the stats documents, used by update_statistics
+        self.statistics_ids = None
+        # Suffix of the collections where a shadow load writes
+        self.shadow_suffix = '_next'
+        self.collections_attributes = ['distelect_table_or_collection', 'elector_table_or_collection', 'province_stats_table_or_collection',
+                                       'canton_stats_table_or_collection', 'district_stats_table_or_collection',
+                                       'expiration_date_stats_table_or_collection']
+
+    def clean_database(self, option, truncate=False):
         """
-        Cleans the database before to start the insertion process
+        Cleans the database before to start the insertion process.
+        With truncate the collections are dropped instead of deleting each document, their indexes are created again by create_indexes
         """
+        if truncate:
+            self.drop_collections(option)
 
-        if (option == 'electoral_roll'):
+        elif (option == 'electoral_roll'):
+            self.districts = None
             self.db[self.distelect_table_or_collection].delete_many({})
             self.db[self.elector_table_or_collection].delete_many({})
 
         elif (option == 'stats'):
+            self.statistics_ids = None
             self.db[self.district_stats_table_or_collection].delete_many({})
             self.db[self.canton_stats_table_or_collection].delete_many({})
             self.db[self.province_stats_table_or_collection].delete_many({})
+            self.db[self.expiration_date_stats_table_or_collection].delete_many({})
+
+    def drop_collections(self, option):
+        """Drops the collections of the option given as a parameter. Mongo has no signals, so it only avoids to delete the documents one by one"""
+        collections = [self.district_stats_table_or_collection, self.canton_stats_table_or_collection,
+                       self.province_stats_table_or_collection, self.expiration_date_stats_table_or_collection]
+        self.statistics_ids = None
+
+        if (option == 'electoral_roll'):
+            self.districts = None
+            collections = [self.elector_table_or_collection, self.distelect_table_or_collection] + collections
+
+        for collection in collections:
+            self.db[collection].drop()
+
+        # The load builds the indexes of the electors after the insert, the stats collections are small so their indexes are built now
+        if (option == 'stats'):
+            indexes = self.get_indexes()
+
+            for collection in collections:
+                for keys, options in indexes.get(collection, []):
+                    self.db[collection].create_index(keys, **options)
+
+    def prepare_shadow_load(self):
+        """Points each collection name of the connection to an empty <name>_next collection"""
+        for attribute in self.collections_attributes:
+            shadow_collection = getattr(self, attribute) + self.shadow_suffix
+            self.db[shadow_collection].drop()
+            setattr(self, attribute, shadow_collection)
+
+        self.districts = None
+        self.statistics_ids = None
+
+    def swap_shadow_load(self):
+        """ Renames each shadow collection to its live name with dropTarget, so the live collection is replaced in a single operation.
+            Each rename is atomic, but the collections are renamed one after the other
+        """
+        existing_collections = set(self.db.list_collection_names())
+
+        for attribute in self.collections_attributes:
+            shadow_collection = getattr(self, attribute)
+            live_collection = shadow_collection[:-len(self.shadow_suffix)]
+
+            if shadow_collection in existing_collections:
+                self.db[shadow_collection].rename(live_collection, dropTarget=True)
+
+            setattr(self, attribute, live_collection)
+
+        self.districts = None
+        self.statistics_ids = None
+
+    def clean_chunk(self, data, option_file):
+        """
+        Deletes the documents of a chunk that could be partially inserted, before to insert it again
+        """
+        if (option_file == 'distelec'):
+            self.districts = None
+            codes = [element['codigo_electoral'] for element in data]
+            self.db[self.distelect_table_or_collection].delete_many({'codigo_electoral': {'$in': codes}})
+
+        elif (option_file == 'padron'):
+            id_cards = [element['cedula'] for element in data]
+            self.db[self.elector_table_or_collection].delete_many({'cedula': {'$in': id_cards}})
+
+    def get_indexes(self):
+        """Returns the indexes of each collection as a dictionary of collection => list of (keys, options)"""
+        return {
+            self.elector_table_or_collection: [
+                ([('cedula', ASCENDING)], {'unique': True}),
+                ([('nombre', ASCENDING), ('primer_apellido', ASCENDING), ('segundo_apellido', ASCENDING)], {}),
+                ([('codigo_electoral', ASCENDING), ('relleno', ASCENDING)], {}),
+                ([('fecha_caducidad', ASCENDING)], {}),
+                # Trigrams of search_by_name_fuzzy, drop_indexes drops it with the other indexes of the electors
+                ([('ngrams', ASCENDING)], {})
+            ],
+            self.distelect_table_or_collection: [
+                ([('codigo_electoral', ASCENDING)], {'unique': True})
+            ],
+            self.province_stats_table_or_collection: [
+                ([('provincia', ASCENDING)], {})
+            ],
+            self.canton_stats_table_or_collection: [
+                ([('provincia', ASCENDING), ('canton', ASCENDING)], {})
+            ],
+            self.district_stats_table_or_collection: [
+                ([('provincia', ASCENDING), ('canton', ASCENDING), ('distrito', ASCENDING)], {})
+            ]
+        }
+
+    def drop_indexes(self):
+        """Drops the indexes of the electors and districts, so the bulk load does not maintain them for each document"""
+        self.db[self.elector_table_or_collection].drop_indexes()
+        self.db[self.distelect_table_or_collection].drop_indexes()
+
+    def create_indexes(self):
+        """Creates the indexes used by the searches and the stats. The indexes that already exist are not built again"""
+        for collection, indexes in self.get_indexes().items():
+            for keys, options in indexes:
+                try:
+                    self.db[collection].create_index(keys, **options)
+
+                except Exception as error:
+                    print(f"--- The index {keys} of {collection} could not be created: {error}")
+
+    def get_index_usage(self):
+        """Returns a list of (collection, index name, number of times that the index was used since the server started)"""
+        usage = []
+
+        for collection in self.get_indexes():
+            for index in self.db[collection].aggregate([{'$indexStats': {}}]):
+                usage.append((collection, index['name'], index['accesses']['ops']))
+
+        return usage
 
     def handle_row_to_insert(self, data_row, option_file):
         """
-        Handles each row of the file to create the correct object that will be inserted in the database
+        Handles each row of the file to create the correct object that will be inserted in the database.
+        The electors keep the trigrams of their names used by search_by_name_fuzzy, so every insert path stores them
         """
         data_dict = {}
 
@@ -64,17 +191,42 @@ class MongoConnection(Connection):
                          "primer_apellido": data_row[6].strip(),
                          "segundo_apellido": data_row[7].strip()
                          }
+            data_dict['ngrams'] = get_name_ngrams(data_dict['nombre'], data_dict['primer_apellido'], data_dict['segundo_apellido'])
 
                         
 
         return data_dict
 
+    def get_row_location(self, data_row):
+        """
+        Returns the electoral code and the gender of a row returned by handle_row_to_insert for the padron file
+        """
+        return data_row['codigo_electoral'], data_row['relleno']
+
+    def get_row_expiration_date(self, data_row):
+        """
+        Returns the id card expiration date of a row returned by handle_row_to_insert for the padron file
+        """
+        return data_row['fecha_caducidad']
+
+    def get_expiration_date(self, date):
+        """Returns the date stored in the electors for a YYYYMMDD date of the padron file or a date of a columnar file"""
+        if isinstance(date, str):
+            date = datetime(int(date[:4]), int(date[4:6]), int(date[6:]), 18)
+
+        # A date32 of a columnar file
+        elif not isinstance(date, datetime):
+            date = datetime(date.year, date.month, date.day, 18)
+
+        return date
+
     def bulk_insert(self, data, insert_option):
         """
         Performs a bulk insert for the database in the table or collection given as a parameter
         """
         try:
             if (insert_option == 'distelec'):
+                self.districts = None
                 self.db[self.distelect_table_or_collection].insert_many(data)
 
             elif (insert_option == 'padron'):
@@ -89,38 +241,81 @@ class MongoConnection(Connection):
                     data)
 
             elif (insert_option == 'district_stats'):
+                self.statistics_ids = None
                 self.db[self.district_stats_table_or_collection].insert_many(
                     data)
 
             print(f"--- The data was inserted ---")
+            return True
 
         except Exception as error:
             print(error)
+            return False
+
+    def bulk_insert_batch(self, batch, option_file):
+        """ Inserts a record batch of a columnar file. insert_many needs a document for each row,
+            so only the cedula and the expiration date are converted to the types of the documents of the text load and the trigrams are added
+        """
+        data = batch.to_pylist()
+
+        if (option_file == 'padron'):
+            for document in data:
+                document['cedula'] = f"{document['cedula']:09d}"
+                document['fecha_caducidad'] = self.get_expiration_date(document['fecha_caducidad'])
+                document['ngrams'] = get_name_ngrams(document['nombre'], document['primer_apellido'], document['segundo_apellido'])
+
+        return self.bulk_insert(data, option_file)
+
+    def get_district(self, code):
+        """ Returns the district document of the electoral code from the districts kept in memory.
+            The districts are loaded with one query the first time that a district is needed
+        """
+        # Another thread can reset self.districts, so the dictionary is read once and built before it is assigned
+        districts = self.districts
+
+        if districts is None:
+            districts = {district['codigo_electoral']: district
+                         for district in self.db[self.distelect_table_or_collection].find({}, {'_id': 0})}
+            self.districts = districts
+
+        district = districts.get(code)
+
+        # A district inserted after the districts were loaded
+        if district is None:
+            district = self.db[self.distelect_table_or_collection].find_one({'codigo_electoral': code}, {'_id': 0})
+
+            if district is not None:
+                districts[code] = district
+
+        return district
 
     def build_searching_result(self, elector_query_filter):
         """ Builds a searching result with the elector and electoral districts information"""
 
         
         elector = self.db[self.elector_table_or_collection].find_one(
-            elector_query_filter)
+            elector_query_filter, {'ngrams': 0})
 
         if elector is not None:
-            electoral_district = self.db[self.distelect_table_or_collection].find_one(
-                {'codigo_electoral': elector['codigo_electoral']})
-
-            return {'nombre': elector['nombre'],
-                'primer_apellido': elector['primer_apellido'],
-                'segundo_apellido': elector['segundo_apellido'],
-                'cedula': elector['cedula'],
-                'fecha_caducidad': elector['fecha_caducidad'],
-                'codigo_electoral__provincia': electoral_district['provincia'],
-                'codigo_electoral__canton': electoral_district['canton'],
-                'codigo_electoral__distrito': electoral_district['distrito'],
-                'codigo_electoral': electoral_district['codigo_electoral'],
-                }
+            return self.build_elector_result(elector)
 
         else :
             return []
+
+    def build_elector_result(self, elector):
+        """ Returns the information of an elector document and its electoral district"""
+        electoral_district = self.get_district(elector['codigo_electoral'])
+
+        return {'nombre': elector['nombre'],
+            'primer_apellido': elector['primer_apellido'],
+            'segundo_apellido': elector['segundo_apellido'],
+            'cedula': elector['cedula'],
+            'fecha_caducidad': elector['fecha_caducidad'],
+            'codigo_electoral__provincia': electoral_district['provincia'],
+            'codigo_electoral__canton': electoral_district['canton'],
+            'codigo_electoral__distrito': electoral_district['distrito'],
+            'codigo_electoral': electoral_district['codigo_electoral'],
+            }
              
 
          
@@ -132,12 +327,95 @@ class MongoConnection(Connection):
         searching_result = self.build_searching_result(elector_query_filter)
         return searching_result
 
+    def search_by_name_fuzzy(self, name, surname, second_surname, page=1, page_size=20):
+        """ Allows to search electors whose names start with or are similar to the names given as parameters.
+            The candidates share trigrams with the ngrams of the electors, and they are ranked by the number of shared trigrams
+        """
+        query_ngrams = get_name_ngrams(name, surname, second_surname, prefix=True)
+
+        if not query_ngrams:
+            return []
+
+        # At least half of the trigrams must match, so a typo changes only a few of them
+        minimum_score = (len(query_ngrams) + 1) // 2
+        rarest_ngrams = self.sort_ngrams_by_frequency(query_ngrams)
+
+        # The electors that share all the trigrams are searched first and the minimum is lowered only when they do not fill the page
+        for score in sorted({len(query_ngrams), (3 * len(query_ngrams) + 3) // 4, minimum_score}, reverse=True):
+            # An elector that shares score trigrams has at least one of any len - score + 1 trigrams of the search, so only the rarest are read
+            candidate_ngrams = rarest_ngrams[:len(query_ngrams) - score + 1]
+            electors = list(self.db[self.elector_table_or_collection].aggregate(
+                self.get_fuzzy_search_pipeline(candidate_ngrams, query_ngrams, score, page, page_size)))
+
+            # A full page is the right one, the electors that were not searched share fewer trigrams so they are ranked after it
+            if len(electors) == page_size:
+                break
+
+        results = []
+
+        for elector in electors:
+            result = self.build_elector_result(elector)
+            result['similarity'] = elector['score'] / len(query_ngrams)
+            results.append(result)
+
+        return results
+
+    def get_fuzzy_search_pipeline(self, candidate_ngrams, query_ngrams, minimum_score, page, page_size):
+        """Returns the aggregation that ranks the electors with any of the candidate trigrams that share at least minimum_score trigrams with the search"""
+        return [
+            {'$match': {'ngrams': {'$in': candidate_ngrams}}},
+            # The candidates are limited before they are scored, so a very common name does not score the whole collection
+            {'$limit': FUZZY_SEARCH_CANDIDATES},
+            {'$project': {'_id': 0, 'cedula': 1, 'nombre': 1, 'primer_apellido': 1, 'segundo_apellido': 1, 'fecha_caducidad': 1, 'codigo_electoral': 1,
+                          'score': {'$size': {'$setIntersection': ['$ngrams', query_ngrams]}}}},
+            {'$match': {'score': {'$gte': minimum_score}}},
+            {'$sort': {'score': -1, 'cedula': 1}},
+            {'$skip': (page - 1) * page_size},
+            {'$limit': page_size}
+        ]
+
+    def sort_ngrams_by_frequency(self, ngrams):
+        """ Returns the trigrams sorted from the one that the fewest electors have.
+            Each trigram is counted in its index only up to FUZZY_SEARCH_CANDIDATES, so counting a common trigram does not read all its electors
+        """
+        frequencies = {ngram: self.db[self.elector_table_or_collection].count_documents({'ngrams': ngram}, limit=FUZZY_SEARCH_CANDIDATES)
+                       for ngram in ngrams}
+        return sorted(ngrams, key=lambda ngram: (frequencies[ngram], ngram))
+
+    def build_name_index(self):
+        """ Builds the index of the trigrams used by search_by_name_fuzzy.
+            The electors stored before their documents had the trigrams get them first
+        """
+        batch = []
+        electors = self.db[self.elector_table_or_collection].find({'ngrams': {'$exists': False}},
+                                                                  {'_id': 1, 'nombre': 1, 'primer_apellido': 1, 'segundo_apellido': 1}, batch_size=10000)
+
+        for elector in electors:
+            ngrams = get_name_ngrams(elector['nombre'], elector['primer_apellido'], elector['segundo_apellido'])
+            batch.append(UpdateOne({'_id': elector['_id']}, {'$set': {'ngrams': ngrams}}))
+
+            if len(batch) == 10000:
+                self.db[self.elector_table_or_collection].bulk_write(batch, ordered=False)
+                batch = []
+
+        if batch:
+            self.db[self.elector_table_or_collection].bulk_write(batch, ordered=False)
+
+        self.db[self.elector_table_or_collection].create_index([('ngrams', ASCENDING)])
+
     def search_by_id_card(self, id_card):
         """Allows to search in the database an element that matches with the id card given as a parameter"""
         elector_query_filter = {'cedula': id_card}
         searching_result = self.build_searching_result(elector_query_filter)
         return searching_result
 
+    def search_by_id_cards(self, id_cards):
+        """ Allows to search with one query the electors of the id cards given as a parameter.
+            The districts are taken from the districts kept in memory, so there is no query by elector
+        """
+        electors = self.db[self.elector_table_or_collection].find({'cedula': {'$in': list(id_cards)}}, {'ngrams': 0})
+        return {elector['cedula']: self.build_elector_result(elector) for elector in electors}
+
     def get_districts_information(self):
         """ Returns a list of MongoDistrictInformation objects
             It uses a MongoDistrictInformation objects to handle the districts in the same way as 
@@ -145,48 +423,61 @@ class MongoConnection(Connection):
         """
         mongo_districts_list = []
 
-        district = self.db[self.distelect_table_or_collection].find({}, {
-                                                                    '_id': 0})
+        # A single scan of the electors counts men and women of every district
+        pipeline = [
+            {'$group': {'_id': '$codigo_electoral',
+                        'male_count': {'$sum': {'$cond': [{'$eq': ['$relleno', '1']}, 1, 0]}},
+                        'female_count': {'$sum': {'$cond': [{'$eq': ['$relleno', '2']}, 1, 0]}}}}
+        ]
+        counts = {element['_id']: element for element in self.db[self.elector_table_or_collection].aggregate(pipeline, allowDiskUse=True)}
 
-        # For each district calculate the total of men and women
-        for district in district:
-            male_count = self.db[self.elector_table_or_collection].count_documents(
-                {"$and": [{'codigo_electoral': district['codigo_electoral']}, {
-                    'relleno': '1'}]}
-            )
+        districts = self.db[self.distelect_table_or_collection].find({}, {'_id': 0})
 
-            female_count = self.db[self.elector_table_or_collection].count_documents(
-                {"$and": [{'codigo_electoral': district['codigo_electoral']}, {
-                    'relleno': '2'}]}
-            )
+        # The districts keep the order of the collection because compute_statistics depends on it
+        for district in districts:
+            district_counts = counts.get(district['codigo_electoral'], {'male_count': 0, 'female_count': 0})
 
             new_district = MongoDistrictInformation(electoral_code=district['codigo_electoral'], province=district['provincia'],
-                                                    canton=district['canton'], district=district['distrito'], male_count=male_count,
-                                                    female_count=female_count)
+                                                    canton=district['canton'], district=district['distrito'], male_count=district_counts['male_count'],
+                                                    female_count=district_counts['female_count'])
             mongo_districts_list.append(new_district)
 
         return mongo_districts_list
 
-    def get_canton_id(self, province, canton):
-        canton = self.db[self.canton_stats_table_or_collection].find_one(
-            {"$and": [{'provincia': province}, {'canton': canton}]})
-        return canton['_id']
+    def get_districts(self):
+        """Returns a list of (electoral code, province, canton, district) in the same order as get_districts_information"""
+        districts = self.db[self.distelect_table_or_collection].find({}, {'_id': 0})
+        return [(district['codigo_electoral'], district['provincia'], district['canton'], district['distrito']) for district in districts]
+
+    def iterate_electors_locations(self):
+        """Yields the electoral code and the gender of each elector"""
+        electors = self.db[self.elector_table_or_collection].find({}, {'_id': 0, 'codigo_electoral': 1, 'relleno': 1}, batch_size=10000)
+
+        for elector in electors:
+            yield elector['codigo_electoral'], elector['relleno']
+
+    def get_canton_ids(self):
+        """Returns a dictionary of (province, canton) => id of the canton stats, fetched with one query"""
+        cantons = self.db[self.canton_stats_table_or_collection].find({}, {'provincia': 1, 'canton': 1})
+        return {(canton['provincia'], canton['canton']): canton['_id'] for canton in cantons}
 
-    def get_province_id(self, province):
-        province = self.db[self.province_stats_table_or_collection].find_one(
-            {'provincia': province})
-        return province['_id']
+    def get_province_ids(self):
+        """Returns a dictionary of province => id of the province stats, fetched with one query"""
+        provinces = self.db[self.province_stats_table_or_collection].find({}, {'provincia': 1})
+        return {province['provincia']: province['_id'] for province in provinces}
 
-    def generate_data(self, element, option):
+    def generate_data(self, element, option, ids=None):
+        """ Returns the element to insert in the stats of the option given as a parameter.
+            ids is the dictionary of the parent level returned by get_province_ids or get_canton_ids
+        """
         new_element = element
 
         if (option == 'canton'):
             new_element.update(
-                {'codigo_provincia_id': self.get_province_id(element['provincia'])})
+                {'codigo_provincia_id': ids[element['provincia']]})
 
         elif (option == 'district'):
-            new_element.update({'codigo_canton_id': self.get_canton_id(
-                element['provincia'], element['canton'])})
+            new_element.update({'codigo_canton_id': ids[(element['provincia'], element['canton'])]})
 
         yield new_element
 
@@ -209,45 +500,162 @@ class MongoConnection(Connection):
                                                                                                           'canton': 0,
                                                                                                           'codigo_canton_id': 0})
 
-        identification_statistics = {'same_id_count': self.db[self.elector_table_or_collection].count_documents(
-            {'fecha_caducidad': expiration_date}
-        )}
+        # The number of electors of each expiration date is precomputed by compute_statistics
+        same_id_count = self.db[self.expiration_date_stats_table_or_collection].find_one({'fecha_caducidad': expiration_date})
+        identification_statistics = {'same_id_count': same_id_count['total_votantes'] if same_id_count else 0}
 
         return {'province_statistics': province_statistics,
                 'canton_statistics': canton_statistics,
                 'district_statistics': district_statistics,
                 'id_statistics': identification_statistics}
 
+    def iterate_electors(self, sort=False):
+        """Yields each elector as a tuple of strings in the same order and format of the padron file, sorted by cedula when sort is True"""
+        fields = ['cedula', 'codigo_electoral', 'relleno', 'fecha_caducidad', 'junta', 'nombre', 'primer_apellido', 'segundo_apellido']
+        projection = dict.fromkeys(fields, 1)
+        projection['_id'] = 0
+
+        electors = self.db[self.elector_table_or_collection].find({}, projection, batch_size=10000)
+
+        if sort:
+            electors = electors.sort('cedula', ASCENDING)
+
+        for elector in electors:
+            elector['fecha_caducidad'] = elector['fecha_caducidad'].strftime("%Y%m%d")
+            yield tuple(elector[field] for field in fields)
+
+    def get_electors_locations(self, id_cards):
+        """Returns a dictionary with the electoral code, the gender and the expiration date of each id card given as a parameter"""
+        electors = self.db[self.elector_table_or_collection].find({'cedula': {'$in': list(id_cards)}},
+                                                                  {'_id': 0, 'cedula': 1, 'codigo_electoral': 1, 'relleno': 1, 'fecha_caducidad': 1})
+
+        return {elector['cedula']: (elector['codigo_electoral'], elector['relleno'], elector['fecha_caducidad']) for elector in electors}
+
+    def delete_electors(self, id_cards):
+        """Deletes the electors of the id cards given as a parameter without updating the statistics"""
+        self.db[self.elector_table_or_collection].delete_many({'cedula': {'$in': list(id_cards)}})
+
+    def replace_electors(self, data):
+        """ Replaces the electors of the documents given as a parameter with one bulk write of upserts, so a document is replaced in a single operation.
+            Returns the id cards of the replaced electors
+        """
+        operations = [ReplaceOne({'cedula': document['cedula']}, document, upsert=True) for document in data]
+        failed_positions = set()
+
+        try:
+            self.db[self.elector_table_or_collection].bulk_write(operations, ordered=False)
+
+        except BulkWriteError as error:
+            failed_positions = {write_error['index'] for write_error in error.details['writeErrors']}
+            print(f"--- {len(failed_positions)} electors could not be replaced: {error}")
+
+        return [document['cedula'] for position, document in enumerate(data) if position not in failed_positions]
+
+    def insert_expiration_dates_statistics(self, expiration_dates=None):
+        """ Inserts the number of electors of each id card expiration date.
+            Without expiration_dates they are counted with a single $group of the electors
+        """
+        if expiration_dates is None:
+            pipeline = [{'$group': {'_id': '$fecha_caducidad', 'total_votantes': {'$sum': 1}}}]
+            expiration_dates = {element['_id']: element['total_votantes']
+                                for element in self.db[self.elector_table_or_collection].aggregate(pipeline, allowDiskUse=True)}
+
+        documents = [{'fecha_caducidad': self.get_expiration_date(date), 'total_votantes': total} for date, total in expiration_dates.items()]
+
+        if documents:
+            self.db[self.expiration_date_stats_table_or_collection].insert_many(documents)
+
+        self.db[self.expiration_date_stats_table_or_collection].create_index([('fecha_caducidad', ASCENDING)], unique=True)
+
+    def apply_expiration_dates_deltas(self, deltas):
+        """Adds to the number of electors of each id card expiration date the changes given as a parameter, the dates that do not exist are inserted"""
+        for date, delta in deltas.items():
+            if delta != 0:
+                self.db[self.expiration_date_stats_table_or_collection].update_one({'fecha_caducidad': self.get_expiration_date(date)},
+                                                                                   {'$inc': {'total_votantes': delta}}, upsert=True)
+
+    def apply_statistics_deltas(self, deltas):
+        """ Adds to the stats of each district, canton and province the changes given as a parameter.
+            The changes of the districts are grouped by canton and province, so each stats document is updated once
+        """
+        districts = self.db[self.distelect_table_or_collection].find({'codigo_electoral': {'$in': list(deltas)}}, {'_id': 0})
+        province_deltas, canton_deltas, district_deltas = self.group_statistics_deltas(districts, deltas)
+
+        levels = [(self.province_stats_table_or_collection, ['provincia'], province_deltas),
+                  (self.canton_stats_table_or_collection, ['provincia', 'canton'], canton_deltas),
+                  (self.district_stats_table_or_collection, ['provincia', 'canton', 'distrito'], district_deltas)]
+
+        for collection, fields, level_deltas in levels:
+            for key, (male_delta, female_delta) in level_deltas.items():
+                if male_delta == 0 and female_delta == 0:
+                    continue
+
+                query_operation = {'$inc': {'total_votantes': male_delta + female_delta,
+                                            'total_votantes_hombres': male_delta,
+                                            'total_votantes_mujeres': female_delta}}
+                self.db[collection].update_one(dict(zip(fields, key)), query_operation)
+
     def insert_new_elector(self,new_data):
         new_data[3] = new_data[3].strftime("%Y%m%d")
         new_doc = self.handle_row_to_insert(new_data, 'padron')
         self.db[self.elector_table_or_collection].insert_one(new_doc)
-        self.update_statistics(new_data[1],new_data[2],'increase')
+        self.update_statistics(new_data[1],new_data[2],'increase', new_doc['fecha_caducidad'])
 
     def delete_elector(self, id_card):
         elector = self.db[self.elector_table_or_collection].find_one({'cedula': id_card})
-        data = [elector['cedula'], elector['codigo_electoral'],elector['relleno']]
+        data = [elector['cedula'], elector['codigo_electoral'],elector['relleno'], elector['fecha_caducidad']]
         
         self.db[self.elector_table_or_collection].delete_one({'cedula': data[0]})
-        self.update_statistics(data[1], data[2], 'decrease')
+        # After the delete, so a search done in between does not cache the deleted elector again
+        id_card_cache.invalidate(id_card)
+        self.update_statistics(data[1], data[2], 'decrease', data[3])
+
+
+    def get_statistics_ids(self, code):
+        """ Returns the ids of the province, canton and district stats documents of the electoral code.
+            The ids of all the districts are loaded with one query for each stats collection the first time
+        """
+        # The dictionary is filled before it is assigned, so another thread never reads it half built or reset
+        statistics_ids = self.statistics_ids
+
+        if statistics_ids is None:
+            province_ids = self.get_province_ids()
+            canton_ids = self.get_canton_ids()
+            district_ids = {(district['provincia'], district['canton'], district['distrito']): district['_id']
+                            for district in self.db[self.district_stats_table_or_collection].find({}, {'provincia': 1, 'canton': 1, 'distrito': 1})}
+            statistics_ids = {}
+
+            for district_code, province, canton, district in self.get_districts():
+                ids = (province_ids.get(province), canton_ids.get((province, canton)), district_ids.get((province, canton, district)))
 
+                if None not in ids:
+                    statistics_ids[district_code] = ids
 
-    def update_statistics(self,code, new_gender, operation):
+            self.statistics_ids = statistics_ids
+
+        return statistics_ids.get(code)
+
+    def update_statistics(self,code, new_gender, operation, expiration_date=None):
 
         gender = 'total_votantes_hombres' if new_gender == '1' else 'total_votantes_mujeres'
         quantity = 1 if operation == 'increase' else -1
 
-        ubication = self.db[self.distelect_table_or_collection].find_one({'codigo_electoral': code },{'_id':0, 'codigo_electoral':0})
+        query_operation = { '$inc': { 'total_votantes': quantity, gender : quantity }}
+        collections = [self.province_stats_table_or_collection, self.canton_stats_table_or_collection, self.district_stats_table_or_collection]
 
-        province_filter = { 'provincia': ubication['provincia'] }
-        canton_filter =  {'$and': [{'provincia': ubication['provincia']}, {'canton': ubication['canton']}]}
-        district_filter = { '$and': [ {'provincia': ubication['provincia']} , {'canton': ubication['canton']} , {'distrito': ubication['distrito']}]}
+        # The stats could be computed again by another process after the ids were cached, so they are loaded again once
+        for _ in range(2):
+            statistics_ids = self.get_statistics_ids(code)
 
-        query_operation = { '$inc': { 'total_votantes': quantity, gender : quantity }}
+            if statistics_ids is not None and self.db[collections[2]].update_one({'_id': statistics_ids[2]}, query_operation).matched_count:
+                self.db[collections[0]].update_one({'_id': statistics_ids[0]}, query_operation)
+                self.db[collections[1]].update_one({'_id': statistics_ids[1]}, query_operation)
+                break
+
+            self.statistics_ids = None
 
-        self.db[self.province_stats_table_or_collection].update_one(province_filter, query_operation )
-        self.db[self.canton_stats_table_or_collection].update_one(canton_filter, query_operation )
-        self.db[self.district_stats_table_or_collection].update_one(district_filter, query_operation )
+        if expiration_date is not None:
+            self.apply_expiration_dates_deltas({expiration_date: quantity})
 
     
       
@@ -0,0 +1,32 @@
+import unicodedata
+
+
+def normalize_name(text):
+    """Returns the text in uppercase without accents, so JOSÉ and JOSE are the same name"""
+    text = unicodedata.normalize('NFKD', text.upper())
+    return ''.join(character for character in text if not unicodedata.combining(character)).strip()
+
+
+def get_trigrams(text, prefix=False):
+    """ Returns the trigrams of each word of the text in the same way as pg_trgm: two blanks before the word and one after.
+        With prefix the last trigram is not added, so a beginning of a word matches the whole word
+    """
+    trigrams = set()
+
+    for word in normalize_name(text).split():
+        padded_word = '  ' + word + ('' if prefix else ' ')
+        trigrams.update(padded_word[i:i + 3] for i in range(len(padded_word) - 2))
+
+    return trigrams
+
+
+def get_name_ngrams(name, surname, second_surname, prefix=False):
+    """ Returns the trigrams of the name fields. Each trigram starts with the position of its field
+        so a trigram of the name does not match the same trigram of a surname
+    """
+    ngrams = []
+
+    for position, text in enumerate([name, surname, second_surname]):
+        ngrams.extend(f"{position}{trigram}" for trigram in sorted(get_trigrams(text or '', prefix)))
+
+    return ngrams
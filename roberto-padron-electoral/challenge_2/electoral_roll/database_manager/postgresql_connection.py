@@ -1,14 +1,32 @@
+import os
+import csv
+import json
+import time
+from io import StringIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
-from django.db import connection
-from django.db.models import Q, Count
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Q, Count, F, Func, Value, CharField
+from django.contrib.postgres.search import TrigramSimilarity
 
 
 from challenge_2.settings import MONGO_URI
-from challenge_2.settings import DB_NAME
-from electoral_roll.models import Elector, DistritoElectoral, VotantesPorProvincia, VotantesPorCanton, VotantesPorDistrito
+from challenge_2.settings import DB_NAME, TIME_ZONE
+from challenge_2.settings import POSTGRES_MAINTENANCE_WORK_MEM, POSTGRES_INDEX_WORKERS, POSTGRES_DROPPED_INDEXES_FILE
+from electoral_roll.models import Elector, DistritoElectoral, VotantesPorProvincia, VotantesPorCanton, VotantesPorDistrito, VotantesPorFechaCaducidad
+from electoral_roll.columnar import import_pyarrow
 from .connection import Connection
 
 
+class Unaccent(Func):
+    """ Removes the accents of a text with the immutable wrapper of unaccent created by the migrations,
+        the trigram indexes of the names are built on the same function
+    """
+    function = 'electoral_roll_unaccent'
+    output_field = CharField()
+
+
 class PostgreConnection(Connection):
     """
         It is a concrete type of postgre databse connection
@@ -17,12 +35,28 @@ class PostgreConnection(Connection):
     def __init__(self, engine):
         super().__init__(engine)
         self.connection = connection
-
-    def clean_database(self, option):
+        # Table and columns where each file is loaded
+        self.files_columns = {
+            'distelec': (self.distelect_table_or_collection, ['codigo_electoral', 'provincia', 'canton', 'distrito']),
+            'padron': (self.elector_table_or_collection, ['cedula', 'codigo_electoral_id', 'relleno', 'fecha_caducidad', 'junta', 'nombre', 'primer_apellido', 'segundo_apellido'])
+        }
+        # Below this number of rows a chunk rejected by COPY is inserted row by row
+        self.copy_fallback_size = 1000
+        # A shadow load creates the tables with the same names in this schema and puts it first in the search_path of each connection
+        self.shadow_schema = 'electoral_roll_next'
+        self.live_schema = None
+        # The models are created in this order, so each foreign key references a table that already exists
+        self.shadow_models = [DistritoElectoral, Elector, VotantesPorProvincia, VotantesPorCanton, VotantesPorDistrito, VotantesPorFechaCaducidad]
+
+    def clean_database(self, option, truncate=False):
         """
-        Cleans the database before to start the insertion process
+        Cleans the database before to start the insertion process.
+        The delete of the ORM loads each elector and sends its post_delete signal, truncate empties the tables with one statement instead
         """
-        if (option == 'electoral_roll'):
+        if truncate:
+            self.truncate_tables(option)
+
+        elif (option == 'electoral_roll'):
             DistritoElectoral.objects.all().delete()
             Elector.objects.all().delete()
 
@@ -30,6 +64,234 @@ class PostgreConnection(Connection):
             VotantesPorDistrito.objects.all().delete()
             VotantesPorCanton.objects.all().delete()
             VotantesPorProvincia.objects.all().delete()
+            VotantesPorFechaCaducidad.objects.all().delete()
+
+    def truncate_tables(self, option):
+        """ Empties the tables of the option with TRUNCATE ... RESTART IDENTITY CASCADE, no signals are sent.
+            The stats depend on the electors, so they are truncated with the electoral roll too
+        """
+        tables = [self.district_stats_table_or_collection, self.canton_stats_table_or_collection,
+                  self.province_stats_table_or_collection, self.expiration_date_stats_table_or_collection]
+
+        if (option == 'electoral_roll'):
+            tables = [self.elector_table_or_collection, self.distelect_table_or_collection] + tables
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY CASCADE")
+            self.connection.commit()
+
+    def set_shadow_search_path(self, sender, connection, **kwargs):
+        """Receiver of connection_created, the worker threads and the index builds open their own connections"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET search_path TO {self.shadow_schema}, {self.live_schema}")
+
+    def prepare_shadow_load(self):
+        """ Creates the tables of the models in an empty schema with the schema editor, so they have the same names, indexes and
+            foreign keys as the live tables. Every connection opened after this looks for the tables in that schema first,
+            so the COPY, the raw sql and the ORM of the load write the shadow tables without changing their names
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT current_schema()")
+            self.live_schema = cursor.fetchone()[0]
+            cursor.execute(f"DROP SCHEMA IF EXISTS {self.shadow_schema} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {self.shadow_schema}")
+
+        connection_created.connect(self.set_shadow_search_path, dispatch_uid='electoral_roll_shadow_load')
+        # The connection of this thread is opened again with the new search_path
+        self.connection.close()
+
+        with self.connection.schema_editor() as schema_editor:
+            for model in self.shadow_models:
+                schema_editor.create_model(model)
+
+        self.copy_live_indexes()
+
+    def copy_live_indexes(self):
+        """ Creates in the shadow electors the indexes of the live electors that the model does not have,
+            like the trigram indexes of the unaccented names created by the migrations
+        """
+        table = self.elector_table_or_collection
+        sql = "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND schemaname = %s"
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [table, self.shadow_schema])
+            shadow_indexes = {name for name, _ in cursor.fetchall()}
+            cursor.execute(sql, [table, self.live_schema])
+
+            for name, index_sql in cursor.fetchall():
+                if name not in shadow_indexes:
+                    cursor.execute(index_sql.replace(f" ON {self.live_schema}.{table} ", f" ON {self.shadow_schema}.{table} ", 1))
+
+    def swap_shadow_load(self):
+        """ Moves the live tables to a temporary schema and the shadow tables to the live schema in one transaction.
+            The searches wait for the transaction and then read the new tables, they never see them empty or partial
+        """
+        old_schema = 'electoral_roll_old'
+        tables = [model._meta.db_table for model in self.shadow_models]
+
+        with transaction.atomic(), self.connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {old_schema} CASCADE")
+            cursor.execute(f"CREATE SCHEMA {old_schema}")
+
+            for table in tables:
+                cursor.execute(f"ALTER TABLE {self.live_schema}.{table} SET SCHEMA {old_schema}")
+
+            for table in tables:
+                cursor.execute(f"ALTER TABLE {self.shadow_schema}.{table} SET SCHEMA {self.live_schema}")
+
+        connection_created.disconnect(dispatch_uid='electoral_roll_shadow_load')
+        self.connection.close()
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA {old_schema} CASCADE")
+            cursor.execute(f"DROP SCHEMA {self.shadow_schema} CASCADE")
+
+    def clean_chunk(self, data, option_file):
+        """
+        Deletes the rows of a chunk that could be partially inserted, before to insert it again.
+        It uses sql to avoid the post_delete signals of the electors
+        """
+        table, columns = self.files_columns[option_file]
+        keys = [element[0] for element in data]
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table} WHERE {columns[0]} = ANY(%s)", [keys])
+            self.connection.commit()
+
+    def get_dropped_indexes(self):
+        """ Returns the dictionaries of index name => CREATE INDEX statement and of constraint name => ADD CONSTRAINT statement
+            that drop_indexes saved and that were not created again yet
+        """
+        if not os.path.exists(POSTGRES_DROPPED_INDEXES_FILE):
+            return {}, {}
+
+        with open(POSTGRES_DROPPED_INDEXES_FILE, mode='r') as file:
+            statements = json.load(file)
+
+        return statements['indexes'], statements['foreign_keys']
+
+    def save_dropped_indexes(self, indexes, foreign_keys):
+        """Writes the statements of the dropped indexes and foreign keys to a file synced to disk, the file is removed when there are none"""
+        if not indexes and not foreign_keys:
+            if os.path.exists(POSTGRES_DROPPED_INDEXES_FILE):
+                os.remove(POSTGRES_DROPPED_INDEXES_FILE)
+
+            return
+
+        temporary_file_name = POSTGRES_DROPPED_INDEXES_FILE + '.tmp'
+
+        with open(temporary_file_name, mode='w') as file:
+            json.dump({'indexes': indexes, 'foreign_keys': foreign_keys}, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_file_name, POSTGRES_DROPPED_INDEXES_FILE)
+
+    def drop_indexes(self):
+        """ Drops the secondary indexes and the foreign keys of the electors, so the bulk load does not maintain them for each row.
+            The primary key is kept. Their definitions are read from the catalog and saved before they are dropped,
+            so create_indexes builds again exactly the indexes that existed, including the ones created by the migrations
+        """
+        table = self.elector_table_or_collection
+        indexes, foreign_keys = self.get_dropped_indexes()
+
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+            dropped_foreign_keys = {name: f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for name, definition in cursor.fetchall()}
+
+            # pg_get_indexdef qualifies the table with its schema, without it the statement builds the index of the tables in use
+            # when it is replayed, the live ones or the shadow ones
+            cursor.execute("SELECT current_schema()")
+            schema = cursor.fetchone()[0]
+            # The indexes that belong to a constraint (the primary key) are not dropped
+            cursor.execute("SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) FROM pg_index "
+                           "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid WHERE pg_index.indrelid = %s::regclass "
+                           "AND pg_index.indexrelid NOT IN (SELECT conindid FROM pg_constraint WHERE conrelid = %s::regclass)", [table, table])
+            dropped_indexes = {name: sql.replace(f" ON {schema}.{table} ", f" ON {table} ", 1) for name, sql in cursor.fetchall()}
+
+            # The statements of a previous load that crashed before create_indexes are kept
+            indexes.update(dropped_indexes)
+            foreign_keys.update(dropped_foreign_keys)
+            self.save_dropped_indexes(indexes, foreign_keys)
+
+            for constraint in dropped_foreign_keys:
+                cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"')
+
+            for index in dropped_indexes:
+                cursor.execute(f'DROP INDEX IF EXISTS "{index}"')
+
+            self.connection.commit()
+
+    def create_index(self, name, sql):
+        """Builds one index in its own connection, so several indexes are built at the same time. Returns the seconds that it took"""
+        start_time = time.time()
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SET maintenance_work_mem = %s", [POSTGRES_MAINTENANCE_WORK_MEM])
+                cursor.execute(sql)
+                self.connection.commit()
+
+        except Exception as error:
+            print(f"--- The index {name} could not be created: {error}")
+
+        finally:
+            # Each thread has its own django connection
+            self.connection.close()
+
+        return name, time.time() - start_time
+
+    def create_foreign_key(self, name, sql):
+        """Adds one foreign key in its own transaction, so a foreign key that fails does not stop the next ones"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(sql)
+                self.connection.commit()
+
+        except Exception as error:
+            self.connection.rollback()
+            print(f"--- The foreign key {name} could not be created: {error}")
+
+    def get_existing_indexes(self):
+        """Returns the names of the indexes and of the foreign keys of the electors"""
+        table = self.elector_table_or_collection
+
+        with self.connection.cursor() as cursor:
+            # During a shadow load the same table exists in two schemas
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND schemaname = current_schema()", [table])
+            existing_indexes = {index for (index,) in cursor.fetchall()}
+            cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+            existing_foreign_keys = {constraint for (constraint,) in cursor.fetchall()}
+
+        return existing_indexes, existing_foreign_keys
+
+    def create_indexes(self):
+        """ Creates the indexes and the foreign keys that drop_indexes dropped, in POSTGRES_INDEX_WORKERS connections at the same time.
+            The foreign keys are added after the indexes, so their validation can use the index of the electoral code.
+            The statements that fail are kept in POSTGRES_DROPPED_INDEXES_FILE for the next load
+        """
+        indexes, foreign_keys = self.get_dropped_indexes()
+        existing_indexes, existing_foreign_keys = self.get_existing_indexes()
+        missing_indexes = [(name, sql) for name, sql in indexes.items() if name not in existing_indexes]
+
+        with ThreadPoolExecutor(max_workers=POSTGRES_INDEX_WORKERS) as executor:
+            for name, seconds in executor.map(lambda index: self.create_index(*index), missing_indexes):
+                print(f"--- The index {name} took {seconds:.2f} seconds")
+
+        for name, sql in foreign_keys.items():
+            if name not in existing_foreign_keys:
+                self.create_foreign_key(name, sql)
+
+        existing_indexes, existing_foreign_keys = self.get_existing_indexes()
+        self.save_dropped_indexes({name: sql for name, sql in indexes.items() if name not in existing_indexes},
+                                  {name: sql for name, sql in foreign_keys.items() if name not in existing_foreign_keys})
+
+    def get_index_usage(self):
+        """Returns a list of (table, index name, number of index scans since the stats were reset)"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT relname, indexrelname, idx_scan FROM pg_stat_user_indexes "
+                           "WHERE relname LIKE 'electoral_roll_%' ORDER BY relname, indexrelname")
+            return cursor.fetchall()
 
     def handle_row_to_insert(self, data_row, option_file):
         """
@@ -47,6 +309,18 @@ class PostgreConnection(Connection):
 
         return data
 
+    def get_row_location(self, data_row):
+        """
+        Returns the electoral code and the gender of a row returned by handle_row_to_insert for the padron file
+        """
+        return data_row[1], data_row[2]
+
+    def get_row_expiration_date(self, data_row):
+        """
+        Returns the id card expiration date of a row returned by handle_row_to_insert for the padron file
+        """
+        return data_row[3]
+
     def bulk_insert(self, data, insert_option):
         """
         Performs a bulk insert for the database in the table or collection given as a parameter
@@ -61,22 +335,107 @@ class PostgreConnection(Connection):
             elif (insert_option == 'district_stats'):
                 VotantesPorDistrito.objects.bulk_create(data)
 
-            else:
+            elif (insert_option in self.files_columns):
+                rejected_rows = self.copy_insert(data, insert_option)
+
+                # The chunk is not complete, so it is not recorded as inserted and its rows are not counted in the stats
+                if rejected_rows:
+                    print(f"--- {len(rejected_rows)} of {len(data)} rows were rejected in {insert_option} ---")
+                    return False
+
+            print(f"--- The data was inserted ---")
+            return True
+
+        except Exception as error:
+            print(error)
+            return False
 
-                if (insert_option == 'distelec'):
-                    sql = f"INSERT INTO {self.distelect_table_or_collection} (codigo_electoral, provincia, canton, distrito)  VALUES (%s,%s,%s,%s)"
+    def bulk_insert_batch(self, batch, option_file):
+        """ Writes the record batch as csv with arrow and loads it with COPY, the rows are not converted to python objects.
+            If COPY rejects the batch, its rows are inserted with bulk_insert, which isolates the bad rows
+        """
+        pa = import_pyarrow()
+        table, columns = self.files_columns[option_file]
+
+        if (option_file == 'padron'):
+            # The cedula is an integer in the columnar file, the leading zeros are put back as in the text load
+            arrays = batch.columns
+            arrays[0] = pa.compute.utf8_lpad(arrays[0].cast(pa.string()), width=9, padding='0')
+            batch = pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
 
-                elif (insert_option == 'padron'):
-                    sql = f"INSERT INTO {self.elector_table_or_collection} (cedula, codigo_electoral_id, relleno,fecha_caducidad, junta,nombre, primer_apellido, segundo_apellido) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
+        buffer = pa.BufferOutputStream()
+        pa.csv.write_csv(batch, buffer, write_options=pa.csv.WriteOptions(include_header=False))
 
-                with self.connection.cursor() as cursor:
-                    cursor.executemany(sql, data)
-                    self.connection.commit()
+        sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.copy_expert(sql, BytesIO(buffer.getvalue().to_pybytes()))
+                self.connection.commit()
 
             print(f"--- The data was inserted ---")
+            return True
 
         except Exception as error:
-            print(error)
+            print(f"--- COPY rejected a batch of {batch.num_rows} rows in {table}: {error}")
+            return self.bulk_insert([tuple(row.values()) for row in batch.to_pylist()], option_file)
+
+    def copy_insert(self, data, insert_option):
+        """
+        Loads the rows with COPY through an in-memory csv buffer.
+        If COPY rejects the chunk, it is split in halves to isolate the bad rows and only those are inserted with executemany.
+        Returns the list of rows that the database rejected
+        """
+        table, columns = self.files_columns[insert_option]
+        sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.copy_expert(sql, self.get_csv_buffer(data))
+                self.connection.commit()
+
+            return []
+
+        except Exception as error:
+            print(f"--- COPY rejected a chunk of {len(data)} rows in {table}: {error}")
+
+            if len(data) <= self.copy_fallback_size:
+                return self.execute_many_insert(data, insert_option)
+
+            middle = len(data) // 2
+            return self.copy_insert(data[:middle], insert_option) + self.copy_insert(data[middle:], insert_option)
+
+    def get_csv_buffer(self, data):
+        """Returns an in-memory csv file with the rows given as a parameter"""
+        buffer = StringIO()
+        csv.writer(buffer).writerows(data)
+        buffer.seek(0)
+        return buffer
+
+    def execute_many_insert(self, data, insert_option):
+        """ Inserts the rows with executemany. If it fails, inserts them one by one reporting each row that the database rejects.
+            Returns the list of rejected rows
+        """
+        table, columns = self.files_columns[insert_option]
+        placeholders = ','.join(['%s'] * len(columns))
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+        rejected_rows = []
+
+        try:
+            with transaction.atomic(), self.connection.cursor() as cursor:
+                cursor.executemany(sql, data)
+
+        except Exception:
+            for row in data:
+                try:
+                    with transaction.atomic(), self.connection.cursor() as cursor:
+                        cursor.execute(sql, row)
+
+                except Exception as error:
+                    print(f"--- Row {row[0]} was rejected in {table}: {error}")
+                    rejected_rows.append(row)
+
+        return rejected_rows
 
     def get_list_of_values(self):
         """ Returns a list of the necessary values to show in the query result"""
@@ -98,6 +457,39 @@ class PostgreConnection(Connection):
         searching_result = self.verify_result(result)
         return searching_result
 
+    def search_by_name_fuzzy(self, name, surname, second_surname, page=1, page_size=20):
+        """ Allows to search electors whose names start with or are similar to the names given as parameters.
+            Both the names and the searched values are compared without accents, so NUNEZ finds NÚÑEZ. It uses the pg_trgm indexes
+            of the unaccented name fields and ranks the results by the sum of the similarity of each field
+        """
+        fields = {'nombre': name, 'primer_apellido': surname, 'segundo_apellido': second_surname}
+        fields = {field: value.strip().upper() for field, value in fields.items() if value and value.strip()}
+
+        if not fields:
+            return []
+
+        unaccented_fields = {}
+        query_filter = Q()
+        similarity = None
+
+        for field, value in fields.items():
+            unaccented_fields[f'{field}_unaccent'] = Unaccent(F(field))
+            unaccented_value = Unaccent(Value(value))
+
+            query_filter &= Q(**{f'{field}_unaccent__startswith': unaccented_value}) | Q(**{f'{field}_unaccent__trigram_similar': unaccented_value})
+            field_similarity = TrigramSimilarity(Unaccent(F(field)), unaccented_value)
+            similarity = field_similarity if similarity is None else similarity + field_similarity
+
+        offset = (page - 1) * page_size
+        result = Elector.objects.annotate(**unaccented_fields).filter(query_filter).annotate(similarity=similarity / len(fields)) \
+            .order_by('-similarity', 'cedula').values(*self.get_list_of_values(), 'similarity')[offset:offset + page_size]
+
+        return list(result)
+
+    def build_name_index(self):
+        """The trigram indexes of postgres are created by the migrations"""
+        pass
+
     def search_by_id_card(self, id_card):
         """Allows to search in the database an element that matches with the id card given as a parameter"""
         result = Elector.objects.filter(
@@ -105,18 +497,44 @@ class PostgreConnection(Connection):
         searching_result = self.verify_result(result)
         return searching_result
 
+    def search_by_id_cards(self, id_cards):
+        """Allows to search with one query the electors of the id cards given as a parameter, the districts are joined by the same query"""
+        result = Elector.objects.filter(cedula__in=list(id_cards)).values(*self.get_list_of_values())
+        return {elector['cedula']: elector for elector in result}
+
     def get_districts_information(self):
         data = DistritoElectoral.objects.annotate(total_hombres=Count('elector', filter=Q(elector__relleno='1')),
                                                   total_mujeres=Count('elector', filter=Q(elector__relleno='2')))
         return data
 
-    def get_province_id(self, province):
-        return VotantesPorProvincia.objects.values('codigo_provincia').filter(provincia=province)[0]['codigo_provincia']
-
-    def get_canton_id(self, province, canton):
-        return VotantesPorCanton.objects.values('codigo_canton').filter(codigo_provincia__provincia=province, canton=canton)[0]['codigo_canton']
-
-    def generate_data(self, element, option):
+    def get_districts(self):
+        """Returns a list of (electoral code, province, canton, district) in the same order as get_districts_information"""
+        return list(DistritoElectoral.objects.values_list('codigo_electoral', 'provincia', 'canton', 'distrito'))
+
+    def iterate_electors_locations(self):
+        """Yields the electoral code and the gender of each elector"""
+        # A server side cursor avoids to load the whole table in memory
+        with self.connection.chunked_cursor() as cursor:
+            cursor.execute(f"SELECT codigo_electoral_id, relleno FROM {self.elector_table_or_collection}")
+            rows = cursor.fetchmany(10000)
+
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(10000)
+
+    def get_province_ids(self):
+        """Returns a dictionary of province => codigo_provincia, fetched with one query"""
+        return dict(VotantesPorProvincia.objects.values_list('provincia', 'codigo_provincia'))
+
+    def get_canton_ids(self):
+        """Returns a dictionary of (province, canton) => codigo_canton, fetched with one query"""
+        cantons = VotantesPorCanton.objects.values_list('codigo_provincia__provincia', 'canton', 'codigo_canton')
+        return {(province, canton): canton_id for province, canton, canton_id in cantons}
+
+    def generate_data(self, element, option, ids=None):
+        """ Returns the model instance to insert in the stats of the option given as a parameter.
+            ids is the dictionary of the parent level returned by get_province_ids or get_canton_ids
+        """
         new_element = ()
 
         if (option == 'province'):
@@ -125,11 +543,11 @@ class PostgreConnection(Connection):
 
         elif(option == 'canton'):
             new_element = (VotantesPorCanton(canton=element['canton'], total_votantes=element['total_votantes'], total_votantes_hombres=element[
-                'total_votantes_hombres'], total_votantes_mujeres=element['total_votantes_mujeres'], codigo_provincia_id=self.get_province_id(element['provincia'])))
+                'total_votantes_hombres'], total_votantes_mujeres=element['total_votantes_mujeres'], codigo_provincia_id=ids[element['provincia']]))
 
         elif (option == 'district'):
             new_element = (VotantesPorDistrito(distrito=element['distrito'], total_votantes=element['total_votantes'], total_votantes_hombres=element[
-                'total_votantes_hombres'], total_votantes_mujeres=element['total_votantes_mujeres'], codigo_canton_id=self.get_canton_id(element['provincia'], element['canton'])))
+                'total_votantes_hombres'], total_votantes_mujeres=element['total_votantes_mujeres'], codigo_canton_id=ids[(element['provincia'], element['canton'])]))
 
         yield new_element
 
@@ -153,11 +571,112 @@ class PostgreConnection(Connection):
             codigo_canton__canton=canton,
             codigo_canton__codigo_provincia__provincia=province).values(*statistics_names)
 
+        # The number of electors of each expiration date is precomputed by compute_statistics
+        same_id_count = VotantesPorFechaCaducidad.objects.filter(fecha_caducidad=expiration_date).values_list('total_votantes', flat=True)
         identification_statistics = {
-            'same_id_count': Elector.objects.filter(fecha_caducidad=expiration_date).count()
+            'same_id_count': same_id_count[0] if same_id_count else 0
         }
 
         return {'province_statistics': province_statistics[0],
                 'canton_statistics': canton_statistics[0],
                 'district_statistics': district_statistics[0],
                 'id_statistics': identification_statistics}
+
+    def iterate_electors(self, sort=False):
+        """ Yields each elector as a tuple of strings in the same order and format of the padron file, sorted by cedula when sort is True.
+            The expiration date is taken in TIME_ZONE, the load stores it at 18:00 UTC and Elector.save at 18:00 of TIME_ZONE,
+            both are the same day there
+        """
+        sql = (f"SELECT cedula, codigo_electoral_id, relleno, to_char(fecha_caducidad AT TIME ZONE %s, 'YYYYMMDD'), "
+               f"junta, nombre, primer_apellido, segundo_apellido FROM {self.elector_table_or_collection}")
+
+        if sort:
+            sql += " ORDER BY cedula"
+
+        # A server side cursor avoids to load the whole table in memory
+        with self.connection.chunked_cursor() as cursor:
+            cursor.execute(sql, [TIME_ZONE])
+            rows = cursor.fetchmany(10000)
+
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(10000)
+
+    def get_electors_locations(self, id_cards):
+        """Returns a dictionary with the electoral code, the gender and the expiration date of each id card given as a parameter"""
+        electors = Elector.objects.filter(cedula__in=list(id_cards)).values_list('cedula', 'codigo_electoral_id', 'relleno', 'fecha_caducidad')
+        return {id_card: (code, gender, expiration_date) for id_card, code, gender, expiration_date in electors}
+
+    def delete_electors(self, id_cards):
+        """Deletes the electors of the id cards given as a parameter without updating the statistics.
+            It uses sql to avoid the post_delete signals of the electors
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.elector_table_or_collection} WHERE cedula = ANY(%s)", [list(id_cards)])
+            self.connection.commit()
+
+    def replace_electors(self, data):
+        """ Replaces the electors of the rows given as a parameter, deleting them and loading them again with COPY in one transaction.
+            Returns the id cards of the replaced electors, none when the transaction fails
+        """
+        table, columns = self.files_columns['padron']
+        id_cards = [element[0] for element in data]
+
+        try:
+            with transaction.atomic(), self.connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE cedula = ANY(%s)", [id_cards])
+                cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", self.get_csv_buffer(data))
+
+            return id_cards
+
+        except Exception as error:
+            print(f"--- {len(data)} electors could not be replaced in {table}: {error}")
+            return []
+
+    def insert_expiration_dates_statistics(self, expiration_dates=None):
+        """ Inserts the number of electors of each id card expiration date.
+            Without expiration_dates they are counted with a single INSERT ... SELECT, so the electors do not leave the database.
+            The dates of the file are given as YYYYMMDD strings and postgres casts them in the same way as the COPY of the load
+        """
+        table = self.expiration_date_stats_table_or_collection
+
+        with self.connection.cursor() as cursor:
+            if expiration_dates is None:
+                cursor.execute(f"INSERT INTO {table} (fecha_caducidad, total_votantes) "
+                               f"SELECT fecha_caducidad, COUNT(*) FROM {self.elector_table_or_collection} GROUP BY fecha_caducidad")
+
+            else:
+                cursor.executemany(f"INSERT INTO {table} (fecha_caducidad, total_votantes) VALUES (%s, %s)", list(expiration_dates.items()))
+
+            self.connection.commit()
+
+    def apply_expiration_dates_deltas(self, deltas):
+        """Adds to the number of electors of each id card expiration date the changes given as a parameter, the dates that do not exist are inserted"""
+        table = self.expiration_date_stats_table_or_collection
+        sql = (f"INSERT INTO {table} (fecha_caducidad, total_votantes) VALUES (%s, %s) "
+               f"ON CONFLICT (fecha_caducidad) DO UPDATE SET total_votantes = {table}.total_votantes + EXCLUDED.total_votantes")
+
+        with transaction.atomic(), self.connection.cursor() as cursor:
+            cursor.executemany(sql, [(date, delta) for date, delta in deltas.items() if delta != 0])
+
+    def apply_statistics_deltas(self, deltas):
+        """ Adds to the stats of each district, canton and province the changes given as a parameter.
+            The changes of the districts are grouped by canton and province, so each row is updated once with F() expressions
+        """
+        districts = DistritoElectoral.objects.filter(codigo_electoral__in=list(deltas)).values('codigo_electoral', 'provincia', 'canton', 'distrito')
+        province_deltas, canton_deltas, district_deltas = self.group_statistics_deltas(districts, deltas)
+
+        levels = [(VotantesPorProvincia.objects, ['provincia'], province_deltas),
+                  (VotantesPorCanton.objects, ['codigo_provincia__provincia', 'canton'], canton_deltas),
+                  (VotantesPorDistrito.objects, ['codigo_canton__codigo_provincia__provincia', 'codigo_canton__canton', 'distrito'], district_deltas)]
+
+        with transaction.atomic():
+            for manager, fields, level_deltas in levels:
+                for key, (male_delta, female_delta) in level_deltas.items():
+                    if male_delta == 0 and female_delta == 0:
+                        continue
+
+                    manager.filter(**dict(zip(fields, key))).update(
+                        total_votantes=F('total_votantes') + male_delta + female_delta,
+                        total_votantes_hombres=F('total_votantes_hombres') + male_delta,
+                        total_votantes_mujeres=F('total_votantes_mujeres') + female_delta)
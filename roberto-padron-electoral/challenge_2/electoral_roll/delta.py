@@ -0,0 +1,102 @@
+import zlib
+
+
+class ElectoralRollDelta:
+    """ Compares a new padron file with the electors stored in the database and applies only the differences.
+        The stored electors are kept in memory as a dictionary of id card => checksum of the row,
+        so each row of the file is compared with a dictionary lookup
+    """
+
+    def __init__(self, connection, batch_size=10000):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.stored_checksums = {}
+        self.electors_to_insert = []
+        self.electors_to_update = []
+        self.id_cards_to_delete = []
+        # Id cards that apply actually wrote in the database
+        self.inserted_id_cards = []
+        self.updated_id_cards = []
+        self.deleted_id_cards = []
+
+    @staticmethod
+    def get_checksum(row):
+        return zlib.crc32('|'.join(row).encode('utf-8'))
+
+    def load_stored_electors(self):
+        """Reads the checksum of each elector stored in the database"""
+        for row in self.connection.iterate_electors():
+            self.stored_checksums[int(row[0])] = self.get_checksum(row)
+
+    def compare_row(self, data_row):
+        """Classifies a row of the padron file as a new elector, a changed elector or an elector without changes"""
+        row = tuple(field.strip() for field in data_row[:8])
+        stored_checksum = self.stored_checksums.pop(int(row[0]), None)
+
+        if stored_checksum is None:
+            self.electors_to_insert.append(row)
+
+        elif stored_checksum != self.get_checksum(row):
+            self.electors_to_update.append(row)
+
+    def finish_comparison(self):
+        """The stored electors that were not found in the file are the ones to delete"""
+        # The id cards always have 9 digits
+        self.id_cards_to_delete = [f"{id_card:09d}" for id_card in self.stored_checksums]
+        self.stored_checksums = {}
+
+    def get_batches(self, data):
+        for i in range(0, len(data), self.batch_size):
+            yield data[i:i + self.batch_size]
+
+    def add_statistics_deltas(self, locations, quantity):
+        """ Adds the quantity to the male or female voters of the electoral code and to the electors of the expiration date of each location.
+            locations are (electoral code, gender, expiration date) as get_electors_locations returns them
+        """
+        for code, gender, expiration_date in locations:
+            self.expiration_dates_deltas[expiration_date] = self.expiration_dates_deltas.get(expiration_date, 0) + quantity
+
+            # As in the load, only the genders 1 and 2 are counted in the stats of the districts
+            if gender in ('1', '2'):
+                self.deltas.setdefault(code, [0, 0])[int(gender) - 1] += quantity
+
+    def apply(self):
+        """ Applies the differences to the electors and to the stats.
+            The stats only change for the electors that were actually deleted, replaced or inserted, which are read again from the database
+            after each batch, so a batch that fails leaves the stats in step with the electors
+        """
+        # Change of [male, female] voters of each electoral code and change of electors of each expiration date
+        self.deltas = {}
+        self.expiration_dates_deltas = {}
+
+        try:
+            for id_cards in self.get_batches(self.id_cards_to_delete):
+                old_locations = self.connection.get_electors_locations(id_cards)
+                self.connection.delete_electors(id_cards)
+                self.add_statistics_deltas(old_locations.values(), -1)
+                self.deleted_id_cards.extend(old_locations)
+
+            # A changed elector is replaced in one operation, so it is never lost between a delete and an insert
+            for rows in self.get_batches(self.electors_to_update):
+                old_locations = self.connection.get_electors_locations([row[0] for row in rows])
+                data = [self.connection.handle_row_to_insert(list(row), 'padron') for row in rows]
+                replaced_id_cards = self.connection.replace_electors(data)
+
+                # An elector deleted by someone else after the comparison is inserted again, so it only adds to the stats
+                self.add_statistics_deltas([old_locations[id_card] for id_card in replaced_id_cards if id_card in old_locations], -1)
+                self.add_statistics_deltas(self.connection.get_electors_locations(replaced_id_cards).values(), 1)
+                self.updated_id_cards.extend(replaced_id_cards)
+
+            for rows in self.get_batches(self.electors_to_insert):
+                data = [self.connection.handle_row_to_insert(list(row), 'padron') for row in rows]
+                self.connection.bulk_insert(data, 'padron')
+
+                # COPY and insert_many can store only a part of the rows, the ones that were stored are read again
+                new_locations = self.connection.get_electors_locations([row[0] for row in rows])
+                self.add_statistics_deltas(new_locations.values(), 1)
+                self.inserted_id_cards.extend(new_locations)
+
+        finally:
+            # The changes of the batches that were written are applied even if a later batch raises
+            self.connection.apply_statistics_deltas(self.deltas)
+            self.connection.apply_expiration_dates_deltas(self.expiration_dates_deltas)
@@ -0,0 +1,42 @@
+import time
+from django.core.management.base import BaseCommand
+from electoral_roll.bulk_electors import BulkElectors
+from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from challenge_2.settings import DB_ENGINE
+
+
+class Command(BaseCommand):
+    help = ('Adds or removes many electors and updates the stats once for each affected district, canton and province. Example to use : '
+            'create <file_name> <file_encoding> or delete <file_name> <file_encoding>\n'
+            'To create, the file has the same format as the padron. To delete, the file has an id card in each line')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', type=str, choices=['create', 'delete'],
+                            help='Indicates if the electors of the file are created or deleted')
+        parser.add_argument('file', type=str,
+                            help='Indicates the name of the file')
+        parser.add_argument('file_encoding', type=str,
+                            help='Indicates the encoding of the file')
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Indicates how many electors are written with each query')
+
+    def handle(self, *args, **kwargs):
+        connection = DBConnectionProducer.get_connection(DB_ENGINE)
+        bulk_electors = BulkElectors(connection, kwargs['batch_size'])
+        start_time = time.time()
+
+        with open(kwargs['file'], mode='r', encoding=kwargs['file_encoding']) as file:
+            rows = [line.rstrip('\r\n').split(',') for line in file if line.strip()]
+
+        if kwargs['action'] == 'create':
+            created = bulk_electors.create(rows)
+            print(f"--- {created} electors were created ---")
+
+            for row in bulk_electors.rejected_rows:
+                print(f"--- The elector {row[0]} was rejected: it already exists or its data is not valid")
+
+        else:
+            deleted = bulk_electors.delete([row[0] for row in rows])
+            print(f"--- {deleted} electors were deleted ---")
+
+        print(f"--- The entire process took %s seconds with {connection.engine} ---" % (time.time() - start_time))
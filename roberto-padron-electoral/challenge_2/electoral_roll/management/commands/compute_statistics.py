@@ -2,13 +2,14 @@ import time
 from django.core.management.base import BaseCommand, CommandError
 from electoral_roll.models import Elector, DistritoElectoral, VotantesPorProvincia, VotantesPorCanton, VotantesPorDistrito
 from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from electoral_roll.columnar import import_pyarrow, read_columns, count_rows, FILES_COLUMNS
 from challenge_2.settings import DB_ENGINE
 # import bson
 # from datetime import datetime
 
 
 class Command(BaseCommand):
-    help = 'Compute statistics for each province and canton and load them into a databse. No arguments needed'
+    help = 'Compute statistics for each province and canton and load them into a databse. No arguments needed, use --engine numpy for the vectorized engine'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -30,29 +31,46 @@ class Command(BaseCommand):
 
         self.connection = DBConnectionProducer.get_connection(DB_ENGINE)
 
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', type=str, choices=['loop', 'numpy'], default='loop',
+                            help='Indicates how the stats are computed. numpy counts the voters with vectorized operations and needs numpy installed')
+        parser.add_argument('--columnar', type=str, nargs=2, metavar=('PADRON', 'DISTELEC'),
+                            help='Computes the stats from the parquet files of convert_electoral_roll instead of the database, with the numpy engine')
+        parser.add_argument('--reset', type=str, choices=['delete', 'truncate'], default='delete',
+                            help='Indicates how the old stats are removed. truncate empties the stats tables at once')
+
     def handle(self, *args, **kwargs):
-        self.clean_statistics()
+        self.clean_statistics(kwargs['reset'] == 'truncate')
         
         print("--- Starting statistics process.... ---")
 
         start_time = time.time()
 
-        self.compute_statistics()
+        if kwargs['engine'] == 'numpy' or kwargs['columnar']:
+            self.compute_statistics_vectorized(kwargs['columnar'])
+
+        else:
+            self.compute_statistics()
 
         print("--- The entire process took %s seconds ---" %
               (time.time() - start_time))
 
     ############################## MY FUNCTIONS  ###########################
 
-    def compute_statistics(self):
+    def compute_statistics(self, data=None, expiration_dates=None):
+        """ Computes and inserts the stats of the districts given as a parameter.
+            Without districts, the districts and their count of voters are taken from the database.
+            expiration_dates is the number of electors of each id card expiration date, without it they are counted in the database
+        """
         
         # Gets all the districts and their information
-        data = self.connection.get_districts_information()
-        print("--- Districts obtained ---")
+        if data is None:
+            data = self.connection.get_districts_information()
+            print("--- Districts obtained ---")
 
-        # The last district in the list
-        last_element = len(data) - 1
-        last_canton = data[last_element].canton
+        if not data:
+            print("--- There are no districts, the stats were not computed ---")
+            return
 
         # The first province and canton in the list
         self.province = data[0].provincia
@@ -60,21 +78,9 @@ class Command(BaseCommand):
 
         print("--- Calculating stats ---")
         for district in data:
-            #Creates each district tuple
-            total_voters = district.total_hombres + district.total_mujeres
-            district_tuple_data = self.assign_tuple_values('distrito', district.distrito, total_voters, district.total_hombres, district.total_mujeres, district.provincia,district.canton)
-            self.district_statistics.append(district_tuple_data)
-            
-            if(district.canton == last_canton):
-                # Creates the last canton tuple and adds it to a list
-                total_voters_last_canton = district.total_hombres + district.total_mujeres
-                canton_tuple_data = self.assign_tuple_values('canton', district.canton, total_voters_last_canton, district.total_hombres, district.total_mujeres, district.provincia)
-                self.canton_statistics.append(canton_tuple_data)
-
-                # Creates the last province tuple and adds it to a list
-                self.add_province(district.provincia)
-
-            if(district.canton != self.canton):
+            # The districts are sorted by electoral code, so a canton ends when the next district has another canton or province.
+            # Two provinces can have a canton with the same name
+            if(district.canton != self.canton or district.provincia != self.province):
                 # Creates each canton tuple and adds it to a list
                 self.add_canton(district.canton)
 
@@ -82,11 +88,109 @@ class Command(BaseCommand):
                 # Creates each province tuple and adds it to a list
                 self.add_province(district.provincia)
 
+            #Creates each district tuple
+            total_voters = district.total_hombres + district.total_mujeres
+            district_tuple_data = self.assign_tuple_values('distrito', district.distrito, total_voters, district.total_hombres, district.total_mujeres, district.provincia,district.canton)
+            self.district_statistics.append(district_tuple_data)
+
             self.manage_statistic_counters('canton', 'increase', district.total_hombres, district.total_mujeres)
 
+        # The last canton and province end with the list
+        self.add_canton(None)
+        self.add_province(None)
+
         print("--- Stats done ---")
 
-        self.bulk_insert()
+        self.bulk_insert(expiration_dates)
+
+    def compute_statistics_vectorized(self, columnar_files=None):
+        """ Computes the stats with numpy instead of walking the districts one by one.
+            The voters are loaded as an integer array of electoral code * 3 + gender and counted with bincount,
+            the cantons and provinces are the sum of their districts. It does not depend on the order of the districts.
+            columnar_files are the padron and distelec parquet files, without them the voters are read from the database
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            raise CommandError('The numpy engine needs numpy installed')
+
+        expiration_dates = None
+
+        if columnar_files is None:
+            districts = self.connection.get_districts()
+            print("--- Districts obtained ---")
+
+            # Gender slot: '1' => male, '2' => female, any other value goes to a third slot that is not counted
+            genders = {'1': 0, '2': 1}
+            locations = np.fromiter((int(code) * 3 + genders.get(gender, 2) for code, gender in self.connection.iterate_electors_locations()),
+                                    dtype=np.int64)
+
+        else:
+            try:
+                districts, locations, expiration_dates = self.read_columnar_files(np, *columnar_files)
+            except ImportError:
+                raise CommandError('The parquet files need pyarrow installed')
+
+        print("--- Electors obtained ---")
+
+        if not districts:
+            print("--- There are no districts, the stats were not computed ---")
+            return
+
+        # Each electoral code is mapped to the position of its district in the list
+        codes = np.array([int(district[0]) for district in districts], dtype=np.int64)
+        district_positions = np.full(codes.max() + 1, -1, dtype=np.int64)
+        district_positions[codes] = np.arange(len(districts))
+
+        # Electors of codes that are not in the districts are not counted
+        locations = locations[locations // 3 <= codes.max()]
+        positions = district_positions[locations // 3]
+        valid = positions >= 0
+        district_counts = np.bincount(positions[valid] * 3 + locations[valid] % 3, minlength=len(districts) * 3).reshape(-1, 3)[:, :2]
+
+        print("--- Calculating stats ---")
+        canton_keys = [(district[1], district[2]) for district in districts]
+        province_keys = [(district[1],) for district in districts]
+
+        for district, (male_count, female_count) in zip(districts, district_counts.tolist()):
+            self.district_statistics.append(self.assign_tuple_values('distrito', district[3], male_count + female_count, male_count, female_count, district[1], district[2]))
+
+        for (province, canton), (male_count, female_count) in self.sum_by_key(np, canton_keys, district_counts):
+            self.canton_statistics.append(self.assign_tuple_values('canton', canton, male_count + female_count, male_count, female_count, province))
+
+        for (province,), (male_count, female_count) in self.sum_by_key(np, province_keys, district_counts):
+            self.provinces_statistics.append(self.assign_tuple_values('provincia', province, male_count + female_count, male_count, female_count))
+
+        print("--- Stats done ---")
+
+        self.bulk_insert(expiration_dates)
+
+    def read_columnar_files(self, np, padron_file_name, distelec_file_name):
+        """ Returns the districts, the array of electoral code * 3 + gender and the number of electors of each expiration date
+            of the parquet files. The columns go from arrow to numpy without a python object for each elector
+        """
+        pa = import_pyarrow()
+        districts = [tuple(row.values()) for row in read_columns(distelec_file_name, FILES_COLUMNS['distelec']).to_pylist()]
+        padron = read_columns(padron_file_name, ['codigo_electoral', 'relleno', 'fecha_caducidad'])
+
+        codes = padron['codigo_electoral'].cast(pa.int64()).to_numpy()
+        is_male = pa.compute.equal(padron['relleno'], '1').fill_null(False).to_numpy()
+        is_female = pa.compute.equal(padron['relleno'], '2').fill_null(False).to_numpy()
+        # Gender slot: '1' => male, '2' => female, any other value goes to a third slot that is not counted
+        gender_slots = np.where(is_male, 0, np.where(is_female, 1, 2))
+
+        return districts, codes * 3 + gender_slots, count_rows(padron, ['fecha_caducidad'])
+
+    def sum_by_key(self, np, keys, counts):
+        """Sums the rows of counts that have the same key. Returns the keys in order of appearance with their sums"""
+        unique_keys = list(dict.fromkeys(keys))
+        key_positions = {key: position for position, key in enumerate(unique_keys)}
+        groups = np.array([key_positions[key] for key in keys], dtype=np.int64)
+
+        sums = np.zeros((len(unique_keys), 2), dtype=np.int64)
+        np.add.at(sums, groups, counts)
+
+        return zip(unique_keys, sums.tolist())
 
     def add_province(self, new_province):
         self.province_voter_counter[0] = self.province_voter_counter[1] + self.province_voter_counter[2]
@@ -142,20 +246,25 @@ class Command(BaseCommand):
                 self.canton_voter_counter[2] += canton_female_count
 
 
-    def bulk_insert(self):
+    def bulk_insert(self, expiration_dates=None):
+        # The ids of each level are fetched once after it is inserted, so the children do not query their parent one by one
         self.connection.bulk_insert(next(self.data_set_generator(self.provinces_statistics ,'province')),'province_stats')
-        self.connection.bulk_insert(next(self.data_set_generator(self.canton_statistics ,'canton')),'canton_stats')
-        self.connection.bulk_insert(next(self.data_set_generator(self.district_statistics ,'district')),'district_stats')
+        province_ids = self.connection.get_province_ids()
+        self.connection.bulk_insert(next(self.data_set_generator(self.canton_statistics ,'canton', province_ids)),'canton_stats')
+        canton_ids = self.connection.get_canton_ids()
+        self.connection.bulk_insert(next(self.data_set_generator(self.district_statistics ,'district', canton_ids)),'district_stats')
+        # voting_info reads the number of electors with the same expiration date from here instead of counting them
+        self.connection.insert_expiration_dates_statistics(expiration_dates)
 
-    def clean_statistics(self):
-        self.connection.clean_database('stats')
+    def clean_statistics(self, truncate=False):
+        self.connection.clean_database('stats', truncate)
 
-    def data_set_generator(self,data, option):
+    def data_set_generator(self,data, option, ids=None):
         elements_to_insert = []
 
         for element in data:
 
-            new_element = self.connection.generate_data(element,option)
+            new_element = self.connection.generate_data(element,option, ids)
             elements_to_insert.append(next(new_element))
 
         yield elements_to_insert
@@ -0,0 +1,34 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from electoral_roll.columnar import convert_file
+
+
+class Command(BaseCommand):
+    help = ('Parses the two TSE files once and writes them as parquet files that load_electoral_roll and compute_statistics can read. '
+            'Example to use : <file_name_1> <file_name_2> <files_encoding>. It needs pyarrow installed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file_1', type=str,
+                            help='Indicates the name of the largest file')
+        parser.add_argument('file_2', type=str,
+                            help='Indicates the name of the smallest file')
+        parser.add_argument('files_encoding', type=str,
+                            help='Indicates the encoding of the files')
+        parser.add_argument('--output-dir', type=str, default='.',
+                            help='Indicates the directory where the parquet files are written')
+
+    def handle(self, *args, **kwargs):
+        start_time = time.time()
+
+        for file_name, option_file in [(kwargs['file_1'], 'padron'), (kwargs['file_2'], 'distelec')]:
+            output_file_name = os.path.join(kwargs['output_dir'], os.path.splitext(os.path.basename(file_name))[0] + '.parquet')
+            print(f"--- Converting {file_name} to {output_file_name} ---")
+
+            try:
+                convert_file(file_name, kwargs['files_encoding'], option_file, output_file_name)
+
+            except ImportError:
+                raise CommandError('convert_electoral_roll needs pyarrow installed')
+
+        print("--- The entire process took %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from electoral_roll.database_manager.mmap_index import write_index
+from challenge_2.settings import DB_ENGINE, MMAP_INDEX_FILE
+
+
+class Command(BaseCommand):
+    help = 'Exports the electors and districts of the database to the read-only index file of the mmap engine. No arguments needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', type=str, choices=['mongo', 'postgre'], default=DB_ENGINE if DB_ENGINE != 'mmap' else None,
+                            help='Indicates the database where the electors are read')
+        parser.add_argument('--output', type=str, default=MMAP_INDEX_FILE,
+                            help='Indicates the name of the index file')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['engine'] is None:
+            raise CommandError('The electors can not be exported from the mmap engine, use --engine mongo or --engine postgre')
+
+        connection = DBConnectionProducer.get_connection(kwargs['engine'])
+        start_time = time.time()
+
+        print(f"--- Exporting the electors of {connection.engine} to {kwargs['output']} ---")
+
+        try:
+            electors, skipped_electors = write_index(kwargs['output'], connection.get_districts(), connection.iterate_electors(sort=True))
+        except ValueError as error:
+            raise CommandError(f"The index was not exported: {error}")
+
+        print(f"--- {electors} electors were exported ---")
+
+        if skipped_electors:
+            print(f"--- {skipped_electors} electors were skipped because their electoral code is not in the districts ---")
+        print("--- The entire process took %s seconds ---" % (time.time() - start_time))
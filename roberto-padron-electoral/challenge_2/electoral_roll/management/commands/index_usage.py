@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from challenge_2.settings import DB_ENGINE
+
+
+class Command(BaseCommand):
+    help = 'Shows how many times each index of the electoral roll was used. No arguments needed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create', action='store_true',
+                            help='Creates the missing indexes before to show the usage')
+
+    def handle(self, *args, **kwargs):
+        connection = DBConnectionProducer.get_connection(DB_ENGINE)
+
+        if kwargs['create']:
+            connection.create_indexes()
+
+        for table_or_collection, index_name, uses in connection.get_index_usage():
+            print(f"{table_or_collection:40} {index_name:45} {uses}")
@@ -1,18 +1,64 @@
 # import memory_profiler
+import io
+import os
 import time
+import queue
+import resource
 import threading
+import multiprocessing
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
 
+import django
 from django.core.management.base import BaseCommand, CommandError
 from electoral_roll.models import DistritoElectoral, Elector
 from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from electoral_roll.checkpoint import ImportCheckpoint
+from electoral_roll.delta import ElectoralRollDelta
+from electoral_roll.columnar import is_columnar_file, iterate_batches, read_columns, count_rows, FILES_COLUMNS
+from electoral_roll.database_manager.connection import DistrictInformation
+from electoral_roll.management.commands.compute_statistics import Command as ComputeStatisticsCommand
 from challenge_2.settings import DB_ENGINE
 
+
+def parse_shard(file_name, encoding, start, end, option_file):
+    """
+        Parses the rows between two byte offsets of the file in a worker process.
+        The offsets are always at the beginning of a line, so each shard has only complete rows
+    """
+    connection = DBConnectionProducer.get_connection(DB_ENGINE)
+
+    with open(file_name, mode='rb') as file:
+        file.seek(start)
+        raw_data = file.read(end - start)
+
+    # newline=None translates the line endings in the same way that the text mode of open() does
+    lines = io.StringIO(raw_data.decode(encoding), newline=None)
+
+    return [connection.handle_row_to_insert(row.split(','), option_file) for row in lines]
+
+
 class Command(BaseCommand):
     help = 'Load two files to a database. Example to use : <file_name_1> <file_name_2> <files_encoding>\n It is necessary to type the file name with its extension : data.txt'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.threads = list()
+        self.chunks_queue = None
+        self.workers_stats = {}
+        # List of (option file, chunk index) of the chunks that a worker could not insert
+        self.failed_chunks = []
+        self.failed_chunks_lock = threading.Lock()
+        # Byte offset where the last yielded chunk ends in the file
+        self.chunk_end_offset = 0
+        self.checkpoint = ImportCheckpoint('load_electoral_roll.checkpoint')
+        self.resume = False
+        # Count of electors by (electoral code, gender) when the stats are computed during the load
+        self.location_counter = None
+        self.expiration_date_counter = None
+        self.counters_lock = threading.Lock()
+        # List of (phase, seconds) of the load
+        self.phases_times = []
         self.connection = DBConnectionProducer.get_connection(DB_ENGINE)
 
 
@@ -23,6 +69,26 @@ class Command(BaseCommand):
                             help='Indicates the name of the smallest file')
         parser.add_argument('files_encoding', type=str,
                             help='Indicates the encoding of the files')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Indicates how many threads insert the chunks into the database')
+        parser.add_argument('--parse-workers', type=int, default=1,
+                            help='Indicates how many processes parse the files. With 1 the files are parsed in the main process')
+        parser.add_argument('--queue-size', type=int, default=2,
+                            help='Indicates how many parsed chunks can wait for a free worker before the parser blocks')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continues a previous import skipping the chunks that were already committed. Use the same options as the interrupted import')
+        parser.add_argument('--delta', action='store_true',
+                            help='Compares the electoral roll file with the electors in the database and applies only the differences, updating the stats')
+        parser.add_argument('--name-index', action='store_true',
+                            help='Builds the index of the similar names search after the load')
+        parser.add_argument('--reset', type=str, choices=['delete', 'truncate'], default='delete',
+                            help='Indicates how the database is cleaned before the load. truncate empties the tables at once without signals, and removes the stats too')
+        parser.add_argument('--defer-indexes', action='store_true',
+                            help='Drops the secondary indexes and foreign keys of the electors before the load and builds them in parallel at the end. Mongo always does it')
+        parser.add_argument('--shadow', action='store_true',
+                            help='Loads the files and the stats into shadow tables or collections and swaps them with the live ones at the end, so the searches keep working during the load')
+        parser.add_argument('--compute-statistics', action='store_true',
+                            help='Counts the voters while the files are loaded and inserts the stats at the end, so compute_statistics is not needed')
 
     def handle(self, *args, **kwargs):
 
@@ -38,32 +104,187 @@ class Command(BaseCommand):
         key_file_2 = "distelec"
 
         chunk_size = 600000 
-        print(f"--- Starting the process to clean the database")
-        self.clean_database()
+        self.resume = kwargs['resume']
+
+        if kwargs['workers'] < 1:
+            raise CommandError('--workers must be at least 1, without workers nobody takes the chunks from the queue')
+
+        columnar = is_columnar_file(electoral_roll) and is_columnar_file(electoral_district)
+
+        if columnar and (self.resume or kwargs['delta']):
+            raise CommandError('The parquet files are loaded whole, they can not be used with --resume or --delta')
+
+        if is_columnar_file(electoral_roll) != is_columnar_file(electoral_district):
+            raise CommandError('Both files must be parquet files created by convert_electoral_roll or both text files')
+
+        if kwargs['shadow'] and (self.resume or kwargs['delta']):
+            raise CommandError('--shadow loads the whole files, it can not be used with --resume or --delta')
+
+        if kwargs['delta']:
+            if self.resume:
+                raise CommandError('--delta and --resume can not be used together')
+
+            self.import_delta(electoral_roll, encoding)
+
+            if kwargs['name_index']:
+                self.build_name_index()
+
+            return
+
+        # The shadow tables are swapped with their stats, so they are always computed
+        if kwargs['compute_statistics'] or kwargs['shadow']:
+            if self.resume:
+                raise CommandError('--compute-statistics needs to read the whole file, it can not be used with --resume')
+
+            self.location_counter = Counter()
+            self.expiration_date_counter = Counter()
+
+        if self.resume:
+            self.checkpoint.load()
+            print(f"--- Resuming the process from {self.checkpoint.file_name}")
+
+        elif kwargs['shadow']:
+            print(f"--- Creating the shadow tables")
+            self.checkpoint.reset()
+            self.run_phase('shadow tables', self.connection.prepare_shadow_load)
+
+            if kwargs['defer_indexes'] or self.connection.engine == 'mongo':
+                self.run_phase('drop indexes', self.connection.drop_indexes)
+
+        else:
+            print(f"--- Starting the process to clean the database")
+            self.checkpoint.reset()
+            self.run_phase('clean', self.clean_database, kwargs['reset'] == 'truncate')
+
+            # The indexes are built once after the load instead of being updated with each insert
+            if kwargs['defer_indexes'] or self.connection.engine == 'mongo':
+                self.run_phase('drop indexes', self.connection.drop_indexes)
 
         print(f"--- Starting the process with {self.connection.engine}")
         start_time = time.time()
 
-        self.import_file_to_database(electoral_district, encoding, chunk_size,key_file_2)
-        self.import_file_to_database(electoral_roll, encoding, chunk_size,key_file_1)
+        # The districts must be in the database before the electors that reference them
+        try:
+            self.run_phase('load distelec', self.load_file, electoral_district, encoding, chunk_size, key_file_2, kwargs)
+            self.run_phase('load padron', self.load_file, electoral_roll, encoding, chunk_size, key_file_1, kwargs)
 
-        for thread in self.threads:
-            thread.join()
+        except CommandError as error:
+            # An incomplete shadow load is never swapped, the live tables keep the previous electoral roll
+            if kwargs['shadow']:
+                raise CommandError(f"{error}. The shadow tables were not swapped, the live ones keep the previous electoral roll")
+
+            raise
+
+        print(f"--- Creating the indexes")
+        self.run_phase('create indexes', self.connection.create_indexes)
+
+        if kwargs['name_index']:
+            self.run_phase('name index', self.build_name_index)
+
+        if self.location_counter is not None:
+            self.run_phase('statistics', self.insert_statistics, electoral_district, encoding, kwargs['reset'] == 'truncate')
+
+        if kwargs['shadow']:
+            print(f"--- Swapping the shadow tables with the live ones")
+            self.run_phase('swap', self.connection.swap_shadow_load)
 
         print(f"--- The entire process took %s seconds with {self.connection.engine} ---" % (time.time() - start_time))
 
+        for phase, seconds in self.phases_times:
+            print(f"--- {phase}: {seconds:.2f} seconds")
+
+        self.print_workers_report()
+
+    def run_phase(self, phase, function, *args):
+        """Runs a phase of the load and keeps the seconds that it took"""
+        start_time = time.time()
+        function(*args)
+        self.phases_times.append((phase, time.time() - start_time))
+
+    def load_file(self, file_name, encoding, chunk_size, option_file, kwargs):
+        """Inserts a file with a pool of workers that is stopped when the whole file is in the queue"""
+        self.start_workers(kwargs['workers'], kwargs['queue_size'])
+
+        try:
+            if is_columnar_file(file_name):
+                self.import_columnar_file_to_database(file_name, chunk_size, option_file)
+
+            else:
+                self.import_file_to_database(file_name, encoding, chunk_size, option_file, kwargs['parse_workers'])
+
+        finally:
+            self.stop_workers()
+
+        self.check_failed_chunks(file_name, option_file)
+
+    def check_failed_chunks(self, file_name, option_file):
+        """ Stops the load when a worker could not insert a chunk of the file, so the next phases do not run with missing rows.
+            The chunks are named as ranges of chunk indexes, like 3, 5-7
+        """
+        chunk_indexes = sorted(chunk_index for failed_option_file, chunk_index in self.failed_chunks if failed_option_file == option_file)
+
+        if not chunk_indexes:
+            return
+
+        ranges = [[chunk_indexes[0], chunk_indexes[0]]]
+
+        for chunk_index in chunk_indexes[1:]:
+            if chunk_index == ranges[-1][1] + 1:
+                ranges[-1][1] = chunk_index
+
+            else:
+                ranges.append([chunk_index, chunk_index])
+
+        ranges = ', '.join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+        self.print_workers_report()
+
+        raise CommandError(f"The chunks {ranges} of {file_name} were not inserted. The text files load again only those chunks with --resume")
+
+    # @profile
+    def import_columnar_file_to_database(self, file_name, chunk_size, option_file):
+        """ Puts in the queue the record batches of a parquet file created by convert_electoral_roll.
+            The rows were parsed by the conversion, so the batches go to the connection without handle_row_to_insert
+        """
+        try:
+            batches = iterate_batches(file_name, chunk_size)
+
+            for chunk_index, batch in enumerate(batches):
+                self.chunks_queue.put((batch, option_file, chunk_index, None))
+
+        except ImportError:
+            raise CommandError('The parquet files need pyarrow installed')
+
     ############################## MY FUNCTIONS TO HANDLE THE FILES ###########################
     
     # @profile
-    def clean_database(self):
+    def clean_database(self, truncate=False):
         """
             Cleans the database to start the process.
             No matters what is the engine of the database
         """
-        self.connection.clean_database('electoral_roll')
+        self.connection.clean_database('electoral_roll', truncate)
 
     # @profile
-    def process_file_in_chunks(self,file_name, encoding, chunk_size , option_file):
+    def read_rows(self, file_name, encoding, start_offset=0):
+        """
+            Yields each line of the file as a list of fields, starting at start_offset.
+            self.read_position returns the offset of the next line to read
+        """
+        with open(file=file_name, mode='r', encoding=encoding) as file:
+            file.seek(start_offset)
+            self.read_position = file.tell
+
+            # readline keeps tell() available, iterating the file with next() disables it
+            for row in iter(file.readline, ''):
+                yield row.split(',')
+
+            end_offset = file.tell()
+
+        # The file is closed at this point, so the last position is kept for the last chunk
+        self.read_position = lambda: end_offset
+
+    # @profile
+    def process_file_in_chunks(self,file_name, encoding, chunk_size , option_file, start_offset=0):
         """
             Processes the file in chunks and yields a chunk according to the chunk_size parameter.
             No matters what is the engine of the database this method handle each row to each specific type of db
@@ -71,44 +292,274 @@ class Command(BaseCommand):
         data_list = []
         count = 0
 
-        with open(file=file_name, mode='r', encoding=encoding) as file:
-            for row in file:
-                row = row.split(',')
-                data_row = self.connection.handle_row_to_insert(row,option_file)
-                data_list.append(data_row)
-
-                if(count == chunk_size):
-                    yield data_list
-                    print(f"{count} elements were yielded")
-                    count = 0
-                    data_list = []
-                
-                count += 1
+        for row in self.read_rows(file_name, encoding, start_offset):
+            data_row = self.connection.handle_row_to_insert(row,option_file)
+            data_list.append(data_row)
+            count += 1
+
+            # Every chunk has exactly chunk_size rows, so a resumed import splits the file in the same chunks
+            if(count == chunk_size):
+                self.chunk_end_offset = self.read_position()
+                yield data_list
+                print(f"{count} elements were yielded")
+                count = 0
+                data_list = []
             
-        yield data_list
-        print(f"{count} elements were yielded")
-        data_list = []
+        if data_list:
+            self.chunk_end_offset = self.read_position()
+            yield data_list
+            print(f"{count} elements were yielded")
+            data_list = []
+
+    # @profile
+    def get_shard_size(self, file_name, chunk_size):
+        """Estimates how many bytes have chunk_size rows, using the length of the first rows of the file"""
+        with open(file_name, mode='rb') as file:
+            sample = file.readlines(1024 * 1024)
+
+        if not sample:
+            return 1
+
+        average_row_size = sum(len(row) for row in sample) / len(sample)
+        return max(int(average_row_size * chunk_size), 1)
+
+    # @profile
+    def get_file_shards(self, file_name, shard_size, start_offset=0):
+        """ Splits the file from start_offset in byte ranges of shard_size that start and end at the beginning of a line.
+            The ranges only depend on where the split starts, so a resumed import gets the same ranges as the first one
+        """
+        file_size = os.path.getsize(file_name)
+        offsets = [start_offset]
+
+        with open(file_name, mode='rb') as file:
+            while offsets[-1] + shard_size < file_size:
+                file.seek(offsets[-1] + shard_size)
+                # Moves to the end of the current line
+                file.readline()
+                offsets.append(file.tell())
+
+        if offsets[-1] < file_size:
+            offsets.append(file_size)
+
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    # @profile
+    def process_file_in_parallel(self, file_name, encoding, chunk_size, option_file, parse_workers, start_offset=0):
+        """
+            Parses the file shards in a process pool and yields a chunk for each shard. Each shard has around chunk_size rows.
+            The shards are yielded in the same order that they have in the file, so the rows are the same as process_file_in_chunks
+        """
+        shards = self.get_file_shards(file_name, self.get_shard_size(file_name, chunk_size), start_offset)
+        pending_shards = deque()
+
+        # The insert threads and the database clients already exist in this process, so the parsers are spawned instead of forked
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup) as executor:
+            for start, end in shards:
+                pending_shards.append((end, executor.submit(parse_shard, file_name, encoding, start, end, option_file)))
+
+                # Only a few shards are parsed ahead so the memory keeps bounded when the writers are slower
+                if len(pending_shards) > parse_workers:
+                    yield from self.yield_shard(*pending_shards.popleft())
+
+            while pending_shards:
+                yield from self.yield_shard(*pending_shards.popleft())
+
+    def yield_shard(self, end, parsed_shard):
+        """Yields the rows of a parsed shard as a chunk"""
+        data = parsed_shard.result()
+        self.chunk_end_offset = end
+        yield data
+        print(f"{len(data)} elements were yielded")
 
     # @profile        
-    def import_file_to_database(self,file_name, encoding, chunk_size,option_file):
-        """ Loop through the file and sends a thread to insert the data into the database"""
-        for data in self.process_file_in_chunks(file_name, encoding, chunk_size,option_file):
-            self.execute_thread(data, option_file)
+    def import_file_to_database(self,file_name, encoding, chunk_size,option_file, parse_workers=1):
+        """ Loop through the file and puts each chunk in the queue, blocking while the workers are busy.
+            When the import is resumed, the chunks that were already committed are skipped
+        """
+        chunk_index, start_offset = 0, 0
+
+        if self.resume:
+            chunk_index, start_offset = self.checkpoint.get_resume_point(option_file)
+            print(f"--- Skipping {chunk_index} committed chunks of {file_name}")
+
+        if parse_workers > 1:
+            chunks = self.process_file_in_parallel(file_name, encoding, chunk_size, option_file, parse_workers, start_offset)
+
+        else:
+            chunks = self.process_file_in_chunks(file_name, encoding, chunk_size, option_file, start_offset)
+
+        for data in chunks:
+            if self.resume and self.checkpoint.is_committed(option_file, chunk_index):
+                # A chunk committed by a worker after an older chunk that was not committed yet
+                if not self.checkpoint.verify(option_file, chunk_index, data):
+                    raise CommandError(f"The chunk {chunk_index} of {file_name} is different from the committed one. The file or the options changed")
+
+            else:
+                if self.resume:
+                    # The chunk could be partially inserted when the previous import stopped
+                    self.connection.clean_chunk(data, option_file)
+
+                self.chunks_queue.put((data, option_file, chunk_index, self.chunk_end_offset))
+
+            chunk_index += 1
+
+    # @profile
+    def build_name_index(self):
+        """Builds the index used by the similar names search"""
+        print(f"--- Building the names index")
+        start_time = time.time()
+        self.connection.build_name_index()
+        print(f"--- The names index took %s seconds" % (time.time() - start_time))
+
+    # @profile
+    def insert_statistics(self, districts_file_name, encoding, truncate=False):
+        """Inserts the stats of the voters counted during the load, without reading the electors again from the database"""
+        print("--- Starting to insert the stats counted during the load ---")
+        districts = []
+
+        if is_columnar_file(districts_file_name):
+            rows = read_columns(districts_file_name, FILES_COLUMNS['distelec']).to_pylist()
+            rows = [list(row.values()) for row in rows]
+
+        else:
+            rows = self.read_rows(districts_file_name, encoding)
+
+        for row in rows:
+            code, province, canton, district = [field.strip() for field in row[:4]]
+            districts.append(DistrictInformation(electoral_code=code, province=province, canton=canton, district=district,
+                                                 male_count=self.location_counter[(code, '1')],
+                                                 female_count=self.location_counter[(code, '2')]))
+
+        # The same order of the districts that get_districts_information returns
+        districts.sort(key=lambda district: district.codigo_electoral)
+
+        statistics_command = ComputeStatisticsCommand()
+        statistics_command.clean_statistics(truncate)
+        statistics_command.compute_statistics(districts, dict(self.expiration_date_counter))
+
+    # @profile
+    def import_delta(self, file_name, encoding):
+        """ Applies to the database only the differences between the electoral roll file and the stored electors.
+            The districts are not compared, a new district needs a full load
+        """
+        print(f"--- Starting the delta process with {self.connection.engine}")
+        start_time = time.time()
+        delta = ElectoralRollDelta(self.connection)
+
+        delta.load_stored_electors()
+        print(f"--- {len(delta.stored_checksums)} stored electors were read")
+
+        for row in self.read_rows(file_name, encoding):
+            delta.compare_row(row)
+
+        delta.finish_comparison()
+        print(f"--- New electors: {len(delta.electors_to_insert)}, changed electors: {len(delta.electors_to_update)}, deleted electors: {len(delta.id_cards_to_delete)}")
+
+        delta.apply()
+        print(f"--- The delta process took %s seconds with {self.connection.engine} ---" % (time.time() - start_time))
 
-    
     # @profile
-    def execute_thread(self, data, option_file):
-        """Activate a thread to insert the data into the database"""
-        t = threading.Thread(target=self.insert_data ,args=(data,option_file))
-        self.threads.append(t)
-        t.start()
+    def start_workers(self, workers, queue_size):
+        """Starts a fixed number of threads that take the chunks from a bounded queue"""
+        self.chunks_queue = queue.Queue(maxsize=queue_size)
+        self.threads = list()
+
+        for _ in range(workers):
+            t = threading.Thread(target=self.insert_data)
+            self.threads.append(t)
+            t.start()
 
     # @profile
-    def insert_data( self, data, option_file):
-        """Performs a bulk insert to the database with each thread"""
-        print(f"--- Starting to insert data with {threading.current_thread().getName()}---")
-        self.connection.bulk_insert(data,option_file)
+    def stop_workers(self):
+        """Sends a stop signal to each worker and waits until all of them finish"""
+        for _ in self.threads:
+            self.chunks_queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+    # @profile
+    def insert_data(self):
+        """Performs a bulk insert to the database for each chunk that the thread takes from the queue"""
+        thread_name = threading.current_thread().getName()
+        stats = self.workers_stats.setdefault(thread_name, {'rows': 0, 'seconds': 0.0})
+
+        while True:
+            item = self.chunks_queue.get()
+
+            if item is None:
+                break
+
+            data, option_file, chunk_index, offset = item
+            print(f"--- Starting to insert data with {thread_name}---")
+            start_time = time.time()
+
+            # A chunk that fails is not recorded in the checkpoint and the worker keeps taking chunks,
+            # otherwise the parser would block forever on the full queue
+            try:
+                inserted = self.insert_chunk(data, option_file, chunk_index, offset)
+
+            except Exception as error:
+                print(f"--- {thread_name} could not insert the chunk {chunk_index} of {option_file}: {error}")
+                inserted = False
+
+            if inserted:
+                stats['rows'] += len(data) if isinstance(data, list) else data.num_rows
+
+            else:
+                with self.failed_chunks_lock:
+                    self.failed_chunks.append((option_file, chunk_index))
+
+            stats['seconds'] += time.time() - start_time
+
+    def insert_chunk(self, data, option_file, chunk_index, offset):
+        """Inserts a chunk taken from the queue and records it in the checkpoint. Returns True when the chunk was inserted"""
+        if isinstance(data, list):
+            # The checksum is taken before the insertion because mongo adds the _id to each document
+            rows, checksum = len(data), self.checkpoint.get_checksum(data)
+
+            if self.connection.bulk_insert(data,option_file):
+                self.checkpoint.commit(option_file, chunk_index, offset, rows, checksum)
+                self.count_inserted_rows(data, option_file)
+                return True
+
+            return False
+
+        # A record batch of a parquet file, they can not be resumed so they are not recorded in the checkpoint
+        if self.connection.bulk_insert_batch(data, option_file):
+            self.count_inserted_rows(data, option_file)
+            return True
+
+        return False
+
+    def count_inserted_rows(self, data, option_file):
+        """ Adds the voters of an inserted chunk to the stats counted during the load.
+            They are counted after the insert, so the rows that the database rejected are not in the stats
+        """
+        if self.location_counter is None or option_file != 'padron':
+            return
+
+        if isinstance(data, list):
+            locations = Counter(map(self.connection.get_row_location, data))
+            expiration_dates = Counter(map(self.connection.get_row_expiration_date, data))
+
+        else:
+            locations = count_rows(data, ['codigo_electoral', 'relleno'])
+            expiration_dates = count_rows(data, ['fecha_caducidad'])
+
+        with self.counters_lock:
+            self.location_counter.update(locations)
+            self.expiration_date_counter.update(expiration_dates)
+
+    def print_workers_report(self):
+        """Prints the throughput of each worker and the peak memory used by the process"""
+        for thread_name, stats in self.workers_stats.items():
+            rows_per_second = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+            print(f"--- {thread_name}: {stats['rows']} rows in {stats['seconds']:.2f} seconds ({rows_per_second:.0f} rows/s) ---")
 
+        # ru_maxrss is given in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"--- Peak memory usage: {peak_rss:.1f} MB ---")
 
 
 ###################################################################################################################
@@ -0,0 +1,31 @@
+from django.contrib.postgres.operations import TrigramExtension, UnaccentExtension
+from django.db import migrations
+
+# unaccent is not immutable because its dictionary could change, so the indexes are built on an immutable wrapper
+# that always uses the unaccent dictionary of the public schema
+CREATE_UNACCENT_FUNCTION = """
+    CREATE OR REPLACE FUNCTION electoral_roll_unaccent(text) RETURNS text AS
+    $$ SELECT public.unaccent('public.unaccent', $1) $$
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+"""
+
+NAMES_INDEXES = [('elector_nombre_trgm_idx', 'nombre'),
+                 ('elector_primer_trgm_idx', 'primer_apellido'),
+                 ('elector_segundo_trgm_idx', 'segundo_apellido')]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('electoral_roll', '0004_auto_20200807_1235'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        UnaccentExtension(),
+        migrations.RunSQL(CREATE_UNACCENT_FUNCTION, 'DROP FUNCTION IF EXISTS electoral_roll_unaccent(text)'),
+    ] + [
+        migrations.RunSQL(f'CREATE INDEX {name} ON electoral_roll_elector USING gin (electoral_roll_unaccent({field}) gin_trgm_ops)',
+                          f'DROP INDEX IF EXISTS {name}')
+        for name, field in NAMES_INDEXES
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('electoral_roll', '0005_elector_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VotantesPorFechaCaducidad',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fecha_caducidad', models.DateTimeField(unique=True)),
+                ('total_votantes', models.IntegerField()),
+            ],
+            options={
+                'ordering': ['fecha_caducidad'],
+            },
+        ),
+    ]
@@ -3,9 +3,8 @@ from django.db.models import Index
 from django.urls import reverse
 from datetime import datetime
 from challenge_2.settings import DB_ENGINE
-from electoral_roll.database_manager.mongo_connection import MongoConnection
-
-connection =  MongoConnection(DB_ENGINE)
+from electoral_roll.cache import id_card_cache
+from electoral_roll.database_manager.connection import ReadOnlyEngineError
 
 class DistritoElectoral(models.Model):
     codigo_electoral = models.CharField(
@@ -39,10 +38,17 @@ class Elector(models.Model):
 
     # Function to upperCase the elector name
     def save(self, *args, **kwargs):
+        if(DB_ENGINE == 'mmap'):
+            raise ReadOnlyEngineError('The mmap engine is read only, change the data in mongo or postgres and export the index again')
 
         if(DB_ENGINE == 'mongo'):
+            # Imported here because the connections import the models
+            from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+            connection = DBConnectionProducer.get_connection(DB_ENGINE)
             new_data = [self.cedula, self.codigo_electoral.codigo_electoral, self.relleno,self.fecha_caducidad,self.junta,self.nombre.upper(),  self.primer_apellido.upper(), self.segundo_apellido.upper()]
             connection.insert_new_elector(new_data)
+            # After the insert, so a search done in between does not cache the old elector again. The ORM saves invalidate it in post_save
+            id_card_cache.invalidate(self.cedula)
 
         else:
             self.nombre = self.nombre.upper()
@@ -53,6 +59,8 @@ class Elector(models.Model):
 
     
     class Meta:
+        # The trigram indexes of the names are built on electoral_roll_unaccent(name) by the migration 0005,
+        # the indexes of the model can not have expressions
         indexes = [Index(fields=['cedula']),
                    Index(fields=['nombre']),
                    Index(fields=['primer_apellido']),
@@ -103,6 +111,17 @@ class VotantesPorCanton(models.Model):
         return "%s: %d" % (self.canton, self.total_votantes)
 
 
+class VotantesPorFechaCaducidad(models.Model):
+    fecha_caducidad = models.DateTimeField(unique=True)
+    total_votantes = models.IntegerField()
+
+    class Meta:
+        ordering = ['fecha_caducidad']
+
+    def __str__(self):
+        return "%s: %d" % (self.fecha_caducidad, self.total_votantes)
+
+
 class VotantesPorDistrito(models.Model):
     codigo_distrito = models.AutoField(primary_key=True)
     codigo_canton = models.ForeignKey(
@@ -1,5 +1,6 @@
 from .models import Elector, DistritoElectoral, VotantesPorProvincia, VotantesPorCanton
 from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from electoral_roll.cache import id_card_cache
 from challenge_2.settings import DB_ENGINE
 
 
@@ -24,7 +25,31 @@ class Queries:
             result = self.connection.search_by_name(self.elector_name,self.elector_first_surname,self.elector_second_surname)
 
         elif self.elector_option == '2':  # Search by identification
-            result  = self.connection.search_by_id_card(self.elector_identification )
+            result = id_card_cache.get(self.elector_identification)
+
+            if result is None:
+                result  = self.connection.search_by_id_card(self.elector_identification )
+
+                # Only the electors that were found are cached
+                if len(result):
+                    id_card_cache.set(self.elector_identification, result)
 
         return result
 
+    def search_id_cards(self, id_cards, batch_size=1000):
+        """ Searches the electors of a list of id cards with one query for each batch.
+            Yields (id card, searching result) in the same order of the list, the result is None when the elector does not exist
+        """
+        for i in range(0, len(id_cards), batch_size):
+            batch = id_cards[i:i + batch_size]
+            results = self.connection.search_by_id_cards(batch)
+
+            for id_card in batch:
+                yield id_card, results.get(id_card)
+
+    def search_similar_names(self, page=1, page_size=20):
+        """ Searches the electors whose names start with or are similar to the names of the query.
+            Returns a page of results ranked by similarity
+        """
+        return self.connection.search_by_name_fuzzy(self.elector_name, self.elector_first_surname, self.elector_second_surname, page, page_size)
+
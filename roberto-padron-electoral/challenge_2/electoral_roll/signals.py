@@ -1,60 +1,71 @@
+from django.db import connection, transaction
 from django.db.models import F
 from django.dispatch import receiver
 from django.db.models.signals import post_save, post_delete
 
-from .models import Elector, VotantesPorCanton, VotantesPorDistrito, VotantesPorProvincia
+from .models import Elector, VotantesPorCanton, VotantesPorDistrito, VotantesPorProvincia, VotantesPorFechaCaducidad
+from .cache import id_card_cache
+
+def invalidate_cached_elector(id_card):
+    """ Removes the cached search of the elector when the transaction of the change commits.
+        A search done before the commit still reads the old elector, so the cache is not invalidated before the write
+    """
+    transaction.on_commit(lambda: id_card_cache.invalidate(id_card))
 
 # Will be execute everytime when an elector is created
 @receiver(post_save, sender=Elector)
 def update_statistics_create(sender, instance, created, **kwargs):
+    invalidate_cached_elector(instance.cedula)
+
     if created:
         province = instance.codigo_electoral.provincia
         canton = instance.codigo_electoral.canton
         district = instance.codigo_electoral.distrito
         gender = instance.relleno
         
-        update_statistics(province= province, canton = canton,district= district, new_gender=gender,operation='increase')
+        update_statistics(province= province, canton = canton,district= district, new_gender=gender,operation='increase',
+                          expiration_date=instance.fecha_caducidad)
 
 # Will be execute everytime when an elector is deleted
 @receiver(post_delete, sender=Elector)
 def update_statistics_delete(sender, instance, **kwargs):
+    invalidate_cached_elector(instance.cedula)
     province = instance.codigo_electoral.provincia
     canton = instance.codigo_electoral.canton
     district = instance.codigo_electoral.distrito
     gender = instance.relleno
 
-    update_statistics(province= province, canton = canton,district= district, new_gender=gender,operation='decrease')
+    update_statistics(province= province, canton = canton,district= district, new_gender=gender,operation='decrease',
+                      expiration_date=instance.fecha_caducidad)
 
 #######################################################################################################################3
 
-def update_statistics(province, canton, district, new_gender, operation):
-    province_info = VotantesPorProvincia.objects.get(provincia=province)
-    canton_info = VotantesPorCanton.objects.get(codigo_provincia__provincia=province, canton=canton)
-    district_info = VotantesPorDistrito.objects.get(codigo_canton__codigo_provincia__provincia=province,
-                                                    codigo_canton__canton=canton, distrito=district)
-
+def update_statistics(province, canton, district, new_gender, operation, expiration_date=None):
+    """ Adds or subtracts one voter to the stats of the province, canton and district given as a parameter.
+        Each level is updated with a single UPDATE ... SET x = x +/- 1 through F() expressions, so the rows are not read
+        in python and concurrent changes are not lost. All the updates are done in one transaction
+    """
     attribute =  'total_votantes_hombres' if new_gender == '1' else 'total_votantes_mujeres'
+    quantity = 1 if operation == 'increase' else -1
+    changes = {'total_votantes': F('total_votantes') + quantity, attribute: F(attribute) + quantity}
+
+    with transaction.atomic():
+        VotantesPorProvincia.objects.filter(provincia=province).update(**changes)
+        VotantesPorCanton.objects.filter(codigo_provincia__provincia=province, canton=canton).update(**changes)
+        VotantesPorDistrito.objects.filter(codigo_canton__codigo_provincia__provincia=province,
+                                           codigo_canton__canton=canton, distrito=district).update(**changes)
+
+        if expiration_date is not None:
+            update_expiration_date_statistics(expiration_date, quantity)
+
 
-    # Is it possible to generalize the operation? The increasing and decreasing code is basically the same. The difference is the operation to be perfmormed
-    if (operation == 'increase'):
-        setattr(province_info,attribute, (getattr(province_info,attribute) + 1))
-        setattr(canton_info,attribute, (getattr(canton_info,attribute) + 1))
-        setattr(district_info,attribute, (getattr(district_info,attribute) + 1))
-
-        province_info.total_votantes = F('total_votantes') + 1
-        canton_info.total_votantes = F('total_votantes') + 1
-        district_info.total_votantes = F('total_votantes') + 1
-
-    elif (operation == 'decrease'):
-        setattr(province_info,attribute, (getattr(province_info,attribute) - 1))
-        setattr(canton_info,attribute, (getattr(canton_info,attribute) - 1))
-        setattr(district_info,attribute, (getattr(district_info,attribute) - 1))
-
-        province_info.total_votantes = F('total_votantes') - 1
-        canton_info.total_votantes = F('total_votantes') - 1
-        district_info.total_votantes = F('total_votantes') - 1
-                                  
-    province_info.save()
-    canton_info.save()
-    district_info.save()
+def update_expiration_date_statistics(expiration_date, quantity):
+    """ Adds the quantity to the number of electors with the expiration date given as a parameter, the date is inserted the first time.
+        The insert and the update are a single INSERT ... ON CONFLICT, so two electors saved at once with a new date do not both insert it
+    """
+    table = VotantesPorFechaCaducidad._meta.db_table
 
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {table} (fecha_caducidad, total_votantes) VALUES (%s, %s) "
+                       f"ON CONFLICT (fecha_caducidad) DO UPDATE SET total_votantes = {table}.total_votantes + EXCLUDED.total_votantes",
+                       [expiration_date, quantity])
@@ -1,3 +1,1185 @@
-from django.test import TestCase
+import os
+import csv
+import time
+import contextlib
+from collections import Counter, defaultdict
+import tempfile
+import unittest
+import importlib.util
+from datetime import date
+from unittest import mock
 
-# Create your tests here.
+from pymongo import ASCENDING
+
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.test import RequestFactory, SimpleTestCase
+from django.utils import timezone
+
+from electoral_roll.checkpoint import ImportCheckpoint
+from electoral_roll.columnar import convert_file, iterate_batches
+from electoral_roll.bulk_electors import BulkElectors
+from electoral_roll.cache import SearchCache, id_card_cache
+from electoral_roll.delta import ElectoralRollDelta
+from electoral_roll.models import Elector
+from electoral_roll.database_manager.connection import DistrictInformation, ReadOnlyEngineError
+from electoral_roll.database_manager.mmap_connection import MmapConnection
+from electoral_roll.database_manager.mmap_index import write_index
+from electoral_roll.database_manager.mongo_connection import MongoConnection
+from electoral_roll.database_manager.postgresql_connection import PostgreConnection
+from electoral_roll.database_manager.ngrams import get_name_ngrams, normalize_name
+from electoral_roll.management.commands.load_electoral_roll import Command as LoadElectoralRollCommand
+from electoral_roll.management.commands.compute_statistics import Command as ComputeStatisticsCommand
+from electoral_roll.signals import invalidate_cached_elector, update_statistics_create, update_statistics_delete
+from electoral_roll.views import ElectorCreateView, ElectorDeleteView, batch_voting_info
+
+
+class ChunksConnection:
+    """ Connection that keeps the inserted rows in a dictionary of id card => row.
+        The chunks whose index is in failing_chunks are rejected by bulk_insert
+    """
+
+    engine = 'test'
+
+    def __init__(self, failing_chunks=()):
+        self.rows = {}
+        self.inserted_chunks = []
+        self.failing_chunks = set(failing_chunks)
+
+    def handle_row_to_insert(self, data_row, option_file):
+        return tuple(field.strip() for field in data_row)
+
+    def bulk_insert(self, data, insert_option):
+        chunk_index = int(data[0][0]) // 2
+
+        if chunk_index in self.failing_chunks:
+            return False
+
+        self.inserted_chunks.append(chunk_index)
+        self.rows.update((row[0], row) for row in data)
+        return True
+
+    def clean_chunk(self, data, option_file):
+        for row in data:
+            self.rows.pop(row[0], None)
+
+    def get_row_location(self, data_row):
+        return data_row[1], data_row[2]
+
+    def get_row_expiration_date(self, data_row):
+        return data_row[3]
+
+
+class PadronFileTestCase(SimpleTestCase):
+    """Writes a padron file of ten electors in a temporary directory"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, 'padron.txt')
+        self.checkpoint_file_name = os.path.join(self.directory.name, 'load.checkpoint')
+
+        # Ten rows, so chunks of two rows have the id cards 2 * chunk and 2 * chunk + 1
+        with open(self.file_name, mode='w', encoding='utf-8') as file:
+            for id_card in range(10):
+                file.write(f"{id_card:09d},101001,1,20301231,00001,JUAN,MORA,SOTO\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class CheckpointResumeTests(PadronFileTestCase):
+
+    def load(self, connection, resume, failed_chunks=None):
+        """Loads the file in chunks of two rows. failed_chunks is the ranges of chunks that the CommandError of the load names"""
+        command = LoadElectoralRollCommand()
+        command.connection = connection
+        command.checkpoint = ImportCheckpoint(self.checkpoint_file_name)
+        command.resume = resume
+        options = {'workers': 1, 'queue_size': 2, 'parse_workers': 1}
+
+        if resume:
+            command.checkpoint.load()
+
+        if failed_chunks is None:
+            command.load_file(self.file_name, 'utf-8', 2, 'padron', options)
+
+        else:
+            with self.assertRaisesMessage(CommandError, f"The chunks {failed_chunks} of {self.file_name} were not inserted"):
+                command.load_file(self.file_name, 'utf-8', 2, 'padron', options)
+
+        return command
+
+    def test_resume_inserts_only_the_chunks_that_were_not_committed(self):
+        first_connection = ChunksConnection(failing_chunks=[1, 3])
+        first_load = self.load(first_connection, resume=False, failed_chunks='1, 3')
+
+        self.assertEqual(sorted(first_connection.inserted_chunks), [0, 2, 4])
+        self.assertEqual(sorted(first_load.failed_chunks), [('padron', 1), ('padron', 3)])
+
+        # The second import sees the rows of the first one, as the database would
+        resumed_connection = ChunksConnection()
+        resumed_connection.rows = dict(first_connection.rows)
+        self.load(resumed_connection, resume=True)
+
+        self.assertEqual(sorted(resumed_connection.inserted_chunks), [1, 3])
+        self.assertEqual(sorted(resumed_connection.rows), [f"{id_card:09d}" for id_card in range(10)])
+
+    def test_the_load_stops_naming_the_ranges_of_the_failed_chunks(self):
+        connection = ChunksConnection(failing_chunks=[0, 1, 3])
+        self.load(connection, resume=False, failed_chunks='0-1, 3')
+
+        self.assertEqual(sorted(connection.inserted_chunks), [2, 4])
+
+    def test_the_rows_of_a_failed_chunk_are_not_counted_in_the_stats(self):
+        command = LoadElectoralRollCommand()
+        command.connection = ChunksConnection(failing_chunks=[1])
+        command.checkpoint = ImportCheckpoint(self.checkpoint_file_name)
+        command.location_counter, command.expiration_date_counter = Counter(), Counter()
+
+        with self.assertRaises(CommandError):
+            command.load_file(self.file_name, 'utf-8', 2, 'padron', {'workers': 2, 'queue_size': 2, 'parse_workers': 1})
+
+        self.assertEqual(command.location_counter, Counter({('101001', '1'): 8}))
+        self.assertEqual(command.expiration_date_counter, Counter({'20301231': 8}))
+
+    def test_resume_point_is_the_end_of_the_committed_prefix(self):
+        self.load(ChunksConnection(failing_chunks=[2]), resume=False, failed_chunks='2')
+
+        checkpoint = ImportCheckpoint(self.checkpoint_file_name)
+        checkpoint.load()
+        chunk_index, offset = checkpoint.get_resume_point('padron')
+
+        with open(self.file_name, mode='rb') as file:
+            file.readline()
+            file.readline()
+            file.readline()
+            file.readline()
+
+            self.assertEqual((chunk_index, offset), (2, file.tell()))
+
+    def test_resume_rejects_a_file_that_changed(self):
+        self.load(ChunksConnection(failing_chunks=[0]), resume=False, failed_chunks='0')
+
+        with open(self.file_name, mode='r', encoding='utf-8') as file:
+            lines = file.readlines()
+
+        lines[2] = lines[2].replace('JUAN', 'ANA')
+
+        with open(self.file_name, mode='w', encoding='utf-8') as file:
+            file.writelines(lines)
+
+        with self.assertRaisesMessage(Exception, 'is different from the committed one'):
+            self.load(ChunksConnection(), resume=True)
+
+
+class ParallelParseTests(SimpleTestCase):
+
+    def test_the_parse_processes_yield_the_same_rows_as_the_main_process(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        file_name = os.path.join(directory.name, 'padron.txt')
+        names = ['JOSÉ', 'MARÍA', 'ÑANDÚ', 'PEÑA']
+
+        # Windows line endings and latin-1, as the files of the TSE, with a number of rows that does not fill the last shard
+        with open(file_name, mode='w', encoding='latin-1', newline='\r\n') as file:
+            for id_card in range(5003):
+                file.write(f"{id_card:09d},101001,{id_card % 2 + 1},20301231,00001,{names[id_card % 4]:<30},MORA      ,SOTO      \n")
+
+        command = LoadElectoralRollCommand()
+        sequential_rows = [row for chunk in command.process_file_in_chunks(file_name, 'latin-1', 1000, 'padron') for row in chunk]
+        parallel_chunks = list(command.process_file_in_parallel(file_name, 'latin-1', 1000, 'padron', 2))
+
+        self.assertGreater(len(parallel_chunks), 1)
+        self.assertEqual([row for chunk in parallel_chunks for row in chunk], sequential_rows)
+        self.assertEqual(len(sequential_rows), 5003)
+        self.assertEqual((sequential_rows[1]['nombre'], sequential_rows[-1]['segundo_apellido']), ('MARÍA', 'SOTO'))
+        self.assertEqual(command.chunk_end_offset, os.path.getsize(file_name))
+
+
+class ShadowConnection(ChunksConnection):
+    """Connection of a shadow load that records the phases that were called"""
+
+    def __init__(self, failing_chunks=()):
+        super().__init__(failing_chunks)
+        self.calls = []
+
+    def bulk_insert(self, data, insert_option):
+        # The districts are always inserted
+        return insert_option == 'distelec' or super().bulk_insert(data, insert_option)
+
+    def __getattr__(self, name):
+        if name in ('prepare_shadow_load', 'drop_indexes', 'create_indexes', 'build_name_index', 'swap_shadow_load'):
+            return lambda: self.calls.append(name)
+
+        raise AttributeError(name)
+
+
+class ShadowLoadTests(PadronFileTestCase):
+
+    def test_a_shadow_load_with_a_failed_chunk_is_not_swapped(self):
+        districts_file_name = os.path.join(self.directory.name, 'distelec.txt')
+
+        with open(districts_file_name, mode='w', encoding='utf-8') as file:
+            file.write("101001,SAN JOSE,CENTRAL,CARMEN\n")
+
+        connection = ShadowConnection(failing_chunks=[0])
+        command = LoadElectoralRollCommand()
+        command.connection = connection
+        command.checkpoint = ImportCheckpoint(self.checkpoint_file_name)
+        options = {'workers': 1, 'parse_workers': 1, 'queue_size': 2, 'resume': False, 'delta': False,
+                   'name_index': False, 'reset': 'delete', 'defer_indexes': False, 'shadow': True, 'compute_statistics': False}
+
+        with self.assertRaisesMessage(CommandError, 'The shadow tables were not swapped'):
+            command.handle(file_1=self.file_name, file_2=districts_file_name, files_encoding='utf-8', **options)
+
+        self.assertEqual(connection.calls, ['prepare_shadow_load'])
+
+
+class ElectorsConnection:
+    """ Connection that keeps the electors in a dictionary of id card => row of the padron file and adds up the stats changes.
+        The rows of the id cards in rejected_id_cards are not written by bulk_insert or replace_electors
+    """
+
+    engine = 'test'
+
+    def __init__(self, rows=(), rejected_id_cards=()):
+        self.electors = {row[0]: tuple(row) for row in rows}
+        self.rejected_id_cards = set(rejected_id_cards)
+        self.statistics_deltas = {}
+        self.expiration_dates_deltas = {}
+
+    def handle_row_to_insert(self, data_row, option_file):
+        return tuple(data_row)
+
+    def iterate_electors(self):
+        yield from self.electors.values()
+
+    def get_districts(self):
+        return [('101001', 'SAN JOSE', 'CENTRAL', 'HOSPITAL'), ('101002', 'SAN JOSE', 'CENTRAL', 'CATEDRAL')]
+
+    def get_electors_locations(self, id_cards):
+        return {id_card: self.electors[id_card][1:4] for id_card in id_cards if id_card in self.electors}
+
+    def delete_electors(self, id_cards):
+        for id_card in id_cards:
+            self.electors.pop(id_card, None)
+
+    def bulk_insert(self, data, insert_option):
+        # As insert_many, the rows after the first rejected one are not inserted
+        for row in data:
+            if row[0] in self.rejected_id_cards:
+                return False
+
+            self.electors[row[0]] = row
+
+        return True
+
+    def replace_electors(self, data):
+        # As the transaction of postgres, a rejected row rejects the whole batch
+        if any(row[0] in self.rejected_id_cards for row in data):
+            return []
+
+        self.electors.update((row[0], row) for row in data)
+        return [row[0] for row in data]
+
+    def apply_statistics_deltas(self, deltas):
+        for code, (male_delta, female_delta) in deltas.items():
+            counts = self.statistics_deltas.setdefault(code, [0, 0])
+            counts[0] += male_delta
+            counts[1] += female_delta
+
+    def apply_expiration_dates_deltas(self, deltas):
+        for date, delta in deltas.items():
+            self.expiration_dates_deltas[date] = self.expiration_dates_deltas.get(date, 0) + delta
+
+
+def get_padron_row(id_card, code='101001', gender='1', expiration_date='20301231', name='JUAN'):
+    return (f"{id_card:09d}", code, gender, expiration_date, '00001', name, 'MORA', 'SOTO')
+
+
+class ElectoralRollDeltaTests(SimpleTestCase):
+
+    def compare(self, connection, rows):
+        delta = ElectoralRollDelta(connection, batch_size=2)
+        delta.load_stored_electors()
+
+        for row in rows:
+            delta.compare_row(list(row))
+
+        delta.finish_comparison()
+        return delta
+
+    def test_the_differences_are_applied_to_the_electors_and_the_stats(self):
+        connection = ElectorsConnection([get_padron_row(1), get_padron_row(2), get_padron_row(3, gender='2')])
+        # 1 is kept, 2 moves to another district, 3 is deleted and 4 is new
+        delta = self.compare(connection, [get_padron_row(1), get_padron_row(2, code='101002', expiration_date='20291231'),
+                                          get_padron_row(4, gender='2')])
+
+        self.assertEqual(len(delta.electors_to_insert), 1)
+        self.assertEqual(len(delta.electors_to_update), 1)
+        self.assertEqual(delta.id_cards_to_delete, ['000000003'])
+
+        delta.apply()
+
+        self.assertEqual(sorted(connection.electors), ['000000001', '000000002', '000000004'])
+        self.assertEqual(connection.electors['000000002'][1], '101002')
+        self.assertEqual(connection.statistics_deltas, {'101001': [-1, 0], '101002': [1, 0]})
+        self.assertEqual(connection.expiration_dates_deltas, {'20301231': -1, '20291231': 1})
+        self.assertEqual((delta.inserted_id_cards, delta.updated_id_cards, delta.deleted_id_cards), (['000000004'], ['000000002'], ['000000003']))
+
+    def test_the_rows_that_are_not_inserted_do_not_change_the_stats(self):
+        connection = ElectorsConnection(rejected_id_cards=['000000002'])
+        delta = self.compare(connection, [get_padron_row(1), get_padron_row(2), get_padron_row(3), get_padron_row(4, gender='2')])
+        delta.apply()
+
+        # The first batch stops at the rejected row, the second batch is inserted
+        self.assertEqual(sorted(connection.electors), ['000000001', '000000003', '000000004'])
+        self.assertEqual(connection.statistics_deltas, {'101001': [2, 1]})
+        self.assertEqual(connection.expiration_dates_deltas, {'20301231': 3})
+
+    def test_a_replacement_that_fails_keeps_the_old_elector_and_its_stats(self):
+        connection = ElectorsConnection([get_padron_row(1), get_padron_row(2)], rejected_id_cards=['000000001'])
+        delta = self.compare(connection, [get_padron_row(1, code='101002'), get_padron_row(2, code='101002')])
+        delta.apply()
+
+        self.assertEqual(connection.electors['000000001'][1], '101001')
+        self.assertEqual(connection.electors['000000002'][1], '101001')
+        self.assertEqual(connection.statistics_deltas, {})
+        self.assertEqual(delta.updated_id_cards, [])
+
+    def test_only_the_genders_1_and_2_are_counted_in_the_districts(self):
+        connection = ElectorsConnection()
+        delta = self.compare(connection, [get_padron_row(1, gender='0'), get_padron_row(2, gender='2')])
+        delta.apply()
+
+        self.assertEqual(connection.statistics_deltas, {'101001': [0, 1]})
+        self.assertEqual(connection.expiration_dates_deltas, {'20301231': 2})
+
+
+class BulkElectorsTests(SimpleTestCase):
+
+    def test_the_invalid_rows_are_rejected(self):
+        connection = ElectorsConnection([get_padron_row(1)])
+        bulk_electors = BulkElectors(connection)
+        rows = [get_padron_row(1), get_padron_row(2, code='999999'), get_padron_row(3, gender='0'),
+                get_padron_row(4, expiration_date='20301332'), get_padron_row(5, expiration_date='2030123A'),
+                ('12345', '101001', '1', '20301231', '00001', 'JUAN', 'MORA', 'SOTO'),
+                ('10000000A', '101001', '1', '20301231', '00001', 'JUAN', 'MORA', 'SOTO'), get_padron_row(8)]
+
+        self.assertEqual(bulk_electors.create(rows), 1)
+        self.assertEqual(bulk_electors.rejected_rows, rows[:7])
+        self.assertEqual(connection.statistics_deltas, {'101001': [1, 0]})
+        self.assertEqual(connection.expiration_dates_deltas, {'20301231': 1})
+
+    def test_the_rows_that_were_not_stored_are_not_counted(self):
+        connection = ElectorsConnection(rejected_id_cards=['000000002'])
+        bulk_electors = BulkElectors(connection, batch_size=2)
+        rows = [get_padron_row(1), get_padron_row(2), get_padron_row(3, gender='2')]
+
+        # The insert stops at the second row, so only the first one and the next batch are stored
+        self.assertEqual(bulk_electors.create(rows), 2)
+        self.assertEqual(bulk_electors.rejected_rows, [rows[1]])
+        self.assertEqual(connection.statistics_deltas, {'101001': [1, 1]})
+
+    def test_only_the_stored_electors_are_deleted(self):
+        connection = ElectorsConnection([get_padron_row(1), get_padron_row(2, gender='2')])
+
+        self.assertEqual(BulkElectors(connection).delete(['000000001', ' 000000001 ', '000000009']), 1)
+        self.assertEqual(list(connection.electors), ['000000002'])
+        self.assertEqual(connection.statistics_deltas, {'101001': [-1, 0]})
+
+
+class ChunkedCursor:
+    """Server side cursor that keeps the executed queries and returns no rows"""
+
+    def __init__(self, queries):
+        self.queries = queries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.queries.append((sql, params))
+
+    def fetchmany(self, size):
+        return []
+
+
+class PostgresElectorsReadTests(SimpleTestCase):
+
+    def read_electors(self, **kwargs):
+        queries = []
+        connection = PostgreConnection('postgre')
+        connection.connection = mock.Mock(chunked_cursor=lambda: ChunkedCursor(queries))
+        list(connection.iterate_electors(**kwargs))
+        return queries[0]
+
+    def test_the_delta_reads_the_electors_without_sorting_them(self):
+        sql, params = self.read_electors()
+
+        self.assertNotIn('ORDER BY', sql)
+
+    def test_the_export_reads_the_electors_sorted_by_cedula(self):
+        sql, params = self.read_electors(sort=True)
+
+        self.assertTrue(sql.endswith('ORDER BY cedula'))
+
+    def test_the_expiration_date_is_taken_in_the_time_zone_of_the_project(self):
+        # Elector.save stores 18:00 of Costa Rica, which is the next day in UTC
+        sql, params = self.read_electors()
+
+        self.assertIn('AT TIME ZONE %s', sql)
+        self.assertEqual(params, ['America/Costa_Rica'])
+
+
+class LocationsConnection:
+    """Connection with the districts and the (electoral code, gender) of the electors that compute_statistics reads"""
+
+    engine = 'test'
+
+    def __init__(self, districts, locations):
+        self.districts = districts
+        self.locations = locations
+
+    def get_districts(self):
+        return self.districts
+
+    def iterate_electors_locations(self):
+        yield from self.locations
+
+    def get_districts_information(self):
+        return [DistrictInformation(code, province, canton, district,
+                                    self.locations.count((code, '1')), self.locations.count((code, '2')))
+                for code, province, canton, district in self.districts]
+
+
+class ComputeStatisticsEnginesTests(SimpleTestCase):
+
+    def compute(self, connection, engine):
+        command = ComputeStatisticsCommand()
+        command.connection = connection
+        # The stats are compared before they are inserted
+        command.bulk_insert = lambda expiration_dates=None: None
+
+        if engine == 'numpy':
+            command.compute_statistics_vectorized()
+
+        else:
+            command.compute_statistics()
+
+        return command.provinces_statistics, command.canton_statistics, command.district_statistics
+
+    def test_the_numpy_engine_computes_the_same_stats_as_the_loop_engine(self):
+        # CENTRAL is a canton of two provinces and the last province has two cantons
+        districts = [('101001', 'SAN JOSE', 'CENTRAL', 'CARMEN'), ('101002', 'SAN JOSE', 'CENTRAL', 'MERCED'),
+                     ('102001', 'SAN JOSE', 'ESCAZU', 'ESCAZU'), ('201001', 'ALAJUELA', 'CENTRAL', 'ALAJUELA'),
+                     ('701001', 'LIMON', 'CENTRAL', 'LIMON'), ('702001', 'LIMON', 'POCOCI', 'GUAPILES'),
+                     ('702002', 'LIMON', 'POCOCI', 'JIMENEZ')]
+        locations = []
+
+        for position, (code, _, _, _) in enumerate(districts):
+            locations += [(code, '1')] * (position + 1) + [(code, '2')] * (2 * position + 3)
+
+        # An unknown gender and an electoral code without district are not counted
+        locations += [('101001', '0'), ('999999', '1')]
+        connection = LocationsConnection(districts, locations)
+
+        loop_statistics = self.compute(connection, 'loop')
+        numpy_statistics = self.compute(connection, 'numpy')
+
+        self.assertEqual(loop_statistics, numpy_statistics)
+
+        provinces = {province['provincia']: province['total_votantes'] for province in loop_statistics[0]}
+        cantons = {(canton['provincia'], canton['canton']): canton['total_votantes'] for canton in loop_statistics[1]}
+
+        self.assertEqual(provinces, {'SAN JOSE': 4 + 7 + 10, 'ALAJUELA': 13, 'LIMON': 16 + 19 + 22})
+        self.assertEqual(cantons[('LIMON', 'POCOCI')], 19 + 22)
+        self.assertEqual(len(loop_statistics[2]), len(districts))
+
+    def test_without_districts_nothing_is_computed(self):
+        for engine in ['loop', 'numpy']:
+            self.assertEqual(self.compute(LocationsConnection([], []), engine), ([], [], []))
+
+
+class NameNgramsTests(SimpleTestCase):
+
+    def get_score(self, query_ngrams, stored_ngrams):
+        """Number of shared trigrams, as the $setIntersection of search_by_name_fuzzy"""
+        return len(set(query_ngrams) & set(stored_ngrams))
+
+    def test_accents_are_removed(self):
+        self.assertEqual(normalize_name(' José Núñez '), 'JOSE NUNEZ')
+        self.assertEqual(get_name_ngrams('JOSÉ', 'NÚÑEZ', 'MORA'), get_name_ngrams('jose', 'nunez', 'mora'))
+
+    def test_a_prefix_matches_the_whole_name(self):
+        query_ngrams = get_name_ngrams('JOS', 'NUÑ', '', prefix=True)
+        stored_ngrams = get_name_ngrams('JOSE', 'NUNEZ', 'MORA')
+
+        self.assertTrue(set(query_ngrams) <= set(stored_ngrams))
+
+    def test_a_typo_keeps_half_of_the_trigrams(self):
+        query_ngrams = get_name_ngrams('JOSE', 'NUNES', 'MORA', prefix=True)
+        minimum_score = (len(query_ngrams) + 1) // 2
+
+        self.assertGreaterEqual(self.get_score(query_ngrams, get_name_ngrams('JOSE', 'NUNEZ', 'MORA')), minimum_score)
+        self.assertLess(self.get_score(query_ngrams, get_name_ngrams('ANA', 'SOLANO', 'VEGA')), minimum_score)
+
+    def test_the_trigrams_of_each_field_are_different(self):
+        self.assertFalse(set(get_name_ngrams('MORA', '', '')) & set(get_name_ngrams('', 'MORA', '')))
+
+    def test_the_loaded_electors_keep_their_trigrams(self):
+        connection = MongoConnection('mongo')
+        row = ['100000001', '101001', '1', '20301231', '00001', 'JOSÉ    ', 'NÚÑEZ   ', 'MORA    ']
+        document = connection.handle_row_to_insert(row, 'padron')
+
+        self.assertEqual(document['ngrams'], get_name_ngrams('JOSE', 'NUNEZ', 'MORA'))
+
+
+class NgramsCollection:
+    """Collection of electors that runs the aggregation of search_by_name_fuzzy in python and keeps the number of candidates that it reads"""
+
+    def __init__(self, electors):
+        self.electors = [dict(elector, ngrams=get_name_ngrams(elector['nombre'], elector['primer_apellido'], elector['segundo_apellido']))
+                         for elector in electors]
+        self.read_candidates = []
+
+    def count_documents(self, query, limit):
+        return min(sum(query['ngrams'] in elector['ngrams'] for elector in self.electors), limit)
+
+    def aggregate(self, pipeline):
+        candidate_ngrams = set(pipeline[0]['$match']['ngrams']['$in'])
+        query_ngrams = set(pipeline[2]['$project']['score']['$size']['$setIntersection'][1])
+        candidates = [elector for elector in self.electors if candidate_ngrams & set(elector['ngrams'])][:pipeline[1]['$limit']]
+        self.read_candidates.append(len(candidates))
+        scored = [dict(elector, score=len(query_ngrams & set(elector['ngrams']))) for elector in candidates]
+        ranked = sorted((elector for elector in scored if elector['score'] >= pipeline[3]['$match']['score']['$gte']),
+                        key=lambda elector: (-elector['score'], elector['cedula']))
+        return iter(ranked[pipeline[5]['$skip']:][:pipeline[6]['$limit']])
+
+
+class MongoFuzzySearchTests(SimpleTestCase):
+
+    def setUp(self):
+        names = [('JOSE', 'MORA', 'VEGA'), ('JOSE', 'MORA', 'SOLANO'), ('JOSE', 'NUNEZ', 'MORA'), ('JOSUE', 'MORALES', 'VEGA'),
+                 ('ANA', 'MORA', 'VEGA'), ('ANA', 'SOLANO', 'ARIAS'), ('LUIS', 'ARIAS', 'MORA')]
+        electors = [{'cedula': f"10000000{position}", 'nombre': name, 'primer_apellido': surname, 'segundo_apellido': second_surname,
+                     'fecha_caducidad': '20301231', 'codigo_electoral': '101001'}
+                    for position, (name, surname, second_surname) in enumerate(names)]
+        self.collection = NgramsCollection(electors * 3)
+        self.connection = MongoConnection('mongo')
+        self.connection.db = {self.connection.elector_table_or_collection: self.collection}
+        self.connection.build_elector_result = lambda elector: {'cedula': elector['cedula']}
+
+    def search_all_trigrams(self, name, surname, second_surname, page, page_size):
+        """Ranking of the electors that share half of the trigrams, searching every trigram as the search did before"""
+        query_ngrams = get_name_ngrams(name, surname, second_surname, prefix=True)
+        pipeline = self.connection.get_fuzzy_search_pipeline(query_ngrams, query_ngrams, (len(query_ngrams) + 1) // 2, page, page_size)
+        return [elector['cedula'] for elector in self.collection.aggregate(pipeline)]
+
+    def test_the_rarest_trigrams_find_the_same_page(self):
+        for names in [('JOSE', 'MORA', 'VEGA'), ('JOSE', 'NUNES', 'MORA'), ('ANA', 'SOL', ''), ('LUIS', 'ARIAS', '')]:
+            for page in (1, 2):
+                found = [result['cedula'] for result in self.connection.search_by_name_fuzzy(*names, page=page, page_size=4)]
+
+                self.assertEqual(found, self.search_all_trigrams(*names, page, 4), names)
+
+    def test_a_full_page_of_electors_with_all_the_trigrams_is_not_searched_again(self):
+        results = self.connection.search_by_name_fuzzy('JOSE', 'MORA', '', page_size=4)
+
+        self.assertEqual([result['similarity'] for result in results], [1.0] * 4)
+        self.assertEqual(len(self.collection.read_candidates), 1)
+        # Only the electors with the rarest trigram of the search are read
+        self.assertLess(self.collection.read_candidates[0], len(self.collection.electors))
+
+
+class ResettingCollection:
+    """Collection of districts whose find_one resets the dictionaries of the connection, as another thread does after a load"""
+
+    def __init__(self, connection, documents):
+        self.connection = connection
+        self.documents = documents
+
+    def find(self, query, projection):
+        return iter(self.documents[:1])
+
+    def find_one(self, query, projection):
+        self.connection.districts = None
+        self.connection.statistics_ids = None
+        return next((document for document in self.documents if document['codigo_electoral'] == query['codigo_electoral']), None)
+
+
+class MongoDictionariesTests(SimpleTestCase):
+
+    def test_a_reset_while_a_district_is_searched_does_not_break_the_search(self):
+        connection = MongoConnection('mongo')
+        districts = [{'codigo_electoral': '101001', 'provincia': 'SAN JOSE', 'canton': 'CENTRAL', 'distrito': 'CARMEN'},
+                     {'codigo_electoral': '101002', 'provincia': 'SAN JOSE', 'canton': 'CENTRAL', 'distrito': 'MERCED'}]
+        connection.db = {connection.distelect_table_or_collection: ResettingCollection(connection, districts)}
+
+        self.assertEqual(connection.get_district('101001'), districts[0])
+        # The second district is not in the loaded dictionary, so it is searched while the dictionary is reset
+        self.assertEqual(connection.get_district('101002'), districts[1])
+        self.assertIsNone(connection.get_district('999999'))
+
+    def test_a_reset_while_the_statistics_ids_are_loaded_does_not_break_the_update(self):
+        connection = MongoConnection('mongo')
+        connection.get_province_ids = lambda: {'SAN JOSE': 1}
+        connection.get_canton_ids = lambda: {('SAN JOSE', 'CENTRAL'): 2}
+        connection.db = {connection.district_stats_table_or_collection:
+                         ResettingCollection(connection, [{'provincia': 'SAN JOSE', 'canton': 'CENTRAL', 'distrito': 'CARMEN', '_id': 3}])}
+
+        def get_districts():
+            # A load that finishes while the ids are built resets them
+            connection.statistics_ids = None
+            return [('101001', 'SAN JOSE', 'CENTRAL', 'CARMEN'), ('101002', 'SAN JOSE', 'CENTRAL', 'MERCED')]
+
+        connection.get_districts = get_districts
+
+        self.assertEqual(connection.get_statistics_ids('101001'), (1, 2, 3))
+        self.assertIsNone(connection.get_statistics_ids('101002'))
+
+
+class IndexesCollection:
+    """Collection that keeps the keys of its indexes, drop_indexes removes all of them as in mongo"""
+
+    def __init__(self):
+        self.indexes = set()
+
+    def create_index(self, keys, **options):
+        self.indexes.add(tuple(keys))
+
+    def drop_indexes(self):
+        self.indexes.clear()
+
+
+class MongoIndexesTests(SimpleTestCase):
+
+    def test_create_indexes_builds_again_the_trigrams_index_that_drop_indexes_dropped(self):
+        connection = MongoConnection('mongo')
+        collections = defaultdict(IndexesCollection)
+        connection.db = collections
+        connection.create_indexes()
+        created = {name: set(collection.indexes) for name, collection in collections.items()}
+
+        connection.drop_indexes()
+        connection.create_indexes()
+
+        self.assertIn((('ngrams', ASCENDING),), collections[connection.elector_table_or_collection].indexes)
+        self.assertEqual({name: collection.indexes for name, collection in collections.items()}, created)
+
+
+class CatalogCursor:
+    """Cursor that answers the catalog queries of drop_indexes and create_indexes with the indexes and foreign keys of the fake table"""
+
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.database.statements.append(sql)
+
+        if any(f'"{name}"' in sql for name in self.database.failing_names):
+            raise Exception(f"the statement of {sql.split(chr(34))[1]} failed")
+
+        if sql == 'SELECT current_schema()':
+            self.rows = [('public',)]
+        elif sql.startswith('SELECT conname, pg_get_constraintdef'):
+            self.rows = list(self.database.foreign_keys.items())
+        elif sql.startswith('SELECT conname'):
+            self.rows = [(name,) for name in self.database.foreign_keys]
+        elif sql.startswith('SELECT index_class.relname'):
+            self.rows = list(self.database.indexes.items())
+        elif sql.startswith('SELECT indexname'):
+            self.rows = [(name,) for name in self.database.indexes]
+        elif sql.startswith('ALTER TABLE') and 'DROP CONSTRAINT' in sql:
+            del self.database.foreign_keys[sql.split('"')[1]]
+        elif sql.startswith('ALTER TABLE'):
+            name = sql.split('"')[1]
+            self.database.foreign_keys[name] = sql.split(f'"{name}" ')[1]
+        elif sql.startswith('DROP INDEX'):
+            del self.database.indexes[sql.split('"')[1]]
+        elif sql.startswith('CREATE INDEX'):
+            self.database.indexes[sql.split()[2]] = sql
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class CatalogDatabase:
+    """Django connection of a table with its index and foreign key definitions as pg_get_indexdef and pg_get_constraintdef return them"""
+
+    def __init__(self, indexes, foreign_keys):
+        self.indexes = dict(indexes)
+        self.foreign_keys = dict(foreign_keys)
+        self.failing_names = set()
+        self.statements = []
+
+    def cursor(self):
+        return CatalogCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DeferredIndexesTests(SimpleTestCase):
+    indexes = {'elector_nombre_trgm_idx': 'CREATE INDEX elector_nombre_trgm_idx ON public.electoral_roll_elector '
+                                          'USING gin (electoral_roll_unaccent((nombre)::text) gin_trgm_ops)',
+               'electoral_roll_elector_codigo_electoral_id': 'CREATE INDEX electoral_roll_elector_codigo_electoral_id '
+                                                             'ON public.electoral_roll_elector USING btree (codigo_electoral_id)'}
+    foreign_keys = {'electoral_roll_elector_fk': 'FOREIGN KEY (codigo_electoral_id) REFERENCES electoral_roll_distritoelectoral(codigo_electoral)'}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_name = os.path.join(directory.name, 'electoral_roll.dropped_indexes')
+        patcher = mock.patch('electoral_roll.database_manager.postgresql_connection.POSTGRES_DROPPED_INDEXES_FILE', self.file_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.database = CatalogDatabase(self.indexes, self.foreign_keys)
+        self.connection = PostgreConnection('postgre')
+        self.connection.connection = self.database
+
+    def test_the_dropped_indexes_are_created_again_from_their_definitions(self):
+        self.connection.drop_indexes()
+
+        self.assertEqual((self.database.indexes, self.database.foreign_keys), ({}, {}))
+        self.assertTrue(os.path.exists(self.file_name))
+
+        self.connection.create_indexes()
+
+        # The indexes are built in the tables of the search_path, the live ones or the shadow ones
+        self.assertEqual(self.database.indexes, {name: sql.replace(' ON public.', ' ON ') for name, sql in self.indexes.items()})
+        self.assertEqual(self.database.foreign_keys, self.foreign_keys)
+        self.assertFalse(os.path.exists(self.file_name))
+
+    def test_a_load_that_stopped_keeps_the_definitions_for_the_next_one(self):
+        self.connection.drop_indexes()
+        # The next load starts again and drops the indexes of an empty table
+        self.connection.drop_indexes()
+        self.connection.create_indexes()
+
+        self.assertEqual(set(self.database.indexes), set(self.indexes))
+        self.assertEqual(self.database.foreign_keys, self.foreign_keys)
+
+    def test_a_foreign_key_that_fails_does_not_stop_the_next_ones(self):
+        self.database.foreign_keys['electoral_roll_elector_second_fk'] = 'FOREIGN KEY (junta) REFERENCES electoral_roll_junta(junta)'
+        foreign_keys = dict(self.database.foreign_keys)
+        self.connection.drop_indexes()
+        self.database.failing_names.add('electoral_roll_elector_fk')
+
+        self.connection.create_indexes()
+
+        self.assertEqual(list(self.database.foreign_keys), ['electoral_roll_elector_second_fk'])
+        # The foreign key that failed is added again by the next load
+        self.database.failing_names.clear()
+        self.connection.create_indexes()
+
+        self.assertEqual(self.database.foreign_keys, foreign_keys)
+        self.assertFalse(os.path.exists(self.file_name))
+
+
+class CopyCursor:
+    """Cursor of a table that rejects the rows of an electoral code that does not exist, as the foreign key does"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def insert(self, rows):
+        rows = [tuple(row) for row in rows]
+
+        if any(row[1] not in self.database.codes for row in rows):
+            raise ValueError('insert or update on table "electoral_roll_elector" violates foreign key constraint')
+
+        self.database.rows.extend(rows)
+
+    def copy_expert(self, sql, buffer):
+        # bulk_insert_batch sends the csv that arrow writes as bytes
+        self.insert(csv.reader(line.decode('utf-8') if isinstance(line, bytes) else line for line in buffer))
+
+    def executemany(self, sql, data):
+        self.insert(data)
+
+    def execute(self, sql, row):
+        self.insert([row])
+
+
+class CopyDatabase:
+
+    def __init__(self, codes):
+        self.codes = set(codes)
+        self.rows = []
+
+    def cursor(self):
+        return CopyCursor(self)
+
+    def commit(self):
+        pass
+
+
+class CopyInsertTests(SimpleTestCase):
+
+    def setUp(self):
+        self.database = CopyDatabase(['101001'])
+        self.connection = PostgreConnection('postgre')
+        self.connection.connection = self.database
+        # The chunk is split down to two rows before the rows are inserted one by one
+        self.connection.copy_fallback_size = 2
+        patcher = mock.patch('electoral_roll.database_manager.postgresql_connection.transaction', atomic=contextlib.nullcontext)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_a_chunk_with_a_bad_row_is_not_reported_as_inserted(self):
+        rows = [get_padron_row(id_card) for id_card in range(8)]
+        rows[5] = get_padron_row(5, code='999999')
+
+        self.assertFalse(self.connection.bulk_insert(rows, 'padron'))
+        self.assertEqual(sorted(self.database.rows), rows[:5] + rows[6:])
+
+    def test_copy_insert_returns_the_rejected_rows(self):
+        rows = [get_padron_row(id_card, code='999999' if id_card in (0, 7) else '101001') for id_card in range(8)]
+
+        self.assertEqual(self.connection.copy_insert(rows, 'padron'), [rows[0], rows[7]])
+        self.assertEqual(len(self.database.rows), 6)
+
+    def test_a_chunk_without_bad_rows_is_copied_at_once(self):
+        rows = [get_padron_row(id_card) for id_card in range(8)]
+
+        self.assertTrue(self.connection.bulk_insert(rows, 'padron'))
+        self.assertEqual(self.database.rows, rows)
+
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+class ColumnarInsertTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_name = os.path.join(directory.name, 'PADRON_COMPLETO.txt')
+        self.parquet_file_name = os.path.join(directory.name, 'PADRON_COMPLETO.parquet')
+        self.database = CopyDatabase(['101001'])
+        self.connection = PostgreConnection('postgre')
+        self.connection.connection = self.database
+        self.connection.copy_fallback_size = 2
+        mock.patch('electoral_roll.database_manager.postgresql_connection.transaction', atomic=contextlib.nullcontext).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def convert_and_insert(self, rows):
+        with open(self.file_name, 'w', encoding='latin-1', newline='') as file:
+            file.writelines(f"{','.join(row)}\r\n" for row in rows)
+
+        convert_file(self.file_name, 'latin-1', 'padron', self.parquet_file_name)
+        return [self.connection.bulk_insert_batch(batch, 'padron') for batch in iterate_batches(self.parquet_file_name, 2)]
+
+    def test_the_converted_electors_are_copied_with_the_leading_zeros_of_the_cedula(self):
+        rows = [('012345678', '101001', '1', '20301231', '00001', 'JOSÉ                          ', 'NÚÑEZ     ', 'MORA      '),
+                ('100000002', '101001', '2', '20251105', '00002', 'ANA                           ', 'SOTO      ', 'VEGA      '),
+                ('000000003', '101001', '1', '20290101', '00003', 'LUIS                          ', 'ARIAS     ', '          ')]
+
+        self.assertEqual(self.convert_and_insert(rows), [True, True])
+        self.assertEqual(self.database.rows, [('012345678', '101001', '1', '2030-12-31', '00001', 'JOSÉ', 'NÚÑEZ', 'MORA'),
+                                              ('100000002', '101001', '2', '2025-11-05', '00002', 'ANA', 'SOTO', 'VEGA'),
+                                              ('000000003', '101001', '1', '2029-01-01', '00003', 'LUIS', 'ARIAS', '')])
+
+    def test_a_batch_that_copy_rejects_keeps_its_good_rows(self):
+        rows = [get_padron_row(1), get_padron_row(2, code='999999'), get_padron_row(3)]
+
+        self.assertEqual(self.convert_and_insert(rows), [False, True])
+        self.assertEqual([row[0] for row in self.database.rows], ['000000001', '000000003'])
+
+
+class MmapIndexTests(SimpleTestCase):
+    districts = [('101001', 'SAN JOSE', 'CENTRAL', 'CARMEN'), ('201001', 'ALAJUELA', 'CENTRAL', 'ALAJUELA')]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file_name = os.path.join(directory.name, 'electoral_roll.index')
+
+    def test_the_exported_electors_are_searched_in_the_index(self):
+        electors = [get_padron_row(1, name='JOSÉ'), get_padron_row(2, code='999999'), get_padron_row(3, gender='2'),
+                    get_padron_row(4, code='201001', expiration_date='20251231')]
+
+        self.assertEqual(write_index(self.file_name, self.districts, iter(electors)), (3, 1))
+
+        connection = MmapConnection('mmap', file_name=self.file_name)
+        elector = connection.search_by_id_card('000000001')
+
+        self.assertEqual((elector['cedula'], elector['nombre'], elector['codigo_electoral__distrito']), ('000000001', 'JOSÉ', 'CARMEN'))
+        self.assertTrue(timezone.is_aware(elector['fecha_caducidad']))
+        self.assertEqual(connection.search_by_id_card('000000002'), [])
+        self.assertEqual([row[0] for row in connection.iterate_electors()], ['000000001', '000000003', '000000004'])
+
+        statistics = connection.get_statistics_from_database(elector['fecha_caducidad'], 'SAN JOSE', 'CENTRAL', 'CARMEN')
+
+        self.assertEqual(statistics['province_statistics'], {'total_votantes': 2, 'total_votantes_hombres': 1, 'total_votantes_mujeres': 1})
+        self.assertEqual(statistics['id_statistics'], {'same_id_count': 2})
+        self.assertEqual(connection.get_statistics_from_database(elector['fecha_caducidad'], 'LIMON', 'CENTRAL', 'LIMON')['district_statistics'],
+                         {'total_votantes': 0, 'total_votantes_hombres': 0, 'total_votantes_mujeres': 0})
+
+    def test_unsorted_electors_do_not_replace_the_index(self):
+        write_index(self.file_name, self.districts, iter([get_padron_row(1)]))
+
+        with self.assertRaises(ValueError):
+            write_index(self.file_name, self.districts, iter([get_padron_row(3), get_padron_row(2)]))
+
+        self.assertEqual(os.listdir(os.path.dirname(self.file_name)), ['electoral_roll.index'])
+        self.assertEqual(list(MmapConnection('mmap', file_name=self.file_name).iterate_electors()), [get_padron_row(1)])
+
+    def test_the_electors_are_not_changed_with_the_mmap_engine(self):
+        for view, path, kwargs in [(ElectorCreateView, '/manage_electors/new/', {}),
+                                   (ElectorDeleteView, '/voting_info/000000001/delete', {'pk': '000000001'})]:
+            request = RequestFactory().post(path)
+            request.user = mock.Mock(is_authenticated=True)
+            request._messages = CookieStorage(request)
+
+            with mock.patch('electoral_roll.views.DB_ENGINE', 'mmap'):
+                response = view.as_view()(request, **kwargs)
+
+            self.assertEqual(response.status_code, 403)
+            self.assertIn('solo lectura', response.content.decode())
+
+    def test_an_elector_is_not_saved_with_the_mmap_engine(self):
+        with mock.patch('electoral_roll.models.DB_ENGINE', 'mmap'):
+            with self.assertRaises(ReadOnlyEngineError):
+                Elector(cedula='000000001').save()
+
+        with self.assertRaises(ReadOnlyEngineError):
+            MmapConnection('mmap', file_name=self.file_name).bulk_insert([], 'padron')
+
+    def test_a_new_index_file_is_mapped_in_the_next_search(self):
+        write_index(self.file_name, self.districts, iter([get_padron_row(1)]))
+        connection = MmapConnection('mmap', file_name=self.file_name)
+        old_index = connection.open_index()
+
+        self.assertEqual(connection.search_by_id_card('000000002'), [])
+
+        write_index(self.file_name, self.districts, iter([get_padron_row(1), get_padron_row(2)]))
+
+        self.assertEqual(connection.search_by_id_card('000000002')['cedula'], '000000002')
+        # A search that started with the old file keeps reading it
+        self.assertEqual(old_index.electors_count, 1)
+        self.assertIsNone(old_index.find_position(2))
+
+
+class BatchVotingInfoTests(SimpleTestCase):
+
+    def setUp(self):
+        mock.patch('electoral_roll.views.BATCH_API_KEYS', ['first-key']).start()
+        self.queries = mock.patch('electoral_roll.views.Queries').start()
+        self.addCleanup(mock.patch.stopall)
+        self.queries.return_value.search_id_cards.side_effect = lambda id_cards: ((id_card, None) for id_card in id_cards)
+
+    def post(self, user=None, **headers):
+        upload = SimpleUploadedFile('cedulas.csv', b'cedula,nombre\n000000001,JOSE\n000000002,ANA\n')
+        request = RequestFactory().post('/batch_voting_info?format=csv', {'file': upload}, **headers)
+        request.user = user or mock.Mock(is_authenticated=False)
+        return batch_voting_info(request)
+
+    def test_a_script_with_an_api_key_does_not_need_a_session_or_a_csrf_token(self):
+        response = self.post(HTTP_X_API_KEY='first-key')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        # The header of the uploaded csv is not searched
+        self.queries.return_value.search_id_cards.assert_called_once_with(['000000001', '000000002'])
+        self.assertEqual(lines[0].split(',')[:2], ['cedula', 'found'])
+        self.assertEqual(lines[1].split(',')[:2], ['000000001', 'False'])
+
+    def test_a_request_without_a_valid_key_or_a_session_is_rejected(self):
+        self.assertEqual(self.post(HTTP_X_API_KEY='other-key').status_code, 401)
+        self.assertEqual(self.post().status_code, 401)
+        self.queries.return_value.search_id_cards.assert_not_called()
+
+    def test_a_request_with_a_session_is_checked_against_csrf(self):
+        self.assertEqual(self.post(user=mock.Mock(is_authenticated=True)).status_code, 403)
+        self.queries.return_value.search_id_cards.assert_not_called()
+
+
+class SearchCacheTests(SimpleTestCase):
+
+    def test_the_least_recently_used_result_is_discarded(self):
+        cache = SearchCache(2, 60)
+        cache.set('101110111', 'first')
+        cache.set('202220222', 'second')
+        # Reading the first result makes the second one the least recently used
+        self.assertEqual(cache.get('101110111'), 'first')
+        cache.set('303330333', 'third')
+
+        self.assertIsNone(cache.get('202220222'))
+        self.assertEqual(cache.get('101110111'), 'first')
+        self.assertEqual(cache.get('303330333'), 'third')
+
+    def test_an_expired_result_is_not_returned(self):
+        cache = SearchCache(2, 60)
+        now = time.monotonic()
+        cache.set('101110111', 'first')
+
+        with mock.patch('electoral_roll.cache.time.monotonic', return_value=now + 61):
+            self.assertIsNone(cache.get('101110111'))
+
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+    def test_the_stats_count_the_hits_and_the_misses(self):
+        cache = SearchCache(2, 60)
+        cache.set('101110111', 'first')
+        cache.get('101110111')
+        cache.get('202220222')
+        cache.invalidate('101110111')
+        cache.get('101110111')
+
+        self.assertEqual(cache.get_stats(), {'size': 0, 'max_size': 2, 'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3})
+
+
+class CounterQuerySet:
+    """Rows of a stats table whose update only accepts the increments F(field) + quantity that postgres applies to the stored value"""
+
+    def __init__(self, rows, key):
+        self.rows = rows
+        self.key = key
+
+    def filter(self, **query):
+        return CounterQuerySet(self.rows, tuple(sorted(query.items())))
+
+    def update(self, **changes):
+        row = self.rows.setdefault(self.key, Counter())
+
+        for field, change in changes.items():
+            if (change.lhs.name, change.connector) != (field, '+'):
+                raise AssertionError(f"{field} is not updated with an increment of the stored value")
+
+            row[field] += change.rhs.value
+
+        return 1
+
+
+class UpsertCursor:
+    """Cursor that runs the INSERT ... ON CONFLICT of the expiration dates, adding the quantity to the stored total"""
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params):
+        if 'ON CONFLICT (fecha_caducidad) DO UPDATE' not in sql or '.total_votantes + EXCLUDED.total_votantes' not in sql:
+            raise AssertionError('The expiration date is not inserted and updated in one statement')
+
+        expiration_date, quantity = params
+        self.totals[expiration_date] = self.totals.get(expiration_date, 0) + quantity
+
+
+class StatisticsSignalsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.rows = {}
+        self.totals = {}
+        upsert_connection = mock.Mock(cursor=lambda: UpsertCursor(self.totals))
+
+        for model in ('VotantesPorProvincia', 'VotantesPorCanton', 'VotantesPorDistrito'):
+            mock.patch(f'electoral_roll.signals.{model}', objects=CounterQuerySet(self.rows.setdefault(model, {}), None)).start()
+
+        mock.patch('electoral_roll.signals.VotantesPorFechaCaducidad._meta.db_table', 'electoral_roll_votantesporfechacaducidad').start()
+        mock.patch('electoral_roll.signals.connection', upsert_connection).start()
+        mock.patch('electoral_roll.signals.transaction', atomic=contextlib.nullcontext, on_commit=lambda function: function()).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def get_elector(self, gender, expiration_date):
+        district = mock.Mock(provincia='SAN JOSE', canton='CENTRAL', distrito='CARMEN')
+        return mock.Mock(cedula='101110111', codigo_electoral=district, relleno=gender, fecha_caducidad=expiration_date)
+
+    def get_province_counters(self):
+        return self.rows['VotantesPorProvincia'][(('provincia', 'SAN JOSE'),)]
+
+    def test_repeated_saves_and_deletes_add_to_the_stored_counters(self):
+        expiration_date = date(2030, 12, 31)
+
+        for gender in ('1', '1', '2'):
+            update_statistics_create(Elector, self.get_elector(gender, expiration_date), created=True)
+
+        # Saving an elector that already exists does not count it again
+        update_statistics_create(Elector, self.get_elector('1', expiration_date), created=False)
+        update_statistics_delete(Elector, self.get_elector('2', expiration_date))
+
+        self.assertEqual(self.get_province_counters(), Counter(total_votantes=2, total_votantes_hombres=2, total_votantes_mujeres=0))
+        self.assertEqual(list(self.rows['VotantesPorDistrito'].values()), [self.get_province_counters()])
+        self.assertEqual(self.totals, {expiration_date: 2})
+
+    def test_a_new_expiration_date_is_inserted_once(self):
+        for expiration_date in (date(2030, 12, 31), date(2031, 1, 1), date(2031, 1, 1)):
+            update_statistics_create(Elector, self.get_elector('2', expiration_date), created=True)
+
+        self.assertEqual(self.totals, {date(2030, 12, 31): 1, date(2031, 1, 1): 2})
+
+
+class RecachingCollection:
+    """Collection of electors whose delete_one caches the elector again, as a search done while the elector is deleted does"""
+
+    def __init__(self, elector):
+        self.elector = elector
+
+    def find_one(self, query):
+        return self.elector
+
+    def delete_one(self, query):
+        id_card_cache.set(query['cedula'], self.elector)
+
+
+class CacheInvalidationTests(SimpleTestCase):
+
+    def tearDown(self):
+        id_card_cache.clear()
+
+    def test_a_search_done_while_an_elector_is_deleted_is_not_left_in_the_cache(self):
+        connection = MongoConnection('mongo')
+        elector = {'cedula': '101110111', 'codigo_electoral': '101001', 'relleno': '1', 'fecha_caducidad': '20301231'}
+        connection.db = {connection.elector_table_or_collection: RecachingCollection(elector)}
+        connection.update_statistics = mock.Mock()
+
+        connection.delete_elector('101110111')
+
+        self.assertIsNone(id_card_cache.get('101110111'))
+        connection.update_statistics.assert_called_once_with('101001', '1', 'decrease', '20301231')
+
+    def test_the_saved_elector_is_invalidated_when_the_transaction_commits(self):
+        id_card_cache.set('101110111', 'old elector')
+        callbacks = []
+
+        with mock.patch('electoral_roll.signals.transaction.on_commit', callbacks.append):
+            invalidate_cached_elector('101110111')
+            # Until the commit the database still has the old elector
+            self.assertEqual(id_card_cache.get('101110111'), 'old elector')
+
+        for callback in callbacks:
+            callback()
+
+        self.assertIsNone(id_card_cache.get('101110111'))
@@ -5,7 +5,10 @@ from .views import ElectorCreateView,ElectorDeleteView
 urlpatterns = [
     path('', views.home, name='electoral_roll-home'),
     path('voting_info', views.voting_info, name='voting-information'), 
+    path('search_names', views.search_names, name='search-names'),
+    path('batch_voting_info', views.batch_voting_info, name='batch-voting-information'),
     path('manage_electors', views.manage_home, name='manage-home'), 
+    path('manage_electors/cache_stats', views.cache_stats, name='cache-stats'),
     path('manage_electors/new/', ElectorCreateView.as_view(), name='elector-create'),
     path('voting_info/<str:pk>/delete', ElectorDeleteView.as_view(), name='elector-delete'),
 
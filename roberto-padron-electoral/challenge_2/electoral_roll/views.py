@@ -1,18 +1,26 @@
+import csv
+import hmac
+import json
+from functools import wraps
 from django.shortcuts import render,  redirect ,HttpResponseRedirect , reverse
 from django.views.generic import CreateView, DeleteView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.http import JsonResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt
 
 from .models import Elector
 from .forms import PollingPlaceForm
 from .queries import Queries
 from.statistics import Statistics
+from .cache import id_card_cache
 
-from challenge_2.settings import DB_ENGINE
-from electoral_roll.database_manager.mongo_connection import MongoConnection
-
-connection =  MongoConnection(DB_ENGINE)
+from challenge_2.settings import DB_ENGINE, BATCH_API_KEYS
+from electoral_roll.database_manager.connection_producer import DBConnectionProducer
+from electoral_roll.database_manager.connection import ReadOnlyEngineError
 
 
 def home(request):
@@ -52,13 +60,144 @@ def voting_info(request):
     return render(request, template, {'elector_information': elector_information, "statistics": polling_statistics})
 
 
+def search_names(request):
+    """Returns as json a page of the electors with names similar to the query parameters nombre, primer_apellido and segundo_apellido"""
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = min(max(int(request.GET.get('page_size', 20)), 1), 100)
+    except ValueError:
+        return JsonResponse({'error': 'page and page_size must be numbers'}, status=400)
+
+    query_object = Queries(elector_name=request.GET.get('nombre', ''),
+                           elector_first_surname=request.GET.get('primer_apellido', ''),
+                           elector_second_surname=request.GET.get('segundo_apellido', ''))
+
+    results = query_object.search_similar_names(page, page_size)
+
+    return JsonResponse({'page': page, 'page_size': page_size, 'results': results})
+
+
+class Echo:
+    """An object that returns the value to write instead of storing it, used to stream a csv"""
+
+    def write(self, value):
+        return value
+
+
+def get_batch_id_cards(request):
+    """ Returns the id cards sent in an uploaded file (one by line, or the first column of a csv),
+        in the cedulas field separated by commas or blanks, or in a json body {"cedulas": [...]}.
+        The lines of the file that do not start with a number, as the header of a csv, are skipped
+    """
+    if 'file' in request.FILES:
+        lines = request.FILES['file'].read().decode('utf-8-sig').splitlines()
+        id_cards = [line.split(',')[0] for line in lines if line.split(',')[0].strip().isdigit()]
+
+    elif request.content_type == 'application/json':
+        id_cards = json.loads(request.body).get('cedulas', [])
+
+    else:
+        id_cards = request.POST.get('cedulas', '').replace(',', ' ').split()
+
+    return [str(id_card).strip() for id_card in id_cards if str(id_card).strip()]
+
+
+def get_csv_lines(writer, fields, results):
+    """Yields the header and a csv line for each id card, the fields are empty when the elector does not exist"""
+    yield writer.writerow(['cedula', 'found'] + fields[1:])
+
+    for id_card, result in results:
+        yield writer.writerow([id_card, result is not None] + [result[field] if result else '' for field in fields[1:]])
+
+
+def api_key_or_login_required(view):
+    """ Lets in the scripts that send one of the BATCH_API_KEYS in the X-Api-Key header, they do not need a session or a csrf token.
+        The users of the site use their session, and their requests are checked against csrf as in the other views
+    """
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        api_key = request.headers.get('X-Api-Key')
+
+        if api_key is not None:
+            if not any(hmac.compare_digest(api_key, key) for key in BATCH_API_KEYS):
+                return JsonResponse({'error': 'The API key is not valid'}, status=401)
+
+            return view(request, *args, **kwargs)
+
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Log in or send an API key in the X-Api-Key header'}, status=401)
+
+        csrf_error = CsrfViewMiddleware(lambda request: None).process_view(request, None, (), {})
+
+        if csrf_error is not None:
+            return csrf_error
+
+        return view(request, *args, **kwargs)
+
+    return wrapper
+
+
+@api_key_or_login_required
+def batch_voting_info(request):
+    """ Searches a list of id cards with one query for each batch and streams the results as json lines or csv (?format=csv)"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Send the id cards with a POST request'}, status=405)
+
+    try:
+        id_cards = get_batch_id_cards(request)
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'The id cards could not be read'}, status=400)
+
+    results = Queries().search_id_cards(id_cards)
+    fields = ['cedula', 'nombre', 'primer_apellido', 'segundo_apellido', 'fecha_caducidad', 'codigo_electoral',
+              'codigo_electoral__provincia', 'codigo_electoral__canton', 'codigo_electoral__distrito']
+
+    if request.GET.get('format') == 'csv':
+        writer = csv.writer(Echo())
+        response = StreamingHttpResponse(get_csv_lines(writer, fields, results), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="electores.csv"'
+
+    else:
+        lines = (json.dumps({'cedula': id_card, 'found': result is not None, 'elector': result}, cls=DjangoJSONEncoder) + '\n'
+                 for id_card, result in results)
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+    return response
+
+
+@login_required
+def cache_stats(request):
+    return JsonResponse(id_card_cache.get_stats())
+
+
 @login_required
 def manage_home(request):
     template = 'electoral_roll/manage_electors_form.html'
     return render(request, template)
 
 
-class ElectorCreateView(LoginRequiredMixin, CreateView):
+class WritableEngineMixin:
+    """ The mmap engine only reads the index file, so the views that change the electors are not available with it.
+        They answer 403 with the page to manage the electors and the message
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if(DB_ENGINE == 'mmap'):
+            return self.read_only_response(request)
+
+        try:
+            return super().dispatch(request, *args, **kwargs)
+
+        except ReadOnlyEngineError:
+            return self.read_only_response(request)
+
+    def read_only_response(self, request):
+        messages.error(request, "El padrón es de solo lectura con el motor mmap, los electores se cambian en mongo o postgres")
+        return render(request, 'electoral_roll/manage_electors_form.html', status=403)
+
+
+class ElectorCreateView(LoginRequiredMixin, WritableEngineMixin, CreateView):
     model = Elector
     fields = ['cedula',
               'codigo_electoral',
@@ -75,13 +214,14 @@ class ElectorCreateView(LoginRequiredMixin, CreateView):
         return response
 
 
-class ElectorDeleteView(LoginRequiredMixin,DeleteView):
+class ElectorDeleteView(LoginRequiredMixin, WritableEngineMixin, DeleteView):
     model = Elector
     success_url = '/'
 
     
     def delete(self, request, *args, **kwargs):
         messages.info(self.request, "Elector eliminado satisfactoriamente")
+        connection = DBConnectionProducer.get_connection(DB_ENGINE)
 
         if connection.engine == 'mongo':
             connection.delete_elector(kwargs['pk'])
@@ -92,6 +232,7 @@ class ElectorDeleteView(LoginRequiredMixin,DeleteView):
             return response
 
     def get(self, request, *args, **kwargs):
+        connection = DBConnectionProducer.get_connection(DB_ENGINE)
 
         if connection.engine == 'mongo':
             id_card = kwargs['pk']